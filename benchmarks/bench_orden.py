@@ -0,0 +1,236 @@
+"""
+Microbenchmarks del camino de Orden.registra(), etapa por etapa, sin red.
+
+Cada etapa se mide para una sola orden y para lotes de varios tamaños. Los
+resultados se guardan en JSON para compararlos contra una ejecución previa:
+
+    python benchmarks/bench_orden.py --output base.json
+    python benchmarks/bench_orden.py --compare base.json --threshold 0.2
+
+Con --compare el proceso termina con código 1 si alguna etapa es más lenta
+que la referencia por encima del umbral.
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from zeep.wsdl.utils import etree_to_string
+
+import stpmex
+from stpmex import Orden, base
+from stpmex.envelope import EnvelopeTemplate
+from stpmex.testing import RESPONSE_TEMPLATE
+from stpmex.types import Institucion
+
+DEFAULT_SIZES = (1, 1_000, 100_000)
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 0.2
+# Tiempo mínimo por medición de una sola orden, repitiéndola las veces
+# necesarias para que el resultado sea estable
+MIN_SINGLE_TIME = 0.2
+PASSPHRASE = 'benchmark'
+
+FIELDS = dict(
+    conceptoPago='Prueba',
+    institucionOperante=Institucion.STP.value,
+    cuentaBeneficiario='072691004495711499',
+    institucionContraparte=Institucion.BANORTE.value,
+    monto=1.2,
+    nombreBeneficiario='Ricardo Sanchez',
+)
+# Firma de relleno del tamaño de una RSA de 2048 bits, para las etapas que
+# van después de firmar
+FIRMA = 'A' * 342 + '=='
+RESPONSE = RESPONSE_TEMPLATE.format(
+    operation='registraOrden', body='<id>1</id>').encode('utf-8')
+
+
+def _configure():
+    """
+        Configura stpmex con el WSDL incluido y una llave nueva. La caché de
+        firmas se desactiva para medir la firma RSA y no la caché.
+    """
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+        serialization.BestAvailableEncryption(PASSPHRASE.encode('ascii')))
+    stpmex.configure('TAMIZI', pem.decode('ascii'), PASSPHRASE, 1570,
+                     wsdl_path=stpmex.BUNDLED_WSDL, wsdl_cache=False,
+                     signature_cache_size=0)
+
+
+def _stages():
+    """
+        Etapas en el orden en que las ejecuta registra(). Cada una es
+        (nombre, preparación, función): la preparación recibe el número de
+        órdenes y devuelve las entradas, que no cuentan en el tiempo medido.
+    """
+    client = base.ACTUALIZA_CLIENT
+    service = base.ACTUALIZA_SERVICE
+    binding = service._binding
+    operation = binding.get('registraOrden')
+    template = EnvelopeTemplate.build(service, 'registraOrden')
+
+    def fields(n):
+        return [dict(FIELDS) for _ in range(n)]
+
+    def ordenes(n):
+        return [Orden(**FIELDS) for _ in range(n)]
+
+    def cadenas(n):
+        rv = ordenes(n)
+        for orden in rv:
+            orden._joined_fields
+        return rv
+
+    def firmadas(n):
+        rv = ordenes(n)
+        for orden in rv:
+            orden.firma = FIRMA
+        return rv
+
+    def zeep_objects(n):
+        return [orden._to_zeep() for orden in firmadas(n)]
+
+    def responses(n):
+        return [SimpleNamespace(status_code=200, content=RESPONSE,
+                                headers={}, encoding=None)
+                for _ in range(n)]
+
+    def serialize(obj):
+        envelope = client.create_message(service, 'registraOrden', obj)
+        return etree_to_string(envelope)
+
+    def parse(response):
+        return binding.process_reply(client, operation, response)
+
+    return [
+        ('orden_init', fields, lambda kwargs: Orden(**kwargs)),
+        ('is_valid', ordenes, Orden._is_valid),
+        ('join_fields', ordenes, Orden._serializer),
+        ('compute_signature', cadenas, Orden._compute_signature),
+        ('to_zeep', firmadas, Orden._to_zeep),
+        ('serialize_envelope', zeep_objects, serialize),
+        ('parse_response', responses, parse),
+        ('template_envelope', firmadas, template.render),
+        ('template_parse', responses, template.parse),
+    ]
+
+
+def _run(func, items) -> float:
+    start = time.perf_counter()
+    for item in items:
+        func(item)
+    return time.perf_counter() - start
+
+
+def _measure(setup, func, size: int, repeat: int) -> dict:
+    """
+        Mide una etapa y se queda con la mejor de `repeat` ejecuciones
+    :return: Tiempo total, por orden y órdenes por segundo
+    """
+    if size == 1:
+        # Una sola orden procesada tantas veces como haga falta
+        items = setup(1)
+        loops = 1
+        while _run(func, items * loops) < MIN_SINGLE_TIME:
+            loops *= 10
+        items = items * loops
+    else:
+        items = setup(size)
+    best = min(_run(func, items) for _ in range(repeat))
+    per_op = best / len(items)
+    return dict(size=size, ops=len(items), seconds=best,
+                per_op_us=per_op * 1e6, ops_per_sec=1 / per_op)
+
+
+def run(sizes=DEFAULT_SIZES, repeat: int = DEFAULT_REPEAT,
+        stages=None, verbose: bool = True) -> dict:
+    """
+        Ejecuta todas las etapas para cada tamaño de lote
+    :param sizes: Tamaños de lote; 1 mide una sola orden
+    :param repeat: Ejecuciones por medición
+    :param stages: Nombres de las etapas a medir, por omisión todas
+    :return: Resultados listos para guardar como JSON
+    """
+    _configure()
+    results = {}
+    for name, setup, func in _stages():
+        if stages and name not in stages:
+            continue
+        for size in sizes:
+            result = _measure(setup, func, size, repeat)
+            results[f'{name}[{size}]'] = result
+            if verbose:
+                print(f'{name}[{size}]'.ljust(28),
+                      f'{result["per_op_us"]:12.2f} us/op',
+                      f'{result["ops_per_sec"]:14.0f} ops/s')
+    return dict(
+        meta=dict(
+            date=datetime.now(timezone.utc).isoformat(),
+            python=platform.python_version(),
+            implementation=platform.python_implementation(),
+            platform=platform.platform(),
+            repeat=repeat,
+        ),
+        results=results,
+    )
+
+
+def compare(current: dict, reference: dict,
+            threshold: float = DEFAULT_THRESHOLD) -> list:
+    """
+        Compara el tiempo por orden de dos ejecuciones
+    :param threshold: Proporción de aumento tolerada, 0.2 es 20%
+    :return: Lista de (etapa, referencia, actual, cambio) de las etapas que
+        empeoraron más que el umbral
+    """
+    regressions = []
+    for key, result in current['results'].items():
+        previous = reference['results'].get(key)
+        if previous is None:
+            continue
+        change = result['per_op_us'] / previous['per_op_us'] - 1
+        if change > threshold:
+            regressions.append((key, previous['per_op_us'],
+                                result['per_op_us'], change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help='Tamaños de lote separados por comas')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('--stage', action='append', dest='stages',
+                        help='Mide sólo esta etapa, se puede repetir')
+    parser.add_argument('--output', help='Guarda los resultados en JSON')
+    parser.add_argument('--compare', help='JSON de referencia')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    current = run(sizes, args.repeat, args.stages)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(current, fp, indent=2)
+    if args.compare:
+        with open(args.compare) as fp:
+            reference = json.load(fp)
+        regressions = compare(current, reference, args.threshold)
+        for key, previous, actual, change in regressions:
+            print(f'REGRESSION {key}: {previous:.2f} -> {actual:.2f} us/op '
+                  f'(+{change:.0%})')
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
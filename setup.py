@@ -1,8 +1,10 @@
 import setuptools
 
 requirements = [
-    'zeep',
-    'pyopenssl',
+    # Se usan atributos privados de zeep (ver test_zeep_privados): subir el
+    # límite sólo después de correr las pruebas con la nueva versión
+    'zeep>=4.0,<4.4',
+    'cryptography',
     'clabe'
 ]
 
@@ -19,11 +21,15 @@ setuptools.setup(
     long_description_content_type='text/markdown',
     url='https://github.com/cuenca-mx/stpmex-python',
     packages=setuptools.find_packages(),
+    package_data={'stpmex': ['wsdl/*.wsdl']},
     install_requires=requirements,
     setup_requires=['pytest-runner'],
     tests_require=['pytest', 'vcrpy'],
     extras_require={
+        'async': ['httpx>=0.26'],
+        'numpy': ['numpy'],
         'dev': [
+            'httpx>=0.26',
             'pytest>=3',
             'ipython',
             'ipdb',
@@ -1,47 +1,131 @@
 """
 Configuraciones iniciales para utilizar el cliente posteriormente
+
+Los módulos con dependencias pesadas (zeep, requests, cryptography) se cargan
+hasta que se usan: `import stpmex` o `stpmex.types` no los importa, y
+`stpmex.Orden` o `stpmex.StpClient` los cargan la primera vez que se piden.
 """
-from zeep import Client
-from zeep.transports import Transport
-from OpenSSL import crypto
-from requests import Session
-from .ordenes import Orden
-from .base import STP_EMPRESA, STP_PREFIJO, STP_PRIVKEY, STP_PRIVKEY_PASSPHRASE
+from importlib import import_module
+from pkgutil import iter_modules
+
+from .defaults import (BUNDLED_WSDL, DEFAULT_CACHE_SIZE, DEFAULT_CACHE_TTL,
+                       DEFAULT_POOL_SIZE, DEFAULT_WSDL)
+from .retry import DEFAULT_RESET_TIMEOUT
+
+# Nombre público: módulo donde se define
+_LAZY = dict(
+    StpClient='client',
+    Orden='ordenes',
+    Resultado='ordenes',
+    ClaveRastreoIndex='generators',
+    STP_EMPRESA='base',
+    STP_PREFIJO='base',
+    STP_PRIVKEY='base',
+    STP_PRIVKEY_PASSPHRASE='base',
+)
+# Submódulos que se pueden usar como atributo sin haberlos importado, por
+# ejemplo `stpmex.base` después de `import stpmex`
+_SUBMODULES = frozenset(module.name for module in iter_modules(__path__)
+                        if not module.name.startswith('_'))
+
 
-DEFAULT_WSDL = ('https://demo.stpmex.com:7024/speidemo/webservices/SpeiActual'
-                'izaServices?wsdl')
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return import_module(f'.{name}', __name__)
+    try:
+        module = _LAZY[name]
+    except KeyError:
+        raise AttributeError(f'module {__name__!r} has no attribute '
+                             f'{name!r}') from None
+    return getattr(import_module(f'.{module}', __name__), name)
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY) | _SUBMODULES)
 
 
 def configure(empresa: str, priv_key: str, priv_key_passphrase: str,
               prefijo: int, wsdl_path: str = DEFAULT_WSDL, proxy: str = None,
-              proxy_user: str = None, proxy_password: str = None):
+              proxy_user: str = None, proxy_password: str = None,
+              endpoint: str = None, wsdl_cache: bool = True,
+              cache_path: str = None, cache_ttl: int = DEFAULT_CACHE_TTL,
+              pool_size: int = DEFAULT_POOL_SIZE, keep_alive: bool = True,
+              connect_timeout: float = None, read_timeout: float = None,
+              deadline: float = None,
+              signature_cache_size: int = DEFAULT_CACHE_SIZE,
+              clave_rastreo_index: 'ClaveRastreoIndex' = None,
+              fast_envelope: bool = False, public_key: str = None,
+              retry_policy: 'RetryPolicy' = None,
+              breaker_threshold: int = None,
+              breaker_reset_timeout: float = DEFAULT_RESET_TIMEOUT,
+              journal: 'Journal' = None, capture: 'Capture' = None):
     """
     Configura las credenciales y parámetros necesarios para poder hacer
-    peticiones a STP
+    peticiones a STP. Crea el StpClient por omisión, que es el que usan las
+    órdenes que no están ligadas a otro cliente
     :param empresa: Nombre de la empresa
     :param priv_key: Contenido de la llave privada
     :param priv_key_passphrase: Password de la llave privada
     :param prefijo: Prefijo en STP
-    :param wsdl_path: URL del WSDL a utilizar
+    :param wsdl_path: URL del WSDL a utilizar, o BUNDLED_WSDL para usar el
+        WSDL incluido en el paquete sin descargar nada
     :param proxy: Si es necesario, se puede especificar un proxy
     :param proxy_user: Usuario del proxy
     :param proxy_password: Contraseña del proxy
-    :return:
+    :param endpoint: URL del servicio, si es distinta a la declarada en el
+        WSDL (por ejemplo producción usando BUNDLED_WSDL)
+    :param wsdl_cache: Guarda en disco el WSDL y sus esquemas descargados
+    :param cache_path: Archivo sqlite para la caché del WSDL. Por omisión se
+        usa el directorio de caché del usuario
+    :param cache_ttl: Segundos que es válida la caché del WSDL
+    :param pool_size: Conexiones HTTP que se mantienen abiertas por host
+    :param keep_alive: Reutiliza las conexiones TLS entre peticiones
+    :param connect_timeout: Segundos máximos para establecer la conexión
+    :param read_timeout: Segundos máximos de espera entre datos recibidos
+    :param deadline: Segundos máximos en total por cada llamada a STP
+    :param signature_cache_size: Firmas que se guardan por cadena original
+        para no volver a firmar los reintentos. 0 la desactiva
+    :param clave_rastreo_index: Índice que rechaza antes de enviarla una
+        orden con una claveRastreo ya usada
+    :param fast_envelope: Envía registraOrden con un envelope precompilado
+        en lugar de construirlo con zeep
+    :param public_key: Certificado o llave pública PEM para verificar
+        firmas con `Resource.verify`
+    :param retry_policy: stpmex.retry.RetryPolicy para reenviar las órdenes
+        que fallan por errores de red o del servidor
+    :param breaker_threshold: Fallas seguidas tras las que se deja de enviar
+        a STP por `breaker_reset_timeout` segundos
+    :param breaker_reset_timeout: Segundos que el circuito permanece abierto
+    :param journal: stpmex.journal.Journal para anotar las órdenes antes de
+        enviarlas y reenviar con `replay()` las que queden sin resultado
+    :param capture: stpmex.capture.Capture con las últimas peticiones y
+        respuestas SOAP. También queda en `base.HISTORY`
+    :return: StpClient por omisión
     """
+    from . import base
+    from .client import StpClient
+
+    client = StpClient(
+        empresa, priv_key, priv_key_passphrase, prefijo, wsdl_path=wsdl_path,
+        proxy=proxy, proxy_user=proxy_user, proxy_password=proxy_password,
+        endpoint=endpoint, wsdl_cache=wsdl_cache, cache_path=cache_path,
+        cache_ttl=cache_ttl, pool_size=pool_size, keep_alive=keep_alive,
+        connect_timeout=connect_timeout, read_timeout=read_timeout,
+        deadline=deadline, signature_cache_size=signature_cache_size,
+        clave_rastreo_index=clave_rastreo_index, fast_envelope=fast_envelope,
+        public_key=public_key, retry_policy=retry_policy,
+        breaker_threshold=breaker_threshold,
+        breaker_reset_timeout=breaker_reset_timeout, journal=journal,
+        capture=capture)
+    if base.DEFAULT_CLIENT is not None:
+        base.DEFAULT_CLIENT.close()
+    base.DEFAULT_CLIENT = client
+    base.HISTORY = capture
     base.STP_EMPRESA = empresa
-    base.STP_PRIVKEY = crypto.load_privatekey(
-        crypto.FILETYPE_PEM, priv_key, priv_key_passphrase. encode('ascii'))
+    base.STP_PRIVKEY = client.signer.key
     base.STP_PRIVKEY_PASSPHRASE = priv_key_passphrase
     base.STP_PREFIJO = prefijo
-    base.WSDL_PATH = wsdl_path
-
-    if proxy is not None:
-        session = Session()
-        session.proxies = {
-            'https': f"https://{proxy_user}:{proxy_password}@{proxy}",
-            'http':  f"http://{proxy_user}:{proxy_password}@{proxy}"
-        }
-        base.ACTUALIZA_CLIENT = Client(wsdl_path,
-                                       transport=Transport(session=session))
-    else:
-        base.ACTUALIZA_CLIENT = Client(wsdl_path)
+    base.ACTUALIZA_CLIENT = client.client
+    base.ACTUALIZA_SERVICE = client.service
+    base.ZEEP_TYPES = client.zeep_types
+    return client
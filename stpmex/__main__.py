@@ -1,10 +1,11 @@
 """
-CLI para enviar órdenes a STP.
+CLI para enviar órdenes a STP. Los datos se piden antes de configurar el
+cliente, así que zeep y el WSDL sólo se cargan al momento de enviar.
 """
 import argparse
 import json
-import stpmex
-from stpmex import Orden
+
+from stpmex.defaults import BUNDLED_WSDL, DEFAULT_MAX_WORKERS
 from stpmex.types import Institucion
 
 DEFAULT_FILE_NAME = 'stp.config'
@@ -24,13 +25,17 @@ def config():
     pk_file = input('Route to private key: ')
     with open(pk_file) as fp:
         pk_value = fp.read()
+    wsdl = input('WSDL (empty to use the bundled one): ')
     configuration = {
-        'wsdl': input('WSDL: '),
+        'wsdl': wsdl or BUNDLED_WSDL,
         'private_key': pk_value,
         'pkey_passphrase': input('Private key passphrase: '),
         'empresa': input('Empresa: '),
         'prefijo': input('Prefijo: ')
     }
+    endpoint = input('Endpoint (optional): ')
+    if endpoint:
+        configuration['endpoint'] = endpoint
     use_proxy = input('Wish to use a proxy? (y/n): ').lower() == 'y'
     if use_proxy:
         configuration['proxy'] = input('Proxy: ')
@@ -43,47 +48,71 @@ def config():
     print("Done...")
 
 
-def order():
+def _client_config():
     """
-    Crea una nueva orden para enviar a STP
-    :return:
+        Lee el archivo creado por `stpmex config`
+    :return: Argumentos para StpClient, o None si no existe el archivo
     """
     try:
         with open(DEFAULT_FILE_NAME, 'r') as f:
             config = json.load(f)
     except IOError:
         print("No configuration file found, use first: stpmex config")
-        return
+        return None
+    return dict(wsdl_path=config['wsdl'], empresa=config['empresa'],
+                priv_key=config['private_key'],
+                priv_key_passphrase=config['pkey_passphrase'],
+                prefijo=config['prefijo'],
+                proxy=config.get('proxy'),
+                proxy_user=config.get('user'),
+                proxy_password=config.get('password'),
+                endpoint=config.get('endpoint'),
+                )
+
+
+def _configure_from_file():
+    """
+        Configura el cliente con el archivo creado por `stpmex config`
+    :return: True si se pudo configurar
+    """
+    config = _client_config()
+    if config is None:
+        return False
 
-    stpmex.configure(wsdl_path=config['wsdl'], empresa=config['empresa'],
-                     priv_key=config['private_key'],
-                     priv_key_passphrase=config['pkey_passphrase'],
-                     prefijo=config['prefijo'],
-                     proxy=None if 'proxy' not in config else config['proxy'],
-                     proxy_user=None if 'user' not in config
-                     else config['user'],
-                     proxy_password=None if 'password' not in config
-                     else config['password'],
-                     )
+    import stpmex
+    stpmex.configure(**config)
+    return True
 
-    print("Connection established")
 
-    order = Orden()
-    order.institucionOperante = Institucion.STP.value
-    order.nombreBeneficiario = input('Nombre del beneficiario: ')
-    order.cuentaBeneficiario = input('CLABE del beneficiario: ')
-    order.institucionContraparte = input('Institución de contraparte: ')
-    order.conceptoPago = input('Concepto de pago: ')
-    order.monto = float(input('Monto: '))  # I assume you won't put a str here
+def order():
+    """
+    Crea una nueva orden para enviar a STP
+    :return:
+    """
+    fields = dict(institucionOperante=Institucion.STP.value)
+    fields['nombreBeneficiario'] = input('Nombre del beneficiario: ')
+    fields['cuentaBeneficiario'] = input('CLABE del beneficiario: ')
+    fields['institucionContraparte'] = input('Institución de contraparte: ')
+    fields['conceptoPago'] = input('Concepto de pago: ')
+    # I assume you won't put a str here
+    fields['monto'] = float(input('Monto: '))
     rfc = input('RFC o CURP de beneficiario (opcional): ')
     if rfc:
-        order.rfcCurpBeneficiario = rfc
+        fields['rfcCurpBeneficiario'] = rfc
     num_reference = input('Referencia númerica (opcional): ')
     if num_reference:
-        order.referenciaNumerica = num_reference
+        fields['referenciaNumerica'] = num_reference
     track_code = input('Clave de rastreo (opcional): ')
     if track_code:
-        order.claveRastreo = track_code
+        fields['claveRastreo'] = track_code
+
+    if not _configure_from_file():
+        return
+
+    print("Connection established")
+
+    from stpmex.ordenes import Orden
+    order = Orden(**fields)
 
     print("Sending order....")
     r = order.registra()
@@ -92,20 +121,114 @@ def order():
     print("Finished")
 
 
+def batch(path, results=None, workers=DEFAULT_MAX_WORKERS, formato=None,
+          resume=True):
+    """
+    Envía todas las órdenes de un archivo CSV o JSON Lines
+    :return:
+    """
+    if not _configure_from_file():
+        return
+
+    from stpmex.batch import procesa_archivo
+    print(f"Sending orders from {path}....")
+    resumen = procesa_archivo(path, results_path=results, max_workers=workers,
+                              formato=formato, resume=resume)
+    print(f"Registered: {resumen['registradas']}, "
+          f"errors: {resumen['errores']}, "
+          f"skipped from previous run: {resumen['omitidas']}")
+    print("Finished")
+
+
+def enqueue(path, queue, formato=None):
+    """
+    Agrega las órdenes de un archivo CSV o JSON Lines a la cola de
+    `stpmex worker`
+    :return:
+    """
+    from stpmex.batch import lee_filas
+    from stpmex.worker import open_queue
+    cola = open_queue(queue)
+    try:
+        n = cola.put_many(lee_filas(path, formato))
+    finally:
+        cola.close()
+    print(f"Queued {n} orders in {queue}")
+
+
+def worker(queue, processes=None, workers=DEFAULT_MAX_WORKERS, drain=False):
+    """
+    Envía las órdenes de la cola con varios procesos hasta recibir SIGTERM o
+    Ctrl-C, o hasta vaciarla con --drain
+    :return:
+    """
+    config = _client_config()
+    if config is None:
+        return
+
+    from stpmex.worker import Supervisor, open_queue
+    supervisor = Supervisor(config, queue, processes=processes,
+                            threads=workers, drain=drain)
+    print(f"Starting {supervisor.processes} workers on {queue}....")
+    supervisor.run()
+    cola = open_queue(queue)
+    try:
+        print(cola.counts())
+    finally:
+        cola.close()
+    print("Finished")
+
+
 def main():
     """
     Función principal, recibe como argumento la función a utilizar
     :return:
     """
     parser = argparse.ArgumentParser(description='Creates an order to STP')
-    parser.add_argument('option', choices=['config', 'order'],
-                        help="'config' to configure the client,"
-                             "'order' for creating a new order")
+    parser.add_argument('option',
+                        choices=['config', 'order', 'batch', 'enqueue',
+                                 'worker'],
+                        help="'config' to configure the client, "
+                             "'order' for creating a new order, "
+                             "'batch' for sending the orders in a file, "
+                             "'enqueue' for adding them to a queue, "
+                             "'worker' for sending the queued orders")
+    parser.add_argument('file', nargs='?',
+                        help="CSV or JSON Lines file for 'batch' and "
+                             "'enqueue'")
+    parser.add_argument('--results', help='Results file for batch')
+    parser.add_argument('--workers', type=int, default=DEFAULT_MAX_WORKERS,
+                        help='Concurrent requests to STP for batch, or per '
+                             'process for worker')
+    parser.add_argument('--queue',
+                        help='SQLite file or spool directory for enqueue '
+                             'and worker')
+    parser.add_argument('--processes', type=int,
+                        help='Worker processes, one per core by default')
+    parser.add_argument('--drain', action='store_true',
+                        help='Stop the workers when the queue is empty')
+    parser.add_argument('--format', choices=['csv', 'jsonl'],
+                        help='Input format, by default from the extension')
+    parser.add_argument('--no-resume', action='store_true',
+                        help='Process the whole file again')
     args = parser.parse_args()
     if args.option == 'config':
         config()
     if args.option == 'order':
         order()
+    if args.option == 'batch':
+        if not args.file:
+            parser.error("'batch' requires a file")
+        batch(args.file, args.results, args.workers, args.format,
+              not args.no_resume)
+    if args.option in ('enqueue', 'worker') and not args.queue:
+        parser.error(f"'{args.option}' requires --queue")
+    if args.option == 'enqueue':
+        if not args.file:
+            parser.error("'enqueue' requires a file")
+        enqueue(args.file, args.queue, args.format)
+    if args.option == 'worker':
+        worker(args.queue, args.processes, args.workers, args.drain)
 
 
 if __name__ == '__main__':
@@ -1,5 +1,12 @@
-from base64 import b64encode
-from OpenSSL import crypto
+import asyncio
+import time
+from decimal import ROUND_HALF_UP, Decimal
+from functools import partial
+from pprint import pformat
+
+from . import retry
+from .metrics import measure, measure_async
+from .validations import compile_validations, errors_by_field, validate_many
 
 STP_EMPRESA = None
 STP_PRIVKEY = None
@@ -7,75 +14,144 @@ STP_PRIVKEY_PASSPHRASE = None
 STP_PREFIJO = None
 SIGN_DIGEST = 'RSA-SHA256'
 ACTUALIZA_CLIENT = None
+ACTUALIZA_SERVICE = None
+ZEEP_TYPES = {}
+# StpClient creado por configure(), usado por los recursos sin cliente
+DEFAULT_CLIENT = None
+# Con DEBUG_MODE la captura guarda todas las llamadas, sin muestreo
 DEBUG_MODE = False
+# capture.Capture para los clientes que no tienen una propia
 HISTORY = None
 
 
-def _join_fields(obj, fieldnames):
-    fields = []
+AMOUNT_FIELDS = ('monto', 'iva')
+_serializers = {}
+
+
+def format_amount(value) -> str:
+    """
+        Importe con dos decimales para la cadena original, redondeado hacia
+        arriba en el medio centavo como lo hace STP. Se parte del texto del
+        número y no del float: 1.005 -> '1.01', no '1.00'
+    :param value: Importe como número o texto; None o '' quedan vacíos
+    """
+    if value is None or value == '':
+        return ''
+    return str(Decimal(str(value)).quantize(Decimal('0.01'), ROUND_HALF_UP))
+
+
+def _compile_join_fields(fieldnames):
+    """
+        Genera una sola vez, para un orden de campos dado, la función que
+        construye la cadena original. Los campos se leen directamente como
+        atributos, sin ciclos ni búsquedas por nombre en cada llamada.
+    :param fieldnames: Campos en el orden de la cadena original
+    :return: Función que recibe el objeto y devuelve la cadena en bytes
+    """
+    key = tuple(fieldnames)
+    if key in _serializers:
+        return _serializers[key]
+    parts = []
     for name in fieldnames:
-        if name in ['monto', 'iva'] and not getattr(obj, name) in ['', None]:
-            field = float(getattr(obj, name))
-            field = f'{field:.2f}'
+        if not name.isidentifier():
+            raise ValueError(f'Invalid field name {name!r}')
+        if name in AMOUNT_FIELDS:
+            parts.append(f'format_amount(obj.{name})')
         else:
-            field = getattr(obj, name) or ''
-        fields.append(str(field))
-    return ('||' + '|'.join(fields) + '||').encode('utf-8')
+            # Un 0 numérico se escribe igual que en el ejemplo de cadena
+            # original de STP y que en el envelope: prioridad 0 -> |0|
+            parts.append(f"('' if obj.{name} is None else str(obj.{name}))")
+    source = ("def join_fields(obj):\n"
+              "    return ('||' + '|'.join((" + ', '.join(parts) +
+              ",)) + '||').encode('utf-8')\n")
+    namespace = dict(format_amount=format_amount)
+    exec(source, namespace)
+    _serializers[key] = namespace['join_fields']
+    return _serializers[key]
 
 
-def _validate(field, field_value, validation, validation_value):
+def _join_fields(obj, fieldnames):
+    return _compile_join_fields(fieldnames)(obj)
+
+
+def _get_client(client=None):
     """
-        Evalua si el valor de un campo es válido y devuelve un mensaje de error
-    :param field: Nombre del campo
-    :param field_value: Valor del campo
-    :param validation: Tipo de validación a realizar
-    :param validation_value: Valor a validar
-    :return:
+        Cliente con el que se envía un recurso: el suyo o el de configure()
     """
-    if validation == 'required' and validation_value and not field_value:
-        return 'Field {} is required'.format(field)
-    if validation == 'maxLength' and validation_value < len(str(field_value)):
-        return 'Length of field {} must be lower than {}'\
-            .format(field, validation_value)
-    return None
+    if client is not None:
+        return client
+    if DEFAULT_CLIENT is None:
+        raise RuntimeError('stpmex is not configured, call '
+                           'stpmex.configure() or use a StpClient')
+    return DEFAULT_CLIENT
+
+
+def _get_capture(client):
+    if client.capture is not None:
+        return client.capture
+    return HISTORY
 
 
 class Resource:
+    """
+        Modelo de datos plano. Los campos viven en __slots__ y sólo se
+        convierten al tipo de zeep al momento de enviarlos, así que se pueden
+        crear y validar órdenes sin haber llamado a configure().
+        Un recurso ligado a un StpClient se firma y se envía con ese
+        cliente; si no, con el cliente por omisión de configure().
+    """
+    __slots__ = ('firma', '_cadena', '_id', '_client', '_reservada')
     __fieldnames__ = None
-    __object__ = None
     __type__ = None
     __validations__ = None
     _defaults = {}
+    _serializer = None
+    _fieldset = frozenset()
+    _checkers = ()
+    # False si la operación no se puede enviar con el template de
+    # `fast_envelope`
+    _fast_envelope = True
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.__fieldnames__:
+            cls._serializer = staticmethod(
+                _compile_join_fields(cls.__fieldnames__))
+            cls._fieldset = frozenset(cls.__fieldnames__)
+        if cls.__validations__:
+            cls._checkers = compile_validations(cls.__validations__)
 
     def __init__(self, **kwargs):
+        set_ = object.__setattr__
+        for name in self.__fieldnames__:
+            set_(self, name, None)
+        set_(self, 'firma', None)
+        set_(self, '_cadena', None)
+        set_(self, '_id', None)
+        set_(self, '_client', None)
+        set_(self, '_reservada', False)
         for key, value in kwargs.items():
+            if key not in self._fieldset:
+                raise TypeError(f'{self.__class__.__name__}() got an '
+                                f'unexpected keyword argument {key!r}')
             if isinstance(value, str):
-                kwargs[key] = value.strip()
+                value = value.strip()
+            set_(self, key, value)
         for default, value in self._defaults.items():
             if default not in kwargs:
                 if callable(value):
-                    kwargs[default] = value()
-                else:
-                    kwargs[default] = value
-        self.__object__ = ACTUALIZA_CLIENT.get_type(self.__type__)(**kwargs)
-        self.empresa = STP_EMPRESA
-        self.firma = None
-
-    def __dir__(self):
-        return dir(super(Resource, self)) + dir(self.__object__)
+                    value = value()
+                set_(self, default, value)
+        if 'empresa' not in kwargs:
+            set_(self, 'empresa', STP_EMPRESA)
 
     def __dict__(self):
-        return {r: self.__getattr__(r) for r in self.__fieldnames__}
+        return {r: getattr(self, r) for r in self.__fieldnames__}
 
     def __eq__(self, other):
         return all(getattr(self, name) ==
                    getattr(other, name) for name in self.__fieldnames__)
 
-    def __getattr__(self, item):
-        if item.startswith('_'):
-            return self.__getattribute__(item)
-        return getattr(self.__object__, item)
-
     def __ne__(self, other):
         return not self == other
 
@@ -88,50 +164,269 @@ class Resource:
         return rv
 
     def __setattr__(self, key, value):
-        if key.startswith('_'):
-            super(Resource, self).__setattr__(key, value)
-        else:
-            setattr(self.__object__, key, value)
+        object.__setattr__(self, key, value)
+        if key in self._fieldset:
+            object.__setattr__(self, '_cadena', None)
 
     def __str__(self):
-        return self.__object__.__str__()
+        return pformat(self.__dict__())
+
+    def _prepare_send(self):
+        """
+            Completa la empresa si la orden se creó antes de configure(),
+            valida y firma
+        """
+        client = _get_client(self._client)
+        if self.empresa is None:
+            self.empresa = client.empresa
+        measure('validate', self, self._is_valid)
+        self.firma = measure('sign', self, self._compute_signature)
+        if client.clave_rastreo_index is not None and \
+                'claveRastreo' in self._fieldset:
+            self._reservada = client.clave_rastreo_index.add(
+                self.claveRastreo, self.firma)
+
+    def _libera_clave(self):
+        """
+            Si el envío falló antes de hacer la petición a STP, libera la
+            claveRastreo que `_prepare_send` reservó en el índice para que
+            la misma orden se pueda enviar con otra firma
+        """
+        if self._reservada:
+            self._reservada = False
+            _get_client(self._client).clave_rastreo_index.discard(
+                self.claveRastreo)
+
+    def _to_zeep(self):
+        """
+            Construye el objeto de zeep que se envía a STP
+        :return: Objeto del tipo __type__ en el WSDL
+        """
+        values = {name: getattr(self, name) for name in self.__fieldnames__}
+        values['firma'] = self.firma
+        return _get_client(self._client).get_type(self.__type__)(**values)
 
     @property
     def _joined_fields(self):
-        return _join_fields(self, self.__fieldnames__)
+        if self._cadena is None:
+            self._cadena = self._serializer(self)
+        return self._cadena
+
+    @classmethod
+    def _join_many(cls, resources):
+        """
+            Construye en una sola pasada la cadena original de varios
+            recursos de la misma clase
+        :param resources: Recursos a serializar
+        :return: Lista de cadenas en bytes, en el mismo orden
+        """
+        serializer = cls._serializer
+        return [serializer(r) for r in resources]
 
     def _compute_signature(self):
-        signature = crypto.sign(STP_PRIVKEY, self._joined_fields, SIGN_DIGEST)
-        return b64encode(signature).decode('ascii')
+        return _get_client(self._client).signer.sign(self._joined_fields)
+
+    @classmethod
+    def _compute_signatures(cls, resources, processes=None):
+        """
+            Firma un lote de recursos en varios procesos y asigna la firma a
+            cada uno, con la llave del cliente de cada recurso
+        :param resources: Lista de recursos a firmar
+        :param processes: Número de procesos, por omisión uno por núcleo
+        :return: Lista de firmas en el mismo orden
+        """
+        por_cliente = {}
+        for resource in resources:
+            client = _get_client(resource._client)
+            por_cliente.setdefault(client, []).append(resource)
+        for client, grupo in por_cliente.items():
+            firmas = client.signer.sign_many(cls._join_many(grupo),
+                                             processes=processes)
+            for resource, firma in zip(grupo, firmas):
+                resource.firma = firma
+        return [resource.firma for resource in resources]
+
+    @staticmethod
+    def _get_verifier(resource, verifier=None):
+        if verifier is not None:
+            return verifier
+        verifier = _get_client(resource._client).verifier
+        if verifier is None:
+            raise RuntimeError('No public key configured to verify firma')
+        return verifier
+
+    def verify(self, verifier=None) -> bool:
+        """
+            Reconstruye la cadena original con __fieldnames__ y verifica
+            que `firma` le corresponda
+        :param verifier: signing.Verifier a usar, por omisión el del cliente
+            del recurso
+        :return: True si la firma es válida
+        """
+        return self._get_verifier(self, verifier).verify(self._joined_fields,
+                                                         self.firma)
+
+    @classmethod
+    def verify_many(cls, resources, verifier=None, processes=None):
+        """
+            Verifica la firma de un lote de recursos de la misma clase en
+            varios procesos
+        :param resources: Recursos a verificar
+        :param verifier: signing.Verifier a usar, por omisión el del cliente
+            del primer recurso
+        :param processes: Número de procesos, por omisión uno por núcleo
+        :return: Lista de resultados en el mismo orden
+        """
+        resources = list(resources)
+        if not resources:
+            return []
+        verifier = cls._get_verifier(resources[0], verifier)
+        pares = zip(cls._join_many(resources),
+                    (resource.firma for resource in resources))
+        return verifier.verify_many(pares, processes=processes)
 
-    def _is_valid_field(self, field):
+    def _errors(self):
         """
-            Obtiene el campo a ser evaluado y el diccionario de validaciones
-            que deban hacerse
-        :param field: Campo a evaluar
-        :return: Lista de errores encontrados en este campo
+            Aplica las validaciones compiladas de la clase
+        :return: {campo: [errores]}, vacío si no hay errores
         """
-        # Validaciones que aplican en este campo
-        vals = self.__validations__[field]
-        return [_validate(field, getattr(self, field), r, vals[r])
-                for r in vals]
+        return errors_by_field(self, self._checkers)
 
     def _is_valid(self):
         """
-            Por todos los campos a ser validados, ejecuta la función
-            _is_valid_field y devuelve todos los errores
+            Por todos los campos a ser validados, ejecuta las validaciones
+            compiladas y devuelve todos los errores
         :return: None si no hay errores, de otra forma lanza una
             excepción con la lista de errores
         """
-        errors = list(filter((lambda x: x is not None),
-                             [error for errors in
-                              map((lambda r: self._is_valid_field(r)),
-                                  self.__validations__)
-                              for error in errors]))
-        if len(errors) > 0:
-            raise ValueError(",".join(errors))
+        errors = self._errors()
+        if errors:
+            raise ValueError(",".join(error for field_errors in
+                                      errors.values()
+                                      for error in field_errors))
         return None
 
+    @classmethod
+    def validate_many(cls, resources):
+        """
+            Valida un lote de recursos en una sola pasada, sin enviar nada
+        :param resources: Recursos a validar
+        :return: {posición en el lote: {campo: [errores]}} sólo con los
+            recursos inválidos
+        """
+        return validate_many(resources, cls._checkers)
+
+    def _build_envelope(self, service, method):
+        """
+            Construye el envelope SOAP de la operación, igual que lo haría
+            zeep al llamar al servicio
+        :return: (envelope, headers HTTP)
+        """
+        return service._binding._create(
+            method, (self._to_zeep(),), {}, client=service._client,
+            options=service._binding_options)
+
+    def _send(self, method):
+        """
+            Envía el recurso ya firmado con la política de reintentos y el
+            circuit breaker del cliente. Cada intento reenvía exactamente
+            los mismos datos y la misma firma.
+        """
+        client = _get_client(self._client)
+        if client.retry_policy is None and client.breaker is None:
+            return self._invoke_method(method)
+        return retry.call(partial(self._invoke_method, method),
+                          client.retry_policy, client.breaker)
+
+    async def _send_async(self, method):
+        client = _get_client(self._client)
+        if client.retry_policy is None and client.breaker is None:
+            return await self._invoke_method_async(method)
+        return await retry.call_async(
+            partial(self._invoke_method_async, method), client.retry_policy,
+            client.breaker)
+
     def _invoke_method(self, method):
-        res = ACTUALIZA_CLIENT.service[method](self.__object__)
+        """
+            Envía el recurso en tres fases medidas por separado: construir
+            el envelope, la petición HTTP y la lectura de la respuesta. Con
+            `fast_envelope` el envelope sale de un template precompilado.
+        """
+        client = _get_client(self._client)
+        service = client.service
+        binding = service._binding
+        transport = service._client.transport
+        template = None
+        if self._fast_envelope:
+            template = client.get_template(service, method)
+        capture = _get_capture(client)
+        start = time.perf_counter()
+        envelope = response = None
+        try:
+            if template is not None:
+                envelope = measure('build', self, template.render, self)
+                self._reservada = False
+                response = measure('post', self, transport.post,
+                                   template.address, envelope,
+                                   dict(template.headers))
+                res = measure('parse', self, template.parse, response)
+            else:
+                envelope, headers = measure('build', self,
+                                            self._build_envelope, service,
+                                            method)
+                self._reservada = False
+                response = measure('post', self, transport.post_xml,
+                                   service._binding_options['address'],
+                                   envelope, headers)
+                res = measure('parse', self, binding.process_reply,
+                              service._client, binding.get(method), response)
+        except Exception as exc:
+            if capture is not None:
+                capture.record(method, self, envelope, response, None, exc,
+                               time.perf_counter() - start, DEBUG_MODE)
+            raise
+        if capture is not None:
+            capture.record(method, self, envelope, response, res, None,
+                           time.perf_counter() - start, DEBUG_MODE)
+        return res
+
+    async def _invoke_method_async(self, method):
+        client = _get_client(self._client)
+        service = client.get_async_service()
+        binding = service._binding
+        transport = service._client.transport
+        template = None
+        if self._fast_envelope:
+            template = client.get_template(service, method)
+        capture = _get_capture(client)
+        start = time.perf_counter()
+        envelope = response = None
+        try:
+            if template is not None:
+                envelope = measure('build', self, template.render, self)
+                call = transport.post(template.address, envelope,
+                                      dict(template.headers))
+            else:
+                envelope, headers = measure('build', self,
+                                            self._build_envelope, service,
+                                            method)
+                call = transport.post_xml(
+                    service._binding_options['address'], envelope, headers)
+            if client.deadline is not None:
+                call = asyncio.wait_for(call, client.deadline)
+            self._reservada = False
+            response = await measure_async('post', self, call)
+            if template is not None:
+                res = measure('parse', self, template.parse, response)
+            else:
+                res = measure('parse', self, binding.process_reply,
+                              service._client, binding.get(method), response)
+        except Exception as exc:
+            if capture is not None:
+                capture.record(method, self, envelope, response, None, exc,
+                               time.perf_counter() - start, DEBUG_MODE)
+            raise
+        if capture is not None:
+            capture.record(method, self, envelope, response, res, None,
+                           time.perf_counter() - start, DEBUG_MODE)
         return res
@@ -0,0 +1,342 @@
+"""
+Envío de órdenes desde archivos CSV o JSON Lines. Las filas se leen como
+flujo, se registran de forma concurrente y cada resultado se escribe en
+cuanto está listo, por lo que el uso de memoria no depende del tamaño del
+archivo.
+"""
+import csv
+import json
+import os
+from collections import deque
+from itertools import islice
+from typing import Iterator, Optional
+
+from .ordenes import DEFAULT_MAX_WORKERS, Orden, registra_ordenes
+from .retry import respuesta_reenvio
+
+RESULT_FIELDS = ['fila', 'claveRastreo', 'id', 'descripcionError', 'error',
+                 'duplicada']
+JSONL_EXTENSIONS = ('.jsonl', '.ndjson')
+
+
+class _FilaInvalida:
+    """
+        Ocupa el lugar de una fila que no se pudo convertir en Orden para que
+        su error quede en el archivo de resultados en la posición correcta
+    """
+    claveRastreo = None
+
+    def __init__(self, error: Exception):
+        self.error = error
+
+    def registra(self):
+        raise self.error
+
+
+def _formato(path: str, formato: Optional[str]) -> str:
+    if formato:
+        return formato
+    return 'jsonl' if path.endswith(JSONL_EXTENSIONS) else 'csv'
+
+
+def lee_filas(path: str, formato: str = None) -> Iterator[dict]:
+    """
+        Lee el archivo fila por fila
+    :param path: Ruta del archivo CSV o JSON Lines
+    :param formato: 'csv' o 'jsonl', por omisión según la extensión
+    :return: Generador de diccionarios con los campos de cada orden
+    """
+    if _formato(path, formato) == 'jsonl':
+        with open(path) as fp:
+            for line in fp:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        with open(path, newline='') as fp:
+            yield from csv.DictReader(fp)
+
+
+def orden_de_fila(fila: dict):
+    """
+        Crea la Orden de una fila de archivo o de cola
+    :param fila: Campos de la orden; los vacíos toman el valor por omisión
+    :return: Orden, o un sustituto cuyo `registra()` lanza el error si la
+        fila no es una orden válida, para que el error quede en su resultado
+    """
+    try:
+        # Las columnas vacías toman el valor por omisión de la orden
+        return Orden(**{k: v for k, v in fila.items() if v not in ('', None)})
+    except Exception as exc:
+        return _FilaInvalida(exc)
+
+
+class _Filas:
+    """
+        Conjunto compacto de números de fila, un bit por fila, para no
+        guardar en memoria los resultados previos
+    """
+    def __init__(self):
+        self._bits = bytearray()
+        self._total = 0
+
+    def add(self, fila: int):
+        byte, bit = divmod(fila, 8)
+        if byte >= len(self._bits):
+            self._bits.extend(bytes(byte + 1 - len(self._bits)))
+        if not self._bits[byte] >> bit & 1:
+            self._bits[byte] |= 1 << bit
+            self._total += 1
+
+    def __contains__(self, fila: int) -> bool:
+        byte, bit = divmod(fila, 8)
+        return byte < len(self._bits) and bool(self._bits[byte] >> bit & 1)
+
+    def __len__(self) -> int:
+        return self._total
+
+
+def _filas_hechas(path: str, formato: str):
+    """
+        Filas que ya tienen resultado y posición en bytes donde termina la
+        última completa. Lo que sigue es una fila que quedó a medias por una
+        interrupción. En CSV también devuelve las columnas del encabezado,
+        que pueden ser las de una versión anterior
+    :return: (_Filas, posición, columnas)
+    """
+    hechas = _Filas()
+    fin = 0
+    if not os.path.exists(path):
+        return hechas, fin, RESULT_FIELDS
+    with open(path, 'rb') as fp:
+        leido = [0, b'']
+
+        def lineas():
+            for line in fp:
+                leido[0] += len(line)
+                leido[1] = line
+                yield line.decode('utf-8', 'replace')
+
+        if formato == 'jsonl':
+            for line in lineas():
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith('\n') or not isinstance(row, dict) or \
+                        not isinstance(row.get('fila'), int):
+                    break
+                hechas.add(row['fila'])
+                fin = leido[0]
+        else:
+            reader = csv.reader(lineas())
+            fields = next(reader, None)
+            if not fields or 'fila' not in fields or \
+                    not leido[1].endswith(b'\n'):
+                return hechas, fin, RESULT_FIELDS
+            fin = leido[0]
+            columna = fields.index('fila')
+            for row in reader:
+                # A una fila cortada le faltan columnas o el salto de línea
+                if not leido[1].endswith(b'\n') or \
+                        len(row) != len(fields) or \
+                        not row[columna].isdigit():
+                    break
+                hechas.add(int(row[columna]))
+                fin = leido[0]
+            return hechas, fin, fields
+    return hechas, fin, None
+
+
+def _descarta_linea_cortada(path: str):
+    """
+        Quita del final del archivo una línea sin salto de línea, que quedó
+        a medias. Sólo se lee el final del archivo
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb+') as fp:
+        pos = fp.seek(0, os.SEEK_END)
+        if pos == 0:
+            return
+        fp.seek(pos - 1)
+        if fp.read(1) == b'\n':
+            return
+        while pos > 0:
+            paso = min(pos, 4096)
+            fp.seek(pos - paso)
+            corte = fp.read(paso).rfind(b'\n')
+            if corte >= 0:
+                fp.truncate(pos - paso + corte + 1)
+                return
+            pos -= paso
+        fp.truncate(0)
+
+
+class _ClavesPrevias:
+    """
+        claveRastreo y referenciaNumerica asignadas a cada fila en una
+        ejecución anterior. El checkpoint está en orden de fila, igual que
+        la entrada, así que se lee a la par de ella con un solo registro en
+        memoria; `get` se llama con filas en orden creciente
+    """
+    def __init__(self, path: Optional[str]):
+        self._fp = None
+        self._record = None
+        # Lo que se agregue al checkpoint durante esta ejecución no se lee
+        self._restante = 0
+        if path is not None and os.path.exists(path):
+            self._restante = os.path.getsize(path)
+            self._fp = open(path, 'rb')
+
+    def get(self, fila: int) -> Optional[dict]:
+        while self._record is None or self._record['fila'] < fila:
+            self._record = self._siguiente()
+            if self._record is None:
+                return None
+        if self._record['fila'] != fila:
+            return None
+        return {k: v for k, v in self._record.items() if k != 'fila'}
+
+    def _siguiente(self) -> Optional[dict]:
+        while self._restante > 0:
+            line = self._fp.readline()
+            if not line:
+                break
+            self._restante -= len(line)
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and \
+                    isinstance(record.get('fila'), int):
+                return record
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self._fp is not None:
+            self._fp.close()
+
+
+def _abre_resultados(path: str, formato: str, fin: int, fields: list):
+    """
+        Abre el archivo de resultados para agregar filas después de la
+        última completa, en `fin`, con las columnas que ya tiene. Con `fin`
+        en 0 se empieza de nuevo
+    """
+    if fin:
+        os.truncate(path, fin)
+        out = open(path, 'a', newline='')
+        return out, _writer(out, formato, fields=fields)
+    out = open(path, 'w', newline='')
+    return out, _writer(out, formato, header=True)
+
+
+class _JsonLinesWriter:
+    def __init__(self, out):
+        self.out = out
+
+    def writerow(self, row: dict):
+        self.out.write(json.dumps(row) + '\n')
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+
+def _writer(out, formato: str, header: bool = False, fields: list = None):
+    if formato == 'jsonl':
+        return _JsonLinesWriter(out)
+    writer = csv.DictWriter(out, fields or RESULT_FIELDS,
+                            extrasaction='ignore')
+    if header:
+        writer.writeheader()
+    return writer
+
+
+def procesa_archivo(path: str, results_path: str = None,
+                    max_workers: int = DEFAULT_MAX_WORKERS,
+                    formato: str = None, resume: bool = True) -> dict:
+    """
+        Registra todas las órdenes de un archivo y escribe un resultado por
+        cada fila de entrada. Antes de enviar cada grupo de filas se guardan
+        en `<results_path>.claves` la claveRastreo y referenciaNumerica que
+        se les asignaron. Si la ejecución se interrumpe, al volver a correrla
+        se omiten las filas que ya tienen resultado y las que se enviaron
+        sin resultado se reenvían con las mismas claves: si STP ya las
+        tenía, su resultado queda con `duplicada`.
+    :param path: Archivo de entrada CSV o JSON Lines
+    :param results_path: Archivo de resultados, por omisión
+        `<path>.resultados.<ext>`
+    :param max_workers: Número máximo de peticiones simultáneas a STP
+    :param formato: 'csv' o 'jsonl', por omisión según la extensión
+    :param resume: Continúa desde la ejecución anterior
+    :return: Resumen con el total de filas registradas, con error y omitidas
+    """
+    formato = _formato(path, formato)
+    if results_path is None:
+        root, ext = os.path.splitext(path)
+        results_path = f'{root}.resultados{ext or "." + formato}'
+    claves_path = f'{results_path}.claves'
+
+    if resume:
+        hechas, fin, fields = _filas_hechas(results_path, formato)
+        _descarta_linea_cortada(claves_path)
+    else:
+        hechas, fin, fields = _Filas(), 0, None
+    resumen = dict(registradas=0, errores=0, omitidas=len(hechas))
+
+    numeradas = enumerate(lee_filas(path, formato), start=1)
+    filas = ((n, fila) for n, fila in numeradas if n not in hechas)
+    pendientes = deque()
+    claves = _ClavesPrevias(claves_path if resume else None)
+    out, writer = _abre_resultados(results_path, formato, fin, fields)
+    checkpoint = open(claves_path, 'a' if resume else 'w')
+    with out, checkpoint, claves:
+        def _ordenes():
+            while True:
+                grupo = list(islice(filas, max_workers))
+                if not grupo:
+                    return
+                items = []
+                nuevas = []
+                for n, fila in grupo:
+                    previa = claves.get(n)
+                    orden = orden_de_fila(
+                        dict(fila, **previa) if previa else fila)
+                    items.append((n, orden, previa is not None))
+                    if previa is None and orden.claveRastreo is not None:
+                        nuevas.append(dict(
+                            fila=n, claveRastreo=orden.claveRastreo,
+                            referenciaNumerica=orden.referenciaNumerica))
+                # Las claves quedan en disco antes de que salga el grupo
+                if nuevas:
+                    checkpoint.write(''.join(json.dumps(record) + '\n'
+                                             for record in nuevas))
+                    checkpoint.flush()
+                    os.fsync(checkpoint.fileno())
+                pendientes.extend(items)
+                for _, orden, _ in items:
+                    yield orden
+
+        for resultado in registra_ordenes(_ordenes(), max_workers):
+            fila, orden, reenvio = pendientes.popleft()
+            if reenvio:
+                resultado = respuesta_reenvio(resultado)
+            error = resultado.error
+            row = dict(fila=fila, claveRastreo=orden.claveRastreo,
+                       id=resultado.id,
+                       descripcionError=resultado.descripcionError,
+                       error=repr(error) if error is not None else None,
+                       duplicada=getattr(resultado, 'duplicada', None))
+            if error is None and resultado.descripcionError is None:
+                resumen['registradas'] += 1
+            else:
+                resumen['errores'] += 1
+            writer.writerow(row)
+            out.flush()
+    # Todas las filas tienen resultado
+    os.remove(claves_path)
+    return resumen
@@ -0,0 +1,181 @@
+"""
+Captura de las peticiones y respuestas SOAP con STP para depurar órdenes
+rechazadas. Se guardan en un buffer circular de tamaño fijo, así que la
+memoria no crece aunque se deje activa en producción: las llamadas con error
+(excepción, HTTP distinto de 200 o descripcionError de STP) se guardan
+siempre y las exitosas sólo en la proporción `sample_rate`. Una llamada que
+no se guarda cuesta una comparación y, con muestreo, un número aleatorio.
+
+La firma y las cuentas se ocultan antes de guardar el XML:
+
+    captura = Capture(size=500, sample_rate=0.01)
+    cliente = StpClient(..., capture=captura)
+    ...
+    captura.export('/tmp/stpmex-captura.jsonl')
+
+Con `base.DEBUG_MODE = True` se guardan todas las llamadas.
+"""
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from typing import List, NamedTuple, Optional, Sequence
+
+DEFAULT_SIZE = 1000
+REDACTED_FIELDS = ('firma',)
+MASKED_FIELDS = ('cuentaOrdenante', 'cuentaBeneficiario',
+                 'cuentaBeneficiario2')
+REDACTED = '[REDACTED]'
+# Dígitos de la cuenta que quedan visibles
+VISIBLE_DIGITS = 4
+
+
+class Exchange(NamedTuple):
+    timestamp: float
+    operation: str
+    claveRastreo: Optional[str]
+    seconds: float
+    request: Optional[str]
+    status: Optional[int]
+    response: Optional[str]
+    error: Optional[str]
+
+
+def _mask(value: str) -> str:
+    visible = value[-VISIBLE_DIGITS:] if len(value) > VISIBLE_DIGITS else ''
+    return '*' * (len(value) - len(visible)) + visible
+
+
+def _redactor(redact: Sequence[str], mask: Sequence[str]):
+    """
+        Función que oculta en un XML el contenido de los elementos
+        `redact` y enmascara el de `mask`, con o sin prefijo de namespace
+    """
+    fields = tuple(redact) + tuple(mask)
+    if not fields:
+        return lambda text: text
+    pattern = re.compile(
+        r'(<(?:[\w.-]+:)?(' + '|'.join(map(re.escape, fields)) +
+        r')(?:\s[^>]*)?>)([^<]*)(</)')
+    masked = frozenset(mask)
+
+    def sub(match):
+        value = match.group(3)
+        value = _mask(value) if match.group(2) in masked else REDACTED
+        return match.group(1) + value + match.group(4)
+
+    return lambda text: pattern.sub(sub, text)
+
+
+def _text(content) -> Optional[str]:
+    if content is None:
+        return None
+    if not isinstance(content, (bytes, str)):
+        # Envelope de zeep como elemento de lxml
+        from zeep.wsdl.utils import etree_to_string
+        content = etree_to_string(content)
+    if isinstance(content, bytes):
+        content = content.decode('utf-8', 'replace')
+    return content
+
+
+class Capture:
+    """
+        Buffer circular con las últimas llamadas a STP
+    :param size: Llamadas que se conservan; al llenarse se descartan las
+        más antiguas
+    :param sample_rate: Proporción de llamadas exitosas que se guardan,
+        entre 0 y 1
+    :param errors: Guarda siempre las llamadas con error
+    :param redact: Elementos del XML cuyo contenido se oculta
+    :param mask: Elementos del XML de los que sólo quedan visibles los
+        últimos dígitos
+    """
+    def __init__(self, size: int = DEFAULT_SIZE, sample_rate: float = 0.0,
+                 errors: bool = True,
+                 redact: Sequence[str] = REDACTED_FIELDS,
+                 mask: Sequence[str] = MASKED_FIELDS):
+        if size < 1:
+            raise ValueError('size must be greater than 0')
+        if not 0 <= sample_rate <= 1:
+            raise ValueError('sample_rate must be between 0 and 1')
+        self.size = size
+        self.sample_rate = sample_rate
+        self.errors = errors
+        self.captured = 0
+        self._redact = _redactor(redact, mask)
+        self._random = random.Random()
+        self._buffer = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def _keep(self, failed: bool, force: bool) -> bool:
+        if force or (failed and self.errors):
+            return True
+        return bool(self.sample_rate) and \
+            self._random.random() < self.sample_rate
+
+    def record(self, operation: str, resource, request, response, result,
+               error: Optional[Exception], seconds: float,
+               force: bool = False):
+        """
+            Se llama al terminar cada llamada a STP. Sólo si se va a guardar
+            se convierte y oculta el XML
+        :param request: Envelope enviado, en bytes o como elemento de zeep
+        :param response: Respuesta HTTP de requests o httpx, o None
+        :param result: Respuesta ya procesada
+        :param force: Guarda la llamada sin importar el muestreo
+        """
+        status = getattr(response, 'status_code', None)
+        failed = error is not None or (status is not None and status != 200) \
+            or bool(getattr(result, 'descripcionError', None))
+        if not self._keep(failed, force):
+            return
+        content = getattr(response, 'content', None)
+        exchange = Exchange(
+            time.time(), operation, getattr(resource, 'claveRastreo', None),
+            seconds, self._redact_text(request), status,
+            self._redact_text(content),
+            None if error is None else f'{type(error).__name__}: {error}')
+        with self._lock:
+            self._buffer.append(exchange)
+            self.captured += 1
+
+    def _redact_text(self, content) -> Optional[str]:
+        text = _text(content)
+        return None if text is None else self._redact(text)
+
+    def exchanges(self) -> List[Exchange]:
+        """
+            Llamadas guardadas, de la más antigua a la más reciente
+        """
+        with self._lock:
+            return list(self._buffer)
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def clear(self):
+        with self._lock:
+            self._buffer.clear()
+
+    def export(self, path: str, clear: bool = False) -> int:
+        """
+            Escribe las llamadas guardadas en un archivo JSON Lines. El
+            archivo se reemplaza completo, nunca queda a medias
+        :param clear: Vacía el buffer después de exportar
+        :return: Número de llamadas escritas
+        """
+        with self._lock:
+            exchanges = list(self._buffer)
+            if clear:
+                self._buffer.clear()
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as fp:
+            for exchange in exchanges:
+                fp.write(json.dumps(exchange._asdict(), ensure_ascii=False))
+                fp.write('\n')
+        os.replace(tmp, path)
+        return len(exchanges)
@@ -0,0 +1,296 @@
+"""
+Cliente de STP para una empresa. Cada StpClient tiene su propia llave,
+cliente de zeep y pool de conexiones, así que un mismo proceso puede enviar
+órdenes de varias empresas al mismo tiempo:
+
+    cliente = StpClient('EMPRESA', priv_key, passphrase, prefijo)
+    orden = cliente.orden(monto=1.2, ...)
+    cliente.registra(orden)
+
+`stpmex.configure()` crea el cliente por omisión, que es el que usan las
+órdenes que no están ligadas a ningún cliente.
+"""
+import asyncio
+import threading
+from typing import Iterable
+
+from zeep import Client
+from zeep.cache import SqliteCache
+
+from .capture import Capture
+from .defaults import (BUNDLED_WSDL, DEFAULT_CACHE_SIZE, DEFAULT_CACHE_TTL,
+                       DEFAULT_MAX_WORKERS, DEFAULT_POOL_SIZE, DEFAULT_WSDL)
+from .envelope import EnvelopeTemplate
+from .generators import ClaveRastreoIndex
+from .journal import Journal
+from .ordenes import Orden, registra_ordenes
+from .retry import DEFAULT_RESET_TIMEOUT, CircuitBreaker, RetryPolicy
+from .signing import Signer, Verifier
+from .transport import StpTransport, build_session
+
+
+class StpClient:
+    """
+        Credenciales y conexión a STP de una empresa
+    :param empresa: Nombre de la empresa
+    :param priv_key: Contenido de la llave privada
+    :param priv_key_passphrase: Password de la llave privada
+    :param prefijo: Prefijo en STP
+    :param wsdl_path: URL del WSDL a utilizar, o BUNDLED_WSDL para usar el
+        WSDL incluido en el paquete sin descargar nada
+    :param proxy: Si es necesario, se puede especificar un proxy
+    :param proxy_user: Usuario del proxy
+    :param proxy_password: Contraseña del proxy
+    :param endpoint: URL del servicio, si es distinta a la declarada en el
+        WSDL (por ejemplo producción usando BUNDLED_WSDL)
+    :param wsdl_cache: Guarda en disco el WSDL y sus esquemas descargados
+    :param cache_path: Archivo sqlite para la caché del WSDL. Por omisión se
+        usa el directorio de caché del usuario
+    :param cache_ttl: Segundos que es válida la caché del WSDL
+    :param pool_size: Conexiones HTTP que se mantienen abiertas por host
+    :param keep_alive: Reutiliza las conexiones TLS entre peticiones
+    :param connect_timeout: Segundos máximos para establecer la conexión
+    :param read_timeout: Segundos máximos de espera entre datos recibidos
+    :param deadline: Segundos máximos en total por cada llamada a STP
+    :param signature_cache_size: Firmas que se guardan por cadena original
+        para no volver a firmar los reintentos. 0 la desactiva
+    :param clave_rastreo_index: Índice que rechaza antes de enviarla una
+        orden con una claveRastreo ya usada
+    :param fast_envelope: Arma el envelope de registraOrden con un template
+        precompilado y lee sólo `id` y `descripcionError` de la respuesta,
+        en lugar de pasar todo por el esquema de zeep
+    :param public_key: Certificado o llave pública PEM con el que se
+        verifican las firmas, ver `Resource.verify`
+    :param retry_policy: RetryPolicy con la que se reenvían las órdenes que
+        fallan por errores de red o del servidor. Por omisión no se reintenta
+    :param breaker_threshold: Fallas seguidas tras las que se deja de enviar
+        al endpoint durante `breaker_reset_timeout` segundos. Por omisión no
+        hay circuit breaker
+    :param breaker_reset_timeout: Segundos que el circuito permanece abierto
+    :param journal: journal.Journal donde se anota cada orden firmada antes
+        de enviarla y su resultado, para reenviar con `journal.replay()`
+        las que queden sin resultado si el proceso se cae
+    :param capture: capture.Capture donde se guardan las peticiones y
+        respuestas SOAP para depurar órdenes rechazadas
+    """
+    def __init__(self, empresa: str, priv_key: str,
+                 priv_key_passphrase: str, prefijo: int,
+                 wsdl_path: str = DEFAULT_WSDL, proxy: str = None,
+                 proxy_user: str = None, proxy_password: str = None,
+                 endpoint: str = None, wsdl_cache: bool = True,
+                 cache_path: str = None, cache_ttl: int = DEFAULT_CACHE_TTL,
+                 pool_size: int = DEFAULT_POOL_SIZE, keep_alive: bool = True,
+                 connect_timeout: float = None, read_timeout: float = None,
+                 deadline: float = None,
+                 signature_cache_size: int = DEFAULT_CACHE_SIZE,
+                 clave_rastreo_index: ClaveRastreoIndex = None,
+                 fast_envelope: bool = False, public_key: str = None,
+                 retry_policy: RetryPolicy = None,
+                 breaker_threshold: int = None,
+                 breaker_reset_timeout: float = DEFAULT_RESET_TIMEOUT,
+                 journal: Journal = None, capture: Capture = None):
+        self.empresa = empresa
+        self.prefijo = prefijo
+        self.signer = Signer(priv_key, priv_key_passphrase,
+                             cache_size=signature_cache_size)
+        self.wsdl_path = wsdl_path
+        self.endpoint = endpoint
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.deadline = deadline
+        self.clave_rastreo_index = clave_rastreo_index
+        self.fast_envelope = fast_envelope
+        self.journal = journal
+        self.capture = capture
+        self.verifier = Verifier(public_key) if public_key else None
+        self.zeep_types = {}
+        self._templates = {}
+        self._async_service = None
+        self._async_http = None
+        self._closing = None
+        self._lock = threading.Lock()
+
+        proxies = None
+        self.proxy_url = None
+        if proxy is not None:
+            proxies = {
+                'https': f"https://{proxy_user}:{proxy_password}@{proxy}",
+                'http':  f"http://{proxy_user}:{proxy_password}@{proxy}"
+            }
+            self.proxy_url = proxies['https']
+        self.session = build_session(pool_size, keep_alive, proxies)
+
+        cache = None
+        if wsdl_cache:
+            cache = SqliteCache(path=cache_path, timeout=cache_ttl)
+        transport = StpTransport(self.session,
+                                 connect_timeout=connect_timeout,
+                                 read_timeout=read_timeout,
+                                 deadline=deadline, cache=cache)
+        self.client = Client(wsdl_path, transport=transport)
+        self.service = self._bind_service(self.client)
+        self.retry_policy = retry_policy
+        self.breaker = None
+        if breaker_threshold is not None:
+            self.breaker = CircuitBreaker(
+                self.service._binding_options['address'],
+                failure_threshold=breaker_threshold,
+                reset_timeout=breaker_reset_timeout)
+
+    def _bind_service(self, client):
+        """
+            Devuelve el servicio por omisión del cliente, apuntando a
+            `endpoint` si se configuró uno distinto al declarado en el WSDL
+        :param client: zeep.Client o zeep.AsyncClient
+        :return: ServiceProxy
+        """
+        if self.endpoint is None:
+            return client.service
+        binding = next(iter(client.wsdl.bindings))
+        return client.create_service(binding, self.endpoint)
+
+    def get_type(self, name: str):
+        """
+            Obtiene el tipo de zeep del WSDL. Se resuelve una sola vez por
+            tipo
+        :param name: Nombre calificado del tipo, por ejemplo 'ns0:ordenPagoWS'
+        :return: Clase del tipo en zeep
+        """
+        try:
+            return self.zeep_types[name]
+        except KeyError:
+            zeep_type = self.client.get_type(name)
+            self.zeep_types[name] = zeep_type
+            return zeep_type
+
+    def get_template(self, service, method: str):
+        """
+            Template precompilado de la operación para el servicio dado, si
+            `fast_envelope` está activo y la operación lo permite. El
+            template sólo depende del binding del WSDL y de la dirección,
+            así que los servicios síncrono y asíncrono comparten el mismo
+        :return: EnvelopeTemplate o None para enviar con zeep
+        """
+        if not self.fast_envelope:
+            return None
+        key = (service._binding.name, service._binding_options['address'],
+               method)
+        try:
+            return self._templates[key]
+        except KeyError:
+            template = EnvelopeTemplate.build(service, method)
+            self._templates[key] = template
+            return template
+
+    def get_async_service(self):
+        """
+            Construye, la primera vez que se necesita, el cliente asíncrono de
+            zeep. Reutiliza el WSDL ya procesado por el cliente síncrono y un
+            pool de conexiones httpx compartido por todas las peticiones.
+        :return: ServiceProxy del zeep.AsyncClient
+        """
+        with self._lock:
+            if self._async_service is None:
+                import httpx
+                from zeep import AsyncClient
+                from zeep.transports import AsyncTransport
+                limits = httpx.Limits(
+                    max_connections=self.pool_size,
+                    max_keepalive_connections=(
+                        self.pool_size if self.keep_alive else 0))
+                timeout = httpx.Timeout(None, connect=self.connect_timeout,
+                                        read=self.read_timeout)
+                self._async_http = httpx.AsyncClient(
+                    limits=limits, timeout=timeout, proxy=self.proxy_url)
+                transport = AsyncTransport(client=self._async_http)
+                self._async_service = self._bind_service(
+                    AsyncClient(self.client.wsdl, transport=transport))
+            return self._async_service
+
+    def bind(self, resource):
+        """
+            Liga un recurso a este cliente: toma su empresa, se firma con su
+            llave y se envía con su conexión
+        :return: El mismo recurso
+        """
+        resource._client = self
+        resource.empresa = self.empresa
+        return resource
+
+    def orden(self, **kwargs) -> Orden:
+        """
+            Crea una orden de esta empresa ligada a este cliente
+        """
+        return self.bind(Orden(**kwargs))
+
+    def registra(self, orden: Orden):
+        """
+            Registra una orden con este cliente
+        :return: Respuesta de STP
+        """
+        return self.bind(orden).registra()
+
+    async def registra_async(self, orden: Orden):
+        return await self.bind(orden).registra_async()
+
+    def registra_many(self, ordenes: Iterable[Orden],
+                      max_workers: int = DEFAULT_MAX_WORKERS):
+        """
+            Registra un lote de órdenes de forma concurrente con este
+            cliente
+        :return: Lista de Resultado en el mismo orden que `ordenes`
+        """
+        return list(registra_ordenes((self.bind(orden) for orden in ordenes),
+                                     max_workers))
+
+    def firma_many(self, ordenes: Iterable[Orden], processes: int = None):
+        """
+            Firma un lote de órdenes con la llave de este cliente usando
+            todos los núcleos
+        :return: Lista de firmas en el mismo orden que `ordenes`
+        """
+        ordenes = [self.bind(orden) for orden in ordenes]
+        return Orden._compute_signatures(ordenes, processes=processes)
+
+    def _take_async_http(self):
+        with self._lock:
+            http, self._async_http = self._async_http, None
+            self._async_service = None
+            return http
+
+    def close(self):
+        """
+            Termina los procesos de firma y cierra las conexiones HTTP. Desde
+            código asíncrono es mejor `await client.aclose()`: aquí el pool
+            de httpx sólo se puede programar para cerrarse en el loop actual
+        """
+        self.signer.close()
+        if self.verifier is not None:
+            self.verifier.close()
+        self.session.close()
+        http = self._take_async_http()
+        if http is None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            try:
+                asyncio.run(http.aclose())
+            except RuntimeError:
+                # Conexiones abiertas en un loop que ya terminó: el pool
+                # queda cerrado y sus sockets se liberan con el loop
+                pass
+        else:
+            self._closing = loop.create_task(http.aclose())
+
+    async def aclose(self):
+        """
+            Cierra el pool de conexiones del cliente asíncrono y todo lo que
+            cierra `close()`
+        """
+        http = self._take_async_http()
+        if http is not None:
+            await http.aclose()
+        self.close()
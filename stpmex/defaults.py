@@ -0,0 +1,18 @@
+"""
+Valores por omisión de la configuración. Este módulo no importa ninguna
+dependencia, así que `import stpmex` no carga zeep, requests ni cryptography
+hasta que se crea un cliente o se envía una orden.
+"""
+import os
+
+DEFAULT_WSDL = ('https://demo.stpmex.com:7024/speidemo/webservices/SpeiActual'
+                'izaServices?wsdl')
+BUNDLED_WSDL = os.path.join(os.path.dirname(__file__), 'wsdl',
+                            'SpeiActualizaServices.wsdl')
+DEFAULT_CACHE_TTL = 24 * 60 * 60
+# Conexiones HTTP por host
+DEFAULT_POOL_SIZE = 10
+# Firmas guardadas por cadena original
+DEFAULT_CACHE_SIZE = 10_000
+# Peticiones simultáneas al registrar un lote
+DEFAULT_MAX_WORKERS = 10
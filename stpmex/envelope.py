@@ -0,0 +1,149 @@
+"""
+Camino rápido para operaciones con un solo parámetro plano, como
+registraOrden. En lugar de recorrer el esquema y construir un árbol de lxml
+en cada llamada, el envelope se arma con un template precompilado a partir
+del mismo WSDL, y de la respuesta sólo se leen `id` y `descripcionError`.
+
+El template se valida contra zeep al construirlo: si el esquema tiene algo
+que el template no reproduce byte por byte (elementos requeridos, con
+namespace o tipos complejos), la operación se sigue enviando con zeep.
+"""
+import re
+from types import SimpleNamespace
+from typing import NamedTuple, Optional
+
+from lxml import etree
+from zeep.wsdl.utils import etree_to_string
+from zeep.xsd.types.builtins import BuiltinType
+
+# Operaciones que pueden usar el template
+OPERATIONS = ('registraOrden',)
+MARK = 'STPMEX-TEMPLATE-MARK'
+# Caracteres que lxml no acepta en XML; esas órdenes se envían con zeep para
+# conservar su mismo error
+INVALID_XML = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+
+class Respuesta(NamedTuple):
+    id: Optional[int]
+    descripcionError: Optional[str]
+
+
+def _escape(text: str) -> str:
+    # El mismo escape que aplica lxml al texto de un elemento
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    if '\r' in text:
+        text = text.replace('\r', '&#13;')
+    return text
+
+
+class EnvelopeTemplate:
+    """
+        Envelope precompilado de una operación
+    :param service: ServiceProxy de zeep con el que se enviaría la operación
+    :param method: Nombre de la operación
+    """
+    def __init__(self, service, method: str):
+        self.service = service
+        self.method = method
+        self.client = service._client
+        self.binding = service._binding
+        self.operation = self.binding.get(method)
+        self.address = service._binding_options['address']
+        (_, self.element), = self.operation.input.body.type.elements
+        self.fields = []
+        for name, element in self.element.type.elements:
+            if element.qname.namespace or not element.is_optional or \
+                    element.accepts_multiple or \
+                    not isinstance(element.type, BuiltinType):
+                raise ValueError(f'{method}.{name} is not supported')
+            self.fields.append((name, f'<{name}>', f'</{name}>',
+                                element.type.xmlvalue))
+        envelope, self.headers = self._zeep_envelope(firma=MARK)
+        marker = f'<firma>{MARK}</firma>'.encode('utf-8')
+        if envelope.count(marker) != 1:
+            raise ValueError(f'Unexpected envelope for {method}')
+        prefix, suffix = envelope.split(marker)
+        self.prefix = prefix.decode('utf-8')
+        self.suffix = suffix.decode('utf-8')
+
+    @classmethod
+    def build(cls, service, method: str) -> Optional['EnvelopeTemplate']:
+        """
+            Construye y valida el template
+        :return: EnvelopeTemplate, o None si la operación debe enviarse con
+            zeep
+        """
+        if method not in OPERATIONS:
+            return None
+        try:
+            template = cls(service, method)
+        except (ValueError, AttributeError, KeyError):
+            return None
+        # Una muestra con todos los campos debe quedar idéntica a la de zeep
+        probe = {}
+        for name, element in template.element.type.elements:
+            if str in element.type.accepted_types:
+                probe[name] = f'{name} <&>\r"ñ'
+            else:
+                probe[name] = 1
+        envelope, _ = template._zeep_envelope(**probe)
+        if template.render(SimpleNamespace(**probe)) != envelope:
+            return None
+        return template
+
+    def _zeep_envelope(self, **values):
+        value = self.element.type(**values)
+        envelope, headers = self.binding._create(
+            self.method, (value,), {}, client=self.client,
+            options=self.service._binding_options)
+        return etree_to_string(envelope), headers
+
+    def render(self, resource) -> bytes:
+        """
+            Envelope SOAP del recurso, igual al que generaría zeep
+        """
+        parts = [self.prefix]
+        for name, open_, close, xmlvalue in self.fields:
+            value = getattr(resource, name, None)
+            if value is None:
+                continue
+            text = xmlvalue(value)
+            if INVALID_XML.search(text):
+                envelope, _ = self._zeep_envelope(
+                    **{field[0]: getattr(resource, field[0], None)
+                       for field in self.fields})
+                return envelope
+            parts.append(open_)
+            parts.append(_escape(text))
+            parts.append(close)
+        parts.append(self.suffix)
+        return ''.join(parts).encode('utf-8')
+
+    def parse(self, response):
+        """
+            Lee sólo `id` y `descripcionError` de la respuesta. Los SOAP
+            Fault y cualquier respuesta inesperada se procesan con zeep.
+        """
+        if response.status_code == 200:
+            try:
+                root = etree.fromstring(response.content)
+            except etree.XMLSyntaxError:
+                root = None
+            values = {}
+            if root is not None:
+                for node in root.iter('{*}return'):
+                    for child in node:
+                        values[etree.QName(child).localname] = child.text
+                    break
+            if 'id' in values:
+                id_ = values['id']
+                return Respuesta(int(id_) if id_ is not None else None,
+                                 values.get('descripcionError'))
+        return self.binding.process_reply(self.client, self.operation,
+                                          response)
@@ -0,0 +1,187 @@
+"""
+Generadores de claveRastreo y referenciaNumerica sin colisiones, e índice en
+memoria para rechazar claves de rastreo duplicadas antes de enviarlas.
+
+Para que las claves sean únicas entre nodos, cada proceso debe tener un
+identificador de nodo distinto en la variable de entorno STP_NODE_ID (de 0 a
+999). Si no está definida se deriva del hostname y el pid. STP_NODES es el
+número de nodos desplegados: las referencias numéricas se reparten entre
+ellos, así que con menos nodos cada uno tiene más referencias.
+"""
+import itertools
+import os
+import socket
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+NODE_ID_ENV = 'STP_NODE_ID'
+NODES_ENV = 'STP_NODES'
+MAX_NODES = 1000
+CLAVE_RASTREO_MAX_LENGTH = 30
+REFERENCIA_MAX = 10 ** 7 - 1
+_SIN_CLAVE = object()
+
+
+def node_id(nodes: int = MAX_NODES) -> int:
+    """
+        Identificador de este nodo/proceso entre 0 y MAX_NODES - 1. El que
+        se deriva del hostname y el pid queda entre 0 y `nodes` - 1
+    """
+    value = os.environ.get(NODE_ID_ENV)
+    if value is not None:
+        return int(value) % MAX_NODES
+    key = f'{socket.gethostname()}-{os.getpid()}'.encode('utf-8')
+    return zlib.crc32(key) % nodes
+
+
+def node_count() -> int:
+    """
+        Número de nodos desplegados, de STP_NODES. Sin ella se supone
+        MAX_NODES, el único valor seguro si el nodo se deriva del hostname
+    """
+    value = os.environ.get(NODES_ENV)
+    if value is None:
+        return MAX_NODES
+    nodes = int(value)
+    if not 0 < nodes <= MAX_NODES:
+        raise ValueError(f'{NODES_ENV} must be between 1 and {MAX_NODES}')
+    return nodes
+
+
+class ClaveRastreoGenerator:
+    """
+        Genera claves `<prefijo><nodo><inicio><contador>`: el nodo (3
+        dígitos) y el inicio del proceso en milisegundos (13 dígitos) tienen
+        ancho fijo y el contador es monótono, así que dos claves no se repiten
+        dentro del proceso ni entre nodos, aunque se generen en el mismo
+        segundo.
+    """
+    def __init__(self, prefijo: str = 'CR', node: int = None):
+        self.prefijo = prefijo
+        self.reset(node)
+
+    def reset(self, node: int = None):
+        """
+            Reinicia el generador con otro nodo, por ejemplo en un proceso
+            hijo
+        """
+        self.node = node_id() if node is None else node % MAX_NODES
+        self.start = int(time.time() * 1000)
+        self._counter = itertools.count()
+        self._base = f'{self.prefijo}{self.node:03d}{self.start:013d}'
+        if len(self._base) >= CLAVE_RASTREO_MAX_LENGTH:
+            raise ValueError(f'Prefix {self.prefijo!r} is too long')
+
+    def __call__(self) -> str:
+        clave = f'{self._base}{next(self._counter)}'
+        if len(clave) > CLAVE_RASTREO_MAX_LENGTH:
+            raise OverflowError('claveRastreo counter exhausted')
+        return clave
+
+
+class ReferenciaNumericaGenerator:
+    """
+        Genera referencias numéricas de hasta 7 dígitos intercalando el nodo
+        con un contador monótono: `1 + contador * nodos + nodo`. No se repiten
+        dentro del proceso ni entre nodos; al agotar los 10**7 / `nodes`
+        valores de un nodo se lanza OverflowError en vez de repetirlos.
+
+        El contador no se guarda: al arrancar empieza en
+        `int(time.time()) % (10**7 / nodes)` y da la vuelta hasta ese mismo
+        punto, así que si en la ejecución anterior del mismo nodo se
+        generaron más referencias que segundos pasaron hasta el reinicio, se
+        pueden repetir referencias de esa ejecución. La unicidad de las
+        órdenes la da la claveRastreo.
+    :param node: Nodo entre 0 y `nodes - 1`; por omisión `node_id()`
+    :param nodes: Número de nodos que comparten el espacio de referencias,
+        por omisión `node_count()`
+    """
+    def __init__(self, node: int = None, nodes: int = None):
+        self.nodes = node_count() if nodes is None else nodes
+        self._span = REFERENCIA_MAX // self.nodes
+        self.reset(node)
+
+    def reset(self, node: int = None):
+        node = node_id(self.nodes) if node is None else node
+        if not 0 <= node < self.nodes:
+            # Con el módulo dos nodos distintos tendrían las mismas referencias
+            raise ValueError(f'node must be between 0 and {self.nodes - 1}')
+        self.node = node
+        # Empieza en un punto distinto en cada arranque del proceso
+        self._start = int(time.time()) % self._span
+        self._counter = itertools.count()
+
+    def __call__(self) -> int:
+        n = next(self._counter)
+        if n >= self._span:
+            raise OverflowError(
+                f'referenciaNumerica exhausted for node {self.node} of '
+                f'{self.nodes}, set {NODES_ENV} to the deployed node count')
+        return 1 + (self._start + n) % self._span * self.nodes + self.node
+
+
+clave_rastreo = ClaveRastreoGenerator()
+referencia_numerica = ReferenciaNumericaGenerator()
+
+
+def set_node_id(node: int):
+    """
+        Cambia el nodo de los generadores por omisión de Orden. Útil cuando
+        un mismo host levanta varios procesos.
+    """
+    clave_rastreo.reset(node)
+    referencia_numerica.reset(node)
+
+
+def _reset_after_fork():
+    clave_rastreo.reset()
+    referencia_numerica.reset()
+
+
+if hasattr(os, 'register_at_fork'):
+    # Un proceso hijo no debe continuar los contadores del padre
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class ClaveRastreoIndex:
+    """
+        Índice en memoria de las claves de rastreo enviadas. Rechaza una
+        clave repetida con una firma distinta; reenviar la misma orden (misma
+        clave y misma firma) sí está permitido. Una clave registrada sin firma
+        no se puede volver a registrar. Con `max_size` se descartan
+        las claves más antiguas para acotar la memoria.
+    """
+    def __init__(self, max_size: int = None):
+        self.max_size = max_size
+        self._claves = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, clave: str) -> bool:
+        return clave in self._claves
+
+    def __len__(self) -> int:
+        return len(self._claves)
+
+    def add(self, clave: str, firma: str = None) -> bool:
+        """
+            Registra una clave de rastreo antes de enviarla
+        :return: True si la clave no estaba en el índice
+        :raises ValueError: si la clave ya se usó en otra orden
+        """
+        with self._lock:
+            previa = self._claves.get(clave, _SIN_CLAVE)
+            if previa is not _SIN_CLAVE and (firma is None or previa != firma):
+                raise ValueError(f'Duplicated claveRastreo {clave}')
+            # Sin firma no se sabe si es la misma orden: se guarda un valor
+            # que no es igual a ninguna otra firma
+            self._claves[clave] = object() if firma is None else firma
+            if self.max_size is not None:
+                while len(self._claves) > self.max_size:
+                    self._claves.popitem(last=False)
+            return previa is _SIN_CLAVE
+
+    def discard(self, clave: str):
+        with self._lock:
+            self._claves.pop(clave, None)
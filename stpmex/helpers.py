@@ -1,19 +1,107 @@
+"""
+Conversión entre los códigos de banco de SPEI (los tres dígitos de la
+CLABE) y las claves de institución de STP. Las tablas se calculan una sola
+vez al importar el módulo, así que cada conversión es una búsqueda en un
+diccionario.
+"""
+from typing import Dict, Iterable, List, Optional, Union
+
 from clabe.banks import BankCode
 
 from stpmex.types import Institucion
 
 
+def _build_indexes():
+    # Se recorre __members__ para incluir los alias de cada Enum: un mismo
+    # código con dos nombres se resuelve por el nombre que sí existe en el
+    # otro catálogo
+    spei_to_stp = {}
+    stp_to_spei = {}
+    for name, bank in BankCode.__members__.items():
+        institucion = Institucion.__members__.get(name)
+        if institucion is None:
+            continue
+        spei_to_stp.setdefault(bank.value, institucion)
+        stp_to_spei.setdefault(institucion.value, bank.value)
+    return spei_to_stp, stp_to_spei
+
+
+SPEI_TO_STP: Dict[str, Institucion]
+STP_TO_SPEI: Dict[int, str]
+SPEI_TO_STP, STP_TO_SPEI = _build_indexes()
+_CONTRAPARTES = {spei: institucion.value
+                 for spei, institucion in SPEI_TO_STP.items()}
+
+
 def spei_to_stp_bank_code(spei_code: str) -> Institucion:
-    try:
-        bank_name = BankCode(spei_code)
-        return Institucion[bank_name.name]
-    except (ValueError, KeyError):
-        return None
-
-
-def stp_to_spei_bank_code(stp_code: int) -> str:
-    try:
-        bank_name = Institucion(stp_code)
-        return BankCode[bank_name.name].value
-    except (ValueError, KeyError):
-        return None
+    return SPEI_TO_STP.get(spei_code)
+
+
+def stp_to_spei_bank_code(stp_code: Union[int, Institucion]) -> str:
+    if isinstance(stp_code, Institucion):
+        stp_code = stp_code.value
+    return STP_TO_SPEI.get(stp_code)
+
+
+def institucion_contraparte(cuenta: str) -> Optional[int]:
+    """
+        Clave de STP del banco de una CLABE, para usarla como
+        institucionContraparte
+    :param cuenta: CLABE, se usan los primeros tres dígitos
+    :return: Clave de la institución o None si el banco no se conoce
+    """
+    return _CONTRAPARTES.get(cuenta[:3])
+
+
+def institucion_contraparte_many(
+        cuentas: Iterable[str]) -> List[Optional[int]]:
+    """
+        institucion_contraparte para un lote de CLABEs
+    :return: Lista de claves en el mismo orden, None si el banco no se
+        conoce
+    """
+    get = _CONTRAPARTES.get
+    return [get(cuenta[:3]) for cuenta in cuentas]
+
+
+_TABLE = None
+
+
+def institucion_contraparte_array(cuentas):
+    """
+        institucion_contraparte vectorizada con NumPy para archivos de
+        millones de cuentas: los tres primeros dígitos de cada CLABE se usan
+        como índice en una tabla de 1000 posiciones. Requiere numpy
+        (`pip install stpmex[numpy]`).
+    :param cuentas: Arreglo o secuencia de CLABEs como texto
+    :return: numpy.ndarray de int32 con la clave de cada institución, 0 si
+        el banco no se conoce
+    """
+    global _TABLE
+    import numpy as np
+
+    if _TABLE is None:
+        table = np.zeros(1000, dtype=np.int32)
+        for spei, clave in _CONTRAPARTES.items():
+            if len(spei) == 3 and spei.isdigit():
+                table[int(spei)] = clave
+        _TABLE = table
+    cuentas = np.asarray(cuentas)
+    if cuentas.dtype.kind not in 'SU':
+        raise TypeError('cuentas must be strings')
+    if cuentas.size == 0:
+        return np.zeros(cuentas.shape, dtype=np.int32)
+    # Los caracteres se leen directo del buffer del arreglo: un byte por
+    # carácter en 'S' y un entero de 32 bits en 'U'
+    char = np.uint8 if cuentas.dtype.kind == 'S' else np.uint32
+    width = cuentas.dtype.itemsize // np.dtype(char).itemsize
+    if width < 3:
+        cuentas = cuentas.astype(f'{cuentas.dtype.kind}3')
+        width = 3
+    chars = np.ascontiguousarray(cuentas).reshape(-1).view(char)
+    digits = chars.reshape(-1, width)[:, :3].astype(np.int32) - ord('0')
+    # Lo que no sea dígito, o una cuenta más corta, no tiene banco
+    valid = ((digits >= 0) & (digits <= 9)).all(axis=1)
+    index = digits[:, 0] * 100 + digits[:, 1] * 10 + digits[:, 2]
+    result = np.where(valid, _TABLE[np.where(valid, index, 0)], 0)
+    return result.astype(np.int32).reshape(cuentas.shape)
@@ -0,0 +1,260 @@
+"""
+Bitácora local de escritura anticipada (write-ahead) para las órdenes. Antes
+de enviar una orden firmada se agrega al archivo su cadena original, firma,
+claveRastreo y campos, y después de enviarla su resultado. Si el proceso se
+cae entre el envío y guardar el id, al arrancar de nuevo `replay()` reenvía
+las órdenes sin resultado con la misma claveRastreo y firma; si STP responde
+que la clave ya fue utilizada, la orden sí había salido.
+
+El archivo sólo crece hacia el final, una línea JSON por evento. Las
+escrituras de varios hilos se agrupan en un solo fsync (group commit), así
+que con varias órdenes en vuelo el costo del fsync se reparte entre todas:
+
+    journal = Journal('/var/lib/stpmex/ordenes.journal')
+    cliente = StpClient(..., journal=journal)
+    journal.replay(cliente)
+"""
+import json
+import os
+import threading
+from typing import Dict, List, NamedTuple, Optional
+
+from .retry import respuesta_reenvio
+
+INICIO = 'P'
+RESULTADO = 'R'
+
+
+class Pendiente(NamedTuple):
+    claveRastreo: str
+    cadena: str
+    firma: str
+    orden: dict
+
+
+class Reenvio(NamedTuple):
+    claveRastreo: str
+    id: Optional[int]
+    descripcionError: Optional[str]
+    error: Optional[Exception]
+    # STP ya tenía la orden: el envío original sí había llegado
+    duplicada: bool = False
+
+
+def _line(record: dict) -> bytes:
+    return (json.dumps(record, separators=(',', ':'), ensure_ascii=False,
+                       default=str) + '\n').encode('utf-8')
+
+
+class Journal:
+    """
+        Bitácora append-only de órdenes enviadas
+    :param path: Archivo de la bitácora, se crea si no existe
+    :param fsync: Espera a que cada orden quede en disco antes de enviarla.
+        Sin fsync la bitácora sobrevive a la caída del proceso pero no a la
+        del sistema operativo
+    """
+    def __init__(self, path: str, fsync: bool = True):
+        self.path = path
+        self.fsync = fsync
+        self.commits = 0
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                           0o600)
+        self._terminate_last_line()
+        self._cond = threading.Condition()
+        self._buffer = []
+        # Secuencia del último evento agregado, del último escrito al
+        # archivo, del último sincronizado con el disco y del último que
+        # alguien espera ver sincronizado
+        self._seq = 0
+        self._written = 0
+        self._synced = 0
+        self._sync_upto = 0
+        self._flushing = False
+
+    def _terminate_last_line(self):
+        # Si el proceso anterior se cayó a media línea, los eventos nuevos
+        # empiezan en otra
+        with open(self.path, 'rb') as fp:
+            fp.seek(0, os.SEEK_END)
+            if not fp.tell():
+                return
+            fp.seek(-1, os.SEEK_END)
+            if fp.read(1) != b'\n':
+                os.write(self._fd, b'\n')
+
+    def _append(self, record: dict, sync: bool):
+        with self._cond:
+            if self._fd is None:
+                raise ValueError('Journal is closed')
+            self._buffer.append(_line(record))
+            self._seq += 1
+            seq = self._seq
+            if sync:
+                self._sync_upto = seq
+            while (self._synced if sync else self._written) < seq:
+                if not self._flushing:
+                    self._flush_locked()
+                elif sync:
+                    self._cond.wait()
+                else:
+                    # El hilo que está escribiendo también escribirá éste
+                    return
+
+    def _flush_locked(self):
+        """
+            Escribe todo lo acumulado y hace fsync si alguien lo espera. Se
+            llama con el lock tomado y lo suelta mientras escribe, así los
+            demás hilos siguen agregando eventos que salen en el siguiente
+            grupo con un solo fsync
+        """
+        self._flushing = True
+        try:
+            while self._buffer or self._synced < self._sync_upto:
+                lines, self._buffer = self._buffer, []
+                upto = self._seq
+                sync = self._sync_upto > self._synced
+                self._cond.release()
+                try:
+                    if lines:
+                        os.write(self._fd, b''.join(lines))
+                    if sync:
+                        os.fsync(self._fd)
+                finally:
+                    self._cond.acquire()
+                self._written = upto
+                if sync:
+                    self._synced = upto
+                    self.commits += 1
+                self._cond.notify_all()
+        finally:
+            self._flushing = False
+            self._cond.notify_all()
+
+    def begin(self, orden):
+        """
+            Registra la orden firmada antes de enviarla. Regresa cuando el
+            evento ya está en disco
+        """
+        campos = {name: getattr(orden, name)
+                  for name in orden.__fieldnames__}
+        self._append(dict(t=INICIO, clave=orden.claveRastreo,
+                          cadena=orden._joined_fields.decode('utf-8'),
+                          firma=orden.firma, orden=campos), sync=self.fsync)
+
+    def end(self, orden, resp):
+        """
+            Registra la respuesta de STP. No espera el fsync: si se pierde,
+            el reenvío encontrará la clave duplicada
+        """
+        self._append(dict(t=RESULTADO, clave=orden.claveRastreo,
+                          id=getattr(resp, 'id', None),
+                          descripcionError=getattr(resp, 'descripcionError',
+                                                   None)), sync=False)
+
+    def flush(self):
+        """
+            Escribe y sincroniza con el disco todo lo pendiente
+        """
+        with self._cond:
+            while self._flushing:
+                self._cond.wait()
+            if self.fsync:
+                self._sync_upto = self._seq
+            self._flush_locked()
+
+    def close(self):
+        if self._fd is None:
+            return
+        self.flush()
+        with self._cond:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _read(self) -> Dict[str, Pendiente]:
+        pendientes = {}
+        with open(self.path, 'rb') as fp:
+            for raw in fp:
+                try:
+                    record = json.loads(raw)
+                except ValueError:
+                    # Una línea incompleta al final por una caída
+                    continue
+                if record.get('t') == INICIO:
+                    pendientes[record['clave']] = Pendiente(
+                        record['clave'], record['cadena'], record['firma'],
+                        record['orden'])
+                elif record.get('t') == RESULTADO:
+                    pendientes.pop(record['clave'], None)
+        return pendientes
+
+    def pendientes(self) -> List[Pendiente]:
+        """
+            Órdenes que se empezaron a enviar y no tienen resultado
+        """
+        self.flush()
+        return list(self._read().values())
+
+    def replay(self, client=None) -> List[Reenvio]:
+        """
+            Reenvía las órdenes sin resultado con la misma claveRastreo y
+            firma. Se debe llamar al arrancar, antes de enviar órdenes nuevas
+        :param client: StpClient con el que se reenvían, por omisión el de
+            configure()
+        :return: Un Reenvio por orden, con `duplicada` si STP ya la tenía
+            registrada
+        """
+        from .base import _get_client
+        from .ordenes import Orden
+
+        client = _get_client(client)
+        resultados = []
+        for pendiente in self.pendientes():
+            orden = Orden(**pendiente.orden)
+            orden._client = client
+            if orden._joined_fields.decode('utf-8') != pendiente.cadena:
+                resultados.append(Reenvio(
+                    pendiente.claveRastreo, None, None,
+                    ValueError('Journal entry does not match its cadena')))
+                continue
+            try:
+                resp = orden.registra()
+            except Exception as exc:
+                resultados.append(
+                    Reenvio(pendiente.claveRastreo, None, None, exc))
+                continue
+            resp = respuesta_reenvio(resp)
+            if client.journal is not self:
+                self.end(orden, resp)
+            resultados.append(Reenvio(
+                pendiente.claveRastreo, resp.id, resp.descripcionError, None,
+                getattr(resp, 'duplicada', False)))
+        self.flush()
+        return resultados
+
+    def compact(self):
+        """
+            Reescribe la bitácora sólo con las órdenes sin resultado
+        """
+        with self._cond:
+            while self._flushing:
+                self._cond.wait()
+            self._flush_locked()
+            pendientes = self._read()
+            tmp = f'{self.path}.tmp'
+            with open(tmp, 'wb') as fp:
+                for p in pendientes.values():
+                    fp.write(_line(dict(t=INICIO, clave=p.claveRastreo,
+                                        cadena=p.cadena, firma=p.firma,
+                                        orden=p.orden)))
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmp, self.path)
+            os.close(self._fd)
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
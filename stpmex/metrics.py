@@ -0,0 +1,187 @@
+"""
+Instrumentación de las fases de envío de un recurso. Cada fase de
+`registra()` se mide y se notifica a los hooks registrados:
+
+    validate  validaciones de la orden
+    sign      cadena original y firma
+    build     objeto de zeep y envelope SOAP
+    post      petición HTTP a STP
+    parse     lectura de la respuesta
+    total     la operación completa, con la respuesta de STP o la excepción
+    queue     tiempo de espera en la cola de un scheduler.Scheduler
+
+Sin hooks registrados no se toma ningún tiempo, así que el costo es una
+sola comparación por fase.
+
+    exporter = PrometheusExporter()
+    add_hook(exporter)
+    ...
+    exporter.render()  # texto en formato de exposición de Prometheus
+"""
+import threading
+import time
+from bisect import bisect_left
+from typing import (Any, Awaitable, Callable, List, NamedTuple, Optional,
+                    Sequence)
+
+PHASES = ('validate', 'sign', 'build', 'post', 'parse')
+TOTAL = 'total'
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Event(NamedTuple):
+    phase: str
+    seconds: float
+    resource: Any
+    result: Any
+    error: Optional[Exception]
+
+
+Hook = Callable[[Event], None]
+
+HOOKS: List[Hook] = []
+
+
+def add_hook(hook: Hook):
+    """
+        Registra una función que recibe un Event al terminar cada fase
+    """
+    HOOKS.append(hook)
+
+
+def remove_hook(hook: Hook):
+    HOOKS.remove(hook)
+
+
+def emit(event: Event):
+    """
+        Notifica un Event a los hooks. Para fases que no se miden con
+        `measure`, como la espera en la cola de un Scheduler
+    """
+    for hook in list(HOOKS):
+        hook(event)
+
+
+def measure(phase: str, resource, func, *args):
+    """
+        Ejecuta `func(*args)` y notifica su duración a los hooks
+    :param phase: Nombre de la fase
+    :param resource: Recurso que se está enviando
+    :return: Lo que devuelva `func`
+    """
+    if not HOOKS:
+        return func(*args)
+    start = time.perf_counter()
+    try:
+        result = func(*args)
+    except Exception as exc:
+        emit(Event(phase, time.perf_counter() - start, resource, None, exc))
+        raise
+    emit(Event(phase, time.perf_counter() - start, resource, result, None))
+    return result
+
+
+async def measure_async(phase: str, resource, awaitable: Awaitable):
+    """
+        Versión de `measure` que espera una corrutina
+    """
+    if not HOOKS:
+        return await awaitable
+    start = time.perf_counter()
+    try:
+        result = await awaitable
+    except Exception as exc:
+        emit(Event(phase, time.perf_counter() - start, resource, None, exc))
+        raise
+    emit(Event(phase, time.perf_counter() - start, resource, result, None))
+    return result
+
+
+def _labels(**labels) -> str:
+    return '{' + ','.join(f'{name}="{value}"'
+                          for name, value in labels.items()) + '}'
+
+
+def _number(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class PrometheusExporter:
+    """
+        Hook que acumula un histograma de duración por fase y contadores de
+        resultados: órdenes aceptadas, rechazadas por STP (por id de error)
+        y excepciones. `render()` devuelve el texto para un endpoint
+        /metrics.
+    :param namespace: Prefijo de las métricas
+    :param buckets: Límites superiores del histograma en segundos
+    """
+    def __init__(self, namespace: str = 'stpmex',
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.namespace = namespace
+        self.buckets = tuple(sorted(buckets))
+        self._histograms = {}
+        self._results = {}
+        self._stp_errors = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event: Event):
+        index = bisect_left(self.buckets, event.seconds)
+        with self._lock:
+            histogram = self._histograms.get(event.phase)
+            if histogram is None:
+                histogram = [[0] * (len(self.buckets) + 1), 0.0]
+                self._histograms[event.phase] = histogram
+            histogram[0][index] += 1
+            histogram[1] += event.seconds
+            if event.phase == TOTAL:
+                self._count_result(event)
+
+    def _count_result(self, event: Event):
+        if event.error is not None:
+            result = 'exception'
+        elif getattr(event.result, 'descripcionError', None):
+            result = 'stp_error'
+            code = str(event.result.id)
+            self._stp_errors[code] = self._stp_errors.get(code, 0) + 1
+        else:
+            result = 'ok'
+        self._results[result] = self._results.get(result, 0) + 1
+
+    def render(self) -> str:
+        """
+            Métricas en el formato de texto de Prometheus
+        """
+        name = f'{self.namespace}_phase_seconds'
+        lines = [f'# HELP {name} Duration of each send phase',
+                 f'# TYPE {name} histogram']
+        with self._lock:
+            for phase, (counts, total) in sorted(self._histograms.items()):
+                cumulative = 0
+                for le, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket'
+                                 f'{_labels(phase=phase, le=_number(le))} '
+                                 f'{cumulative}')
+                lines.append(f'{name}_sum{_labels(phase=phase)} '
+                             f'{_number(total)}')
+                lines.append(f'{name}_count{_labels(phase=phase)} '
+                             f'{cumulative}')
+            for metric, label, values, help_ in (
+                    ('results_total', 'result', self._results,
+                     'Sent resources by result'),
+                    ('stp_errors_total', 'id', self._stp_errors,
+                     'Resources rejected by STP by error id')):
+                metric = f'{self.namespace}_{metric}'
+                lines.append(f'# HELP {metric} {help_}')
+                lines.append(f'# TYPE {metric} counter')
+                for value, count in sorted(values.items()):
+                    lines.append(f'{metric}{_labels(**{label: value})} '
+                                 f'{count}')
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._results.clear()
+            self._stp_errors.clear()
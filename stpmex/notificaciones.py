@@ -0,0 +1,297 @@
+"""
+Receptor de las notificaciones que STP envía por HTTP: abonos recibidos y
+cambios de estado de las órdenes enviadas (liquidadas o devueltas).
+
+Es una aplicación WSGI que valida cada notificación con los mismos modelos
+que Orden, la encola y responde de inmediato. Un grupo de hilos ejecuta el
+handler de forma concurrente y las notificaciones procesadas se entregan en
+lotes a un sink, así que un pico de miles de notificaciones por segundo no
+retrasa la respuesta a STP:
+
+    receptor = Receptor(handler=procesa, sink=guarda_lote)
+    receptor.start()
+    # gunicorn, uwsgi o receptor.serve('0.0.0.0', 8000)
+"""
+import json
+import logging
+import queue
+import threading
+import time
+from socketserver import ThreadingMixIn
+from typing import Callable, List, Optional, Union
+from wsgiref.simple_server import WSGIServer, make_server
+
+from .base import Resource
+from .signing import Verifier
+
+logger = logging.getLogger(__name__)
+
+ABONO_FIELDNAMES = """
+    id
+    fechaOperacion
+    institucionOrdenante
+    institucionBeneficiaria
+    claveRastreo
+    monto
+    nombreOrdenante
+    tipoCuentaOrdenante
+    cuentaOrdenante
+    rfcCurpOrdenante
+    nombreBeneficiario
+    tipoCuentaBeneficiario
+    cuentaBeneficiario
+    rfcCurpBeneficiario
+    conceptoPago
+    referenciaNumerica
+    empresa
+    """.split()
+
+CAMBIO_ESTADO_FIELDNAMES = """
+    id
+    empresa
+    folioOrigen
+    estado
+    causaDevolucion
+    """.split()
+
+DEFAULT_WORKERS = 10
+DEFAULT_QUEUE_SIZE = 10_000
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_FLUSH_INTERVAL = 1.0
+RESPUESTA = json.dumps(dict(mensaje='recibido')).encode('utf-8')
+
+
+class Abono(Resource):
+    __slots__ = tuple(ABONO_FIELDNAMES)
+    __fieldnames__ = ABONO_FIELDNAMES
+    __validations__ = dict(
+        id=dict(required=True),
+        claveRastreo=dict(required=True, maxLength=30),
+        monto=dict(required=True, positive=True),
+        cuentaBeneficiario=dict(required=True,
+                                cuenta='tipoCuentaBeneficiario'),
+        institucionOrdenante=dict(required=True),
+        empresa=dict(required=True),
+    )
+
+
+class CambioEstado(Resource):
+    __slots__ = tuple(CAMBIO_ESTADO_FIELDNAMES)
+    __fieldnames__ = CAMBIO_ESTADO_FIELDNAMES
+    __validations__ = dict(
+        id=dict(required=True),
+        estado=dict(required=True),
+    )
+
+
+Notificacion = Union[Abono, CambioEstado]
+
+
+def parse_notificacion(payload: dict) -> Notificacion:
+    """
+        Convierte el JSON de STP en Abono o CambioEstado y lo valida. Los
+        campos que no son parte del modelo se ignoran; `firma` se conserva
+        para poder verificarla.
+    :raises ValueError: si faltan campos o tienen valores inválidos
+    """
+    if not isinstance(payload, dict):
+        raise ValueError('Notification must be a JSON object')
+    model = CambioEstado if 'estado' in payload else Abono
+    notificacion = model(**{k: v for k, v in payload.items()
+                            if k in model._fieldset})
+    notificacion.firma = payload.get('firma')
+    notificacion._is_valid()
+    return notificacion
+
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class Receptor:
+    """
+        Aplicación WSGI que recibe las notificaciones de STP
+    :param handler: Función que procesa cada notificación. Se ejecuta en
+        `workers` hilos a la vez
+    :param sink: Función que recibe listas de notificaciones ya procesadas,
+        por ejemplo para guardarlas en una sola transacción
+    :param workers: Hilos que ejecutan el handler
+    :param queue_size: Notificaciones pendientes antes de responder 503 para
+        que STP reintente
+    :param batch_size: Tamaño máximo de cada lote para el sink
+    :param flush_interval: Segundos máximos que espera un lote incompleto
+    :param verifier: signing.Verifier con el certificado de STP. Si se da,
+        las notificaciones con firma inválida se rechazan con 400
+    """
+    def __init__(self, handler: Callable[[Notificacion], None] = None,
+                 sink: Callable[[List[Notificacion]], None] = None,
+                 workers: int = DEFAULT_WORKERS,
+                 queue_size: int = DEFAULT_QUEUE_SIZE,
+                 batch_size: int = DEFAULT_BATCH_SIZE,
+                 flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+                 verifier: Verifier = None):
+        if handler is None and sink is None:
+            raise ValueError('A handler or a sink is required')
+        self.handler = handler
+        self.sink = sink
+        self.workers = workers
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.verifier = verifier
+        self.recibidas = 0
+        self.errores = 0
+        self._stats_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._batch = []
+        self._batch_lock = threading.Condition()
+        self._threads = []
+        self._running = False
+
+    def start(self):
+        """
+            Arranca los hilos del handler y del sink
+        """
+        if self._running:
+            return self
+        self._running = True
+        targets = [self._work] * self.workers
+        if self.sink is not None:
+            targets.append(self._flush_loop)
+        for target in targets:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def close(self):
+        """
+            Procesa lo pendiente, entrega el último lote y detiene los hilos
+        """
+        if not self._running:
+            return
+        self._queue.join()
+        self._running = False
+        for _ in range(self.workers):
+            self._queue.put(None)
+        with self._batch_lock:
+            self._batch_lock.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._flush()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def recibe(self, payload: dict) -> Notificacion:
+        """
+            Valida una notificación y la encola
+        :raises ValueError: si la notificación o su firma son inválidas
+        :raises queue.Full: si hay demasiadas notificaciones pendientes
+        """
+        notificacion = parse_notificacion(payload)
+        if self.verifier is not None and \
+                not notificacion.verify(self.verifier):
+            raise ValueError('Invalid firma')
+        self._queue.put_nowait(notificacion)
+        self._count('recibidas')
+        return notificacion
+
+    def _count(self, stat: str, n: int = 1):
+        with self._stats_lock:
+            setattr(self, stat, getattr(self, stat) + n)
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] != 'POST':
+            return self._respond(start_response, '405 Method Not Allowed',
+                                 dict(error='Method not allowed'))
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            payload = json.loads(environ['wsgi.input'].read(length))
+            self.recibe(payload)
+        except queue.Full:
+            return self._respond(start_response, '503 Service Unavailable',
+                                 dict(error='Too many pending notifications'))
+        except ValueError as exc:
+            return self._respond(start_response, '400 Bad Request',
+                                 dict(error=str(exc)))
+        start_response('200 OK', [('Content-Type', 'application/json'),
+                                  ('Content-Length', str(len(RESPUESTA)))])
+        return [RESPUESTA]
+
+    @staticmethod
+    def _respond(start_response, status: str, body: dict):
+        content = json.dumps(body).encode('utf-8')
+        start_response(status, [('Content-Type', 'application/json'),
+                                ('Content-Length', str(len(content)))])
+        return [content]
+
+    def serve(self, host: str = '0.0.0.0', port: int = 8000):
+        """
+            Atiende las notificaciones con el servidor WSGI de la librería
+            estándar, un hilo por petición. En producción se puede montar la
+            instancia en cualquier servidor WSGI.
+        """
+        self.start()
+        server = make_server(host, port, self,
+                             server_class=_ThreadingWSGIServer)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            self.close()
+
+    def _work(self):
+        while True:
+            notificacion = self._queue.get()
+            try:
+                if notificacion is None:
+                    return
+                if self.handler is not None:
+                    self.handler(notificacion)
+                if self.sink is not None:
+                    self._add(notificacion)
+            except Exception:
+                self._count('errores')
+                logger.exception('Error processing notification %s',
+                                 getattr(notificacion, 'id', None))
+            finally:
+                self._queue.task_done()
+
+    def _add(self, notificacion: Notificacion):
+        with self._batch_lock:
+            self._batch.append(notificacion)
+            if len(self._batch) >= self.batch_size:
+                self._batch_lock.notify()
+
+    def _take_batch(self) -> Optional[List[Notificacion]]:
+        with self._batch_lock:
+            batch, self._batch = self._batch[:self.batch_size], \
+                self._batch[self.batch_size:]
+            return batch
+
+    def _flush(self):
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                return
+            try:
+                self.sink(batch)
+            except Exception:
+                self._count('errores', len(batch))
+                logger.exception('Error delivering %d notifications',
+                                 len(batch))
+
+    def _flush_loop(self):
+        while self._running:
+            deadline = time.monotonic() + self.flush_interval
+            with self._batch_lock:
+                while self._running and len(self._batch) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._batch_lock.wait(remaining)
+            self._flush()
@@ -1,7 +1,12 @@
-import random
-import time
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, NamedTuple, Optional
 
-from .base import Resource
+from .base import Resource, _get_client
+from .defaults import DEFAULT_MAX_WORKERS
+from .metrics import TOTAL, measure, measure_async
+from .generators import clave_rastreo, referencia_numerica
 from .types import AccountType, Prioridad
 
 ORDEN_FIELDNAMES = """
@@ -48,39 +53,168 @@ ORDEN_DEFAULTS = dict(
     topologia='T',
     medioEntrega=3,
     prioridad=Prioridad.alta.value,
-    claveRastreo=lambda: f'CR{int(time.time())}',
-    referenciaNumerica=lambda: random.randint(10 ** 6, 10 ** 7)
+    claveRastreo=clave_rastreo,
+    referenciaNumerica=referencia_numerica
 )
 
 VALIDATIONS = dict(
     nombreBeneficiario=dict(
         required=True,
-        maxLength=39
+        maxLength=39,
+        charset=True
     ),
     claveRastreo=dict(
         required=True,
-        maxLength=30
+        maxLength=30,
+        charset=True
     ),
     conceptoPago=dict(
-        required=True
+        required=True,
+        charset=True
     ),
     referenciaNumerica=dict(
         required=True,
         maxLength=7
+    ),
+    cuentaBeneficiario=dict(
+        required=True,
+        cuenta='tipoCuentaBeneficiario'
+    ),
+    institucionContraparte=dict(
+        required=True,
+        institucion=True
+    ),
+    monto=dict(
+        required=True,
+        positive=True
+    ),
+    rfcCurpBeneficiario=dict(
+        maxLength=18,
+        charset=True
     )
 )
 
 
+class Resultado(NamedTuple):
+    id: Optional[int]
+    descripcionError: Optional[str]
+    error: Optional[Exception]
+
+
+def _registra(orden: 'Orden') -> Resultado:
+    try:
+        resp = orden.registra()
+    except Exception as exc:
+        return Resultado(None, None, exc)
+    if getattr(resp, 'duplicada', False):
+        # retry.Duplicada ya tiene los campos de Resultado
+        return resp
+    return Resultado(resp.id, resp.descripcionError, None)
+
+
+def registra_ordenes(ordenes: Iterable['Orden'],
+                     max_workers: int = DEFAULT_MAX_WORKERS
+                     ) -> Iterator[Resultado]:
+    """
+        Envía las órdenes de forma concurrente y devuelve sus resultados en
+        el mismo orden en que fueron recibidas. Nunca hay más de
+        `max_workers` peticiones en vuelo y sólo se mantiene en memoria una
+        ventana acotada de órdenes pendientes, por lo que `ordenes` puede
+        ser un generador de cualquier tamaño.
+    :param ordenes: Órdenes a registrar
+    :param max_workers: Número máximo de peticiones simultáneas a STP
+    :return: Generador de Resultado, uno por cada orden
+    """
+    if max_workers < 1:
+        raise ValueError('max_workers must be greater than 0')
+    window = max_workers * 2
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pendientes = deque()
+        for orden in ordenes:
+            pendientes.append(executor.submit(_registra, orden))
+            if len(pendientes) >= window:
+                yield pendientes.popleft().result()
+        while pendientes:
+            yield pendientes.popleft().result()
+
+
 class Orden(Resource):
+    __slots__ = tuple(ORDEN_FIELDNAMES)
     __fieldnames__ = ORDEN_FIELDNAMES
     __type__ = 'ns0:ordenPagoWS'
     __validations__ = VALIDATIONS
-    _id = None
     _defaults = ORDEN_DEFAULTS
 
     def registra(self):
-        self._is_valid()
-        self.firma = self._compute_signature()
-        resp = self._invoke_method('registraOrden')
+        """
+            Valida, firma y envía la orden. Si el cliente tiene una
+            `retry_policy`, los reintentos reenvían la misma claveRastreo y
+            firma.
+        :return: Respuesta de STP
+        """
+        return measure(TOTAL, self, self._registra)
+
+    def _registra(self):
+        self._prepare_send()
+        journal = _get_client(self._client).journal
+        try:
+            if journal is not None:
+                journal.begin(self)
+            resp = self._send('registraOrden')
+        except BaseException:
+            self._libera_clave()
+            raise
+        if journal is not None:
+            journal.end(self, resp)
         self._id = resp.id
         return resp
+
+    async def registra_async(self):
+        """
+            Versión asíncrona de `registra`. Aplica las mismas validaciones y
+            la misma firma, pero envía la orden con el cliente asíncrono de
+            zeep sin ocupar un hilo por petición.
+        :return: Respuesta de STP
+        """
+        return await measure_async(TOTAL, self, self._registra_async())
+
+    async def _registra_async(self):
+        self._prepare_send()
+        journal = _get_client(self._client).journal
+        try:
+            if journal is not None:
+                # El fsync no debe bloquear el event loop
+                await asyncio.get_running_loop().run_in_executor(
+                    None, journal.begin, self)
+            resp = await self._send_async('registraOrden')
+        except BaseException:
+            self._libera_clave()
+            raise
+        if journal is not None:
+            journal.end(self, resp)
+        self._id = resp.id
+        return resp
+
+    @classmethod
+    def firma_many(cls, ordenes: Iterable['Orden'], processes: int = None):
+        """
+            Calcula la firma de un lote de órdenes usando todos los núcleos.
+            Las firmas quedan en caché, así que un `registra_many` posterior
+            no vuelve a firmarlas.
+        :param ordenes: Órdenes a firmar
+        :param processes: Número de procesos, por omisión uno por núcleo
+        :return: Lista de firmas en el mismo orden que `ordenes`
+        """
+        return cls._compute_signatures(list(ordenes), processes=processes)
+
+    @classmethod
+    def registra_many(cls, ordenes: Iterable['Orden'],
+                      max_workers: int = DEFAULT_MAX_WORKERS):
+        """
+            Registra un lote de órdenes de forma concurrente. El error de una
+            orden no interrumpe el resto del lote, queda en su Resultado.
+        :param ordenes: Órdenes a registrar
+        :param max_workers: Número máximo de peticiones simultáneas a STP
+        :return: Lista de Resultado en el mismo orden que `ordenes`
+        """
+        return list(registra_ordenes(ordenes, max_workers))
@@ -0,0 +1,315 @@
+"""
+Reintentos con espera exponencial aleatoria y circuit breaker por endpoint
+para el envío de órdenes.
+
+Reintentar sólo es seguro si se reenvía exactamente la misma orden: se
+valida y firma una sola vez y cada intento lleva la misma claveRastreo y
+firma. Si después de un intento fallido STP contesta que la clave de rastreo
+ya fue utilizada, el intento anterior sí llegó y la respuesta es
+`Duplicada`.
+
+    cliente = StpClient(..., retry_policy=RetryPolicy(max_attempts=3),
+                        breaker_threshold=5)
+"""
+import asyncio
+import random
+import re
+import threading
+import time
+from typing import Any, NamedTuple, Optional, Tuple, Type
+
+# STP usa el id -1 para varios rechazos; el de una claveRastreo ya utilizada
+# se distingue por su descripcionError
+CLAVE_DUPLICADA_ID = -1
+CLAVE_DUPLICADA = re.compile(r'clave de rastreo .*ya fue utilizada',
+                             re.IGNORECASE)
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_BASE_DELAY = 0.1
+DEFAULT_MAX_DELAY = 2.0
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30.0
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """
+        El endpoint tuvo demasiadas fallas seguidas y no se intenta enviar
+    """
+    def __init__(self, address: str, retry_in: float):
+        super().__init__(f'Circuit open for {address}, retry in '
+                         f'{retry_in:.1f}s')
+        self.address = address
+        self.retry_in = retry_in
+
+
+class Duplicada(NamedTuple):
+    """
+        Respuesta a un reenvío de la misma orden que STP rechazó por
+        claveRastreo duplicada: el envío anterior sí llegó y la orden está
+        registrada, pero STP no devuelve su id
+    :param respuesta: El rechazo de STP, con su descripcionError
+    """
+    respuesta: Any
+    id = None
+    descripcionError = None
+    error = None
+    duplicada = True
+
+
+def es_clave_duplicada(resp) -> bool:
+    """
+        True si STP rechazó la orden porque su claveRastreo ya fue utilizada
+    """
+    return getattr(resp, 'id', None) == CLAVE_DUPLICADA_ID and \
+        bool(CLAVE_DUPLICADA.search(
+            getattr(resp, 'descripcionError', None) or ''))
+
+
+def respuesta_reenvio(resp):
+    """
+        Interpreta la respuesta a un reenvío con la misma claveRastreo y
+        firma: la clave duplicada se convierte en Duplicada y cualquier otra
+        respuesta, incluso otros rechazos con id -1, se devuelve igual
+    """
+    if es_clave_duplicada(resp):
+        return Duplicada(resp)
+    return resp
+
+
+_retry_on = None
+
+
+def default_retry_on() -> Tuple[Type[BaseException], ...]:
+    """
+        Errores de conexión, timeouts, HTTP y SOAP Fault. Se importan al
+        usarse para no cargar requests ni zeep con el módulo
+    """
+    global _retry_on
+    if _retry_on is None:
+        from requests.exceptions import RequestException
+        from zeep.exceptions import Fault, TransportError
+        errors = (RequestException, TransportError, Fault,
+                  asyncio.TimeoutError)
+        try:
+            import httpx
+        except ImportError:
+            pass
+        else:
+            errors += (httpx.TransportError,)
+        _retry_on = errors
+    return _retry_on
+
+
+class RetryPolicy:
+    """
+        Cuándo y cuánto esperar para reenviar una orden
+    :param max_attempts: Intentos en total, incluyendo el primero
+    :param base_delay: Espera máxima antes del segundo intento; se duplica
+        en cada intento
+    :param max_delay: Tope de la espera entre intentos
+    :param budget: Segundos máximos para todos los intentos. No se reintenta
+        si la espera terminaría después
+    :param retry_on: Excepciones que se reintentan. Por omisión los errores
+        de conexión, timeouts, HTTP y SOAP Fault
+    """
+    def __init__(self, max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                 base_delay: float = DEFAULT_BASE_DELAY,
+                 max_delay: float = DEFAULT_MAX_DELAY,
+                 budget: float = None,
+                 retry_on: Tuple[Type[BaseException], ...] = None):
+        if max_attempts < 1:
+            raise ValueError('max_attempts must be greater than 0')
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.retry_on = retry_on if retry_on is not None \
+            else default_retry_on()
+        self._random = random.Random()
+
+    def retryable(self, exc: BaseException) -> bool:
+        return isinstance(exc, self.retry_on) and \
+            not isinstance(exc, CircuitOpenError)
+
+    def delay(self, attempt: int) -> float:
+        """
+            Espera antes del siguiente intento, con jitter completo para que
+            los clientes no reintenten todos al mismo tiempo
+        :param attempt: Intento que acaba de fallar, empezando en 1
+        """
+        cap = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return self._random.uniform(0, cap)
+
+    def next_delay(self, attempt: int, exc: BaseException,
+                   elapsed: float) -> Optional[float]:
+        """
+            Decide si se reintenta después de un error
+        :return: Segundos a esperar, o None si no se reintenta
+        """
+        if attempt >= self.max_attempts or not self.retryable(exc):
+            return None
+        delay = self.delay(attempt)
+        if self.budget is not None and elapsed + delay >= self.budget:
+            return None
+        return delay
+
+
+class CircuitBreaker:
+    """
+        Deja de enviar a un endpoint después de `failure_threshold` fallas
+        seguidas. Pasados `reset_timeout` segundos deja pasar una sola
+        petición de prueba: si tiene éxito se cierra, si no vuelve a abrirse.
+    """
+    def __init__(self, address: str,
+                 failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout: float = DEFAULT_RESET_TIMEOUT,
+                 clock=time.monotonic):
+        self.address = address
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._clock = clock
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == OPEN and \
+                    self._clock() - self._opened_at >= self.reset_timeout:
+                return HALF_OPEN
+            return self._state
+
+    def before_call(self) -> bool:
+        """
+            Se llama antes de cada intento
+        :return: True si el intento es la petición de prueba; al terminar
+            se debe llamar record_success, record_failure o release_trial
+        :raises CircuitOpenError: si el circuito está abierto
+        """
+        with self._lock:
+            if self._state == CLOSED:
+                return False
+            retry_in = self._opened_at + self.reset_timeout - self._clock()
+            if retry_in > 0 or self._trial:
+                raise CircuitOpenError(self.address, max(retry_in, 0))
+            self._state = HALF_OPEN
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._state = CLOSED
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self._state == HALF_OPEN or \
+                    self.failures >= self.failure_threshold:
+                self._state = OPEN
+                self._opened_at = self._clock()
+
+    def release_trial(self):
+        """
+            Termina una petición de prueba que no registró éxito ni falla,
+            por ejemplo porque lanzó un error de negocio o fue cancelada. El
+            circuito se vuelve a abrir por `reset_timeout` segundos
+        """
+        with self._lock:
+            if not self._trial:
+                return
+            self._trial = False
+            self._state = OPEN
+            self._opened_at = self._clock()
+
+
+def _on_error(exc: Exception, attempt: int, start: float,
+              policy: Optional[RetryPolicy],
+              breaker: Optional[CircuitBreaker]) -> Optional[float]:
+    """
+        Registra la falla en el breaker y decide si se reintenta
+    :return: Segundos a esperar, o None para propagar el error
+    """
+    if policy is not None:
+        retryable = policy.retryable(exc)
+    else:
+        retryable = isinstance(exc, default_retry_on())
+    if breaker is not None and retryable:
+        breaker.record_failure()
+    if policy is None:
+        return None
+    return policy.next_delay(attempt, exc, time.monotonic() - start)
+
+
+def _on_success(resp, attempt: int, breaker: Optional[CircuitBreaker]):
+    if breaker is not None:
+        breaker.record_success()
+    # Sólo después de un intento fallido el rechazo por clave duplicada
+    # significa que ese intento sí llegó a STP
+    if attempt > 1:
+        return respuesta_reenvio(resp)
+    return resp
+
+
+def call(func, policy: Optional[RetryPolicy],
+         breaker: Optional[CircuitBreaker], sleep=time.sleep):
+    """
+        Ejecuta `func()` reintentando según `policy` y respetando `breaker`
+    :param func: Envía la orden ya firmada, siempre con los mismos datos
+    :return: Respuesta de STP, o Duplicada si un reintento encontró la
+        orden ya registrada por un intento anterior
+    :raises CircuitOpenError: si el endpoint tiene el circuito abierto
+    """
+    start = time.monotonic()
+    attempt = 1
+    while True:
+        probe = breaker is not None and breaker.before_call()
+        try:
+            try:
+                resp = func()
+            except Exception as exc:
+                delay = _on_error(exc, attempt, start, policy, breaker)
+                if delay is None:
+                    raise
+            else:
+                return _on_success(resp, attempt, breaker)
+        finally:
+            if probe:
+                # Cualquier salida sin éxito ni falla registrada, incluso
+                # una cancelación, libera la petición de prueba
+                breaker.release_trial()
+        sleep(delay)
+        attempt += 1
+
+
+async def call_async(func, policy: Optional[RetryPolicy],
+                     breaker: Optional[CircuitBreaker]):
+    """
+        Versión de `call` para una función que devuelve una corrutina
+    """
+    start = time.monotonic()
+    attempt = 1
+    while True:
+        probe = breaker is not None and breaker.before_call()
+        try:
+            try:
+                resp = await func()
+            except Exception as exc:
+                delay = _on_error(exc, attempt, start, policy, breaker)
+                if delay is None:
+                    raise
+            else:
+                return _on_success(resp, attempt, breaker)
+        finally:
+            if probe:
+                breaker.release_trial()
+        await asyncio.sleep(delay)
+        attempt += 1
@@ -0,0 +1,277 @@
+"""
+Envío de órdenes con prioridad y límite de tasa hacia STP. Las órdenes se
+encolan y se envían primero las de `Prioridad.alta`; dentro de cada
+prioridad se alterna entre empresas para que un lote grande de una no
+retrase a las demás. Un token bucket limita las órdenes por segundo:
+
+    with Scheduler(rate=50) as scheduler:
+        futuro = scheduler.submit(orden)
+        ...
+        futuro.result()
+"""
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Dict, Hashable, NamedTuple
+
+from .defaults import DEFAULT_MAX_WORKERS
+from .metrics import HOOKS, Event, emit
+from .types import Prioridad
+
+# Fase que se notifica a los hooks de metrics con el tiempo en cola
+QUEUE = 'queue'
+PRIORIDADES = (Prioridad.alta, Prioridad.normal)
+
+
+class TokenBucket:
+    """
+        Permite `rate` operaciones por segundo en promedio con ráfagas de
+        hasta `burst`
+    """
+    def __init__(self, rate: float, burst: float = None,
+                 clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError('rate must be greater than 0')
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1)
+        self._tokens = self.burst
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self) -> float:
+        """
+            Toma un token si hay uno disponible
+        :return: 0 si se tomó, o los segundos que faltan para el siguiente
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        """
+            Espera hasta tomar un token
+        """
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            self._sleep(wait)
+
+    def release(self):
+        """
+            Devuelve un token que se tomó y no se usó
+        """
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.burst, self._tokens + 1)
+
+
+class _Pendiente(NamedTuple):
+    orden: object
+    future: Future
+    encolada: float
+
+
+class _Espera:
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+
+class Scheduler:
+    """
+        Cola de órdenes con prioridad, equidad entre empresas y límite de
+        tasa
+    :param rate: Órdenes por segundo hacia STP. None para no limitar
+    :param burst: Órdenes que se pueden enviar de golpe, por omisión `rate`
+    :param workers: Peticiones simultáneas a STP
+    """
+    def __init__(self, rate: float = None, burst: float = None,
+                 workers: int = DEFAULT_MAX_WORKERS):
+        if workers < 1:
+            raise ValueError('workers must be greater than 0')
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.workers = workers
+        self.enviadas = 0
+        self.errores = 0
+        # Por prioridad: empresa -> órdenes pendientes, en turno rotativo
+        self._colas = {prioridad: OrderedDict() for prioridad in PRIORIDADES}
+        self._profundidad = {prioridad: 0 for prioridad in PRIORIDADES}
+        self._esperas = {prioridad: _Espera() for prioridad in PRIORIDADES}
+        self._cond = threading.Condition()
+        self._threads = []
+        self._running = False
+        self._closed = False
+
+    def start(self):
+        """
+            Arranca los hilos que envían las órdenes
+        """
+        with self._cond:
+            if self._running:
+                return self
+            self._running = True
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def close(self):
+        """
+            Envía lo pendiente y detiene los hilos. Si nunca se llamó a
+            `start()` no hay quién envíe: las órdenes pendientes se cancelan
+            y sus futures lanzan CancelledError
+        """
+        with self._cond:
+            self._closed = True
+            if not self._running:
+                while True:
+                    siguiente = self._siguiente()
+                    if siguiente is None:
+                        return
+                    siguiente[1].future.cancel()
+            self._running = False
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def _prioridad(orden) -> Prioridad:
+        if orden.prioridad == Prioridad.alta.value:
+            return Prioridad.alta
+        return Prioridad.normal
+
+    def submit(self, orden, tenant: Hashable = None) -> Future:
+        """
+            Encola una orden. Se puede encolar antes de `start()`
+        :param orden: Orden a registrar, ligada o no a un StpClient
+        :param tenant: Con quién se reparte el turno, por omisión la empresa
+            de la orden
+        :return: Future con la respuesta de STP o la excepción
+        """
+        future = Future()
+        prioridad = self._prioridad(orden)
+        if tenant is None:
+            tenant = orden.empresa
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Scheduler is closed')
+            cola = self._colas[prioridad].get(tenant)
+            if cola is None:
+                cola = self._colas[prioridad][tenant] = deque()
+            cola.append(_Pendiente(orden, future, time.monotonic()))
+            self._profundidad[prioridad] += 1
+            self._cond.notify()
+        return future
+
+    def _pendientes(self) -> int:
+        return sum(self._profundidad.values())
+
+    def _siguiente(self):
+        # Primero la prioridad alta; dentro de ella, la empresa a la que le
+        # toca turno pasa al final de la rotación
+        for prioridad in PRIORIDADES:
+            colas = self._colas[prioridad]
+            if not colas:
+                continue
+            tenant, cola = next(iter(colas.items()))
+            pendiente = cola.popleft()
+            if cola:
+                colas.move_to_end(tenant)
+            else:
+                del colas[tenant]
+            self._profundidad[prioridad] -= 1
+            return prioridad, pendiente
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while self._running and not self._pendientes():
+                    self._cond.wait()
+                if not self._pendientes():
+                    return
+            # El token se toma antes de elegir la orden, así una orden alta
+            # que llega durante la espera sale antes que una normal
+            if self.bucket is not None:
+                self.bucket.acquire()
+            with self._cond:
+                siguiente = self._siguiente()
+            if siguiente is None:
+                # Otro hilo vació la cola durante la espera: el token no se
+                # usó y queda para la siguiente orden
+                if self.bucket is not None:
+                    self.bucket.release()
+                continue
+            prioridad, pendiente = siguiente
+            self._send(prioridad, pendiente)
+
+    def _send(self, prioridad: Prioridad, pendiente: _Pendiente):
+        espera = time.monotonic() - pendiente.encolada
+        with self._cond:
+            self._esperas[prioridad].add(espera)
+        if HOOKS:
+            emit(Event(QUEUE, espera, pendiente.orden, None, None))
+        if not pendiente.future.set_running_or_notify_cancel():
+            # Se canceló mientras esperaba: el token queda para otra orden
+            if self.bucket is not None:
+                self.bucket.release()
+            return
+        try:
+            resp = pendiente.orden.registra()
+        except Exception as exc:
+            with self._cond:
+                self.errores += 1
+            pendiente.future.set_exception(exc)
+            return
+        with self._cond:
+            self.enviadas += 1
+        pendiente.future.set_result(resp)
+
+    def stats(self) -> Dict:
+        """
+            Profundidad de la cola y tiempo de espera por prioridad
+        :return: {'enviadas', 'errores', 'alta': {...}, 'normal': {...}}
+            con `pendientes`, `despachadas`, `espera_promedio` y
+            `espera_maxima` en segundos por prioridad
+        """
+        with self._cond:
+            stats = dict(enviadas=self.enviadas, errores=self.errores)
+            for prioridad in PRIORIDADES:
+                espera = self._esperas[prioridad]
+                stats[prioridad.name] = dict(
+                    pendientes=self._profundidad[prioridad],
+                    despachadas=espera.count,
+                    espera_promedio=(espera.total / espera.count
+                                     if espera.count else 0.0),
+                    espera_maxima=espera.max,
+                )
+            return stats
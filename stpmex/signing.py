@@ -0,0 +1,253 @@
+"""
+Firma RSA-SHA256 de las cadenas originales que se envían a STP, y
+verificación de las firmas con el certificado público correspondiente
+"""
+import threading
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, List, Tuple, Union
+
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+
+from .defaults import DEFAULT_CACHE_SIZE
+
+# Por debajo de este tamaño de lote no vale la pena usar otros procesos
+MIN_PARALLEL_BATCH = 256
+
+_worker_signer = None
+_worker_verifier = None
+# Llaves públicas ya cargadas, por contenido PEM
+_public_keys = {}
+_public_keys_lock = threading.Lock()
+
+
+def load_private_key(priv_key: str, priv_key_passphrase: str):
+    """
+        Carga la llave privada PEM cifrada
+    :param priv_key: Contenido de la llave privada
+    :param priv_key_passphrase: Password de la llave privada
+    :return: RSAPrivateKey de cryptography
+    """
+    return serialization.load_pem_private_key(
+        priv_key.encode('ascii'), priv_key_passphrase.encode('ascii'))
+
+
+def load_public_key(public_key: Union[str, bytes]):
+    """
+        Carga un certificado X.509 o una llave pública PEM. Cada contenido
+        se procesa una sola vez y se reutiliza en las siguientes llamadas
+    :param public_key: Contenido PEM del certificado o de la llave pública
+    :return: RSAPublicKey de cryptography
+    """
+    if isinstance(public_key, str):
+        public_key = public_key.encode('ascii')
+    with _public_keys_lock:
+        key = _public_keys.get(public_key)
+        if key is None:
+            if b'CERTIFICATE' in public_key:
+                key = x509.load_pem_x509_certificate(public_key).public_key()
+            else:
+                key = serialization.load_pem_public_key(public_key)
+            _public_keys[public_key] = key
+        return key
+
+
+def _sign(key, cadena: bytes) -> str:
+    signature = key.sign(cadena, padding.PKCS1v15(), hashes.SHA256())
+    return b64encode(signature).decode('ascii')
+
+
+def _verify(key, cadena: bytes, firma: str) -> bool:
+    try:
+        key.verify(b64decode(firma or '', validate=True), cadena,
+                   padding.PKCS1v15(), hashes.SHA256())
+    except (InvalidSignature, ValueError):
+        return False
+    return True
+
+
+def _init_worker(priv_key: str, priv_key_passphrase: str):
+    global _worker_signer
+    _worker_signer = load_private_key(priv_key, priv_key_passphrase)
+
+
+def _sign_in_worker(cadena: bytes) -> str:
+    return _sign(_worker_signer, cadena)
+
+
+def _init_verify_worker(public_key: bytes):
+    global _worker_verifier
+    _worker_verifier = load_public_key(public_key)
+
+
+def _verify_in_worker(pair: Tuple[bytes, str]) -> bool:
+    return _verify(_worker_verifier, *pair)
+
+
+class Signer:
+    """
+        Firma cadenas originales con la llave de la empresa. Las firmas
+        RSA PKCS#1 v1.5 son deterministas, así que se guardan por cadena
+        para no volver a firmar los reintentos de una misma orden.
+    """
+    def __init__(self, priv_key: str, priv_key_passphrase: str,
+                 cache_size: int = DEFAULT_CACHE_SIZE):
+        self.key = load_private_key(priv_key, priv_key_passphrase)
+        self.cache_size = cache_size
+        self._priv_key = priv_key
+        self._priv_key_passphrase = priv_key_passphrase
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_workers = None
+
+    def _cached(self, cadena: bytes):
+        with self._lock:
+            firma = self._cache.get(cadena)
+            if firma is not None:
+                self._cache.move_to_end(cadena)
+            return firma
+
+    def _store(self, cadena: bytes, firma: str):
+        if not self.cache_size:
+            return
+        with self._lock:
+            self._cache[cadena] = firma
+            self._cache.move_to_end(cadena)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def sign(self, cadena: bytes) -> str:
+        """
+            Firma una cadena original
+        :param cadena: Cadena original en bytes
+        :return: Firma en base64
+        """
+        firma = self._cached(cadena)
+        if firma is None:
+            firma = _sign(self.key, cadena)
+            self._store(cadena, firma)
+        return firma
+
+    def sign_many(self, cadenas: Iterable[bytes], processes: int = None,
+                  chunksize: int = 64) -> List[str]:
+        """
+            Firma un lote de cadenas repartiendo el trabajo entre varios
+            procesos. Cada proceso carga la llave una sola vez.
+        :param cadenas: Cadenas originales en bytes
+        :param processes: Número de procesos, por omisión uno por núcleo
+        :param chunksize: Cadenas que se envían a cada proceso por tarea
+        :return: Lista de firmas en base64, en el mismo orden
+        """
+        cadenas = list(cadenas)
+        firmas = [self._cached(cadena) for cadena in cadenas]
+        faltantes = [i for i, firma in enumerate(firmas) if firma is None]
+        if len(faltantes) < MIN_PARALLEL_BATCH or processes == 1:
+            for i in faltantes:
+                firmas[i] = self.sign(cadenas[i])
+            return firmas
+
+        executor = self._get_executor(processes)
+        nuevas = executor.map(_sign_in_worker,
+                              [cadenas[i] for i in faltantes],
+                              chunksize=chunksize)
+        for i, firma in zip(faltantes, nuevas):
+            firmas[i] = firma
+            self._store(cadenas[i], firma)
+        return firmas
+
+    def _get_executor(self, processes: int = None) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None or self._executor_workers != processes:
+                if self._executor is not None:
+                    self._executor.shutdown()
+                self._executor = ProcessPoolExecutor(
+                    max_workers=processes, initializer=_init_worker,
+                    initargs=(self._priv_key, self._priv_key_passphrase))
+                self._executor_workers = processes
+            return self._executor
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+
+    def close(self):
+        """
+            Termina los procesos usados por sign_many
+        """
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+class Verifier:
+    """
+        Verifica firmas de cadenas originales con un certificado público:
+        el de STP para lo que STP nos envía, o el de la empresa para revisar
+        las cadenas propias antes de enviarlas
+    :param public_key: Certificado o llave pública en PEM, o una llave ya
+        cargada
+    """
+    def __init__(self, public_key):
+        if isinstance(public_key, (str, bytes)):
+            self.key = load_public_key(public_key)
+        else:
+            self.key = public_key
+        self._pem = self.key.public_bytes(
+            serialization.Encoding.PEM,
+            serialization.PublicFormat.SubjectPublicKeyInfo)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_workers = None
+
+    def verify(self, cadena: bytes, firma: str) -> bool:
+        """
+            Verifica una firma
+        :param cadena: Cadena original en bytes
+        :param firma: Firma en base64
+        :return: True si la firma corresponde a la cadena
+        """
+        return _verify(self.key, cadena, firma)
+
+    def verify_many(self, pares: Iterable[Tuple[bytes, str]],
+                    processes: int = None,
+                    chunksize: int = 64) -> List[bool]:
+        """
+            Verifica un lote de firmas repartiendo el trabajo entre varios
+            procesos. Cada proceso carga el certificado una sola vez.
+        :param pares: Tuplas (cadena, firma)
+        :param processes: Número de procesos, por omisión uno por núcleo
+        :param chunksize: Firmas que se envían a cada proceso por tarea
+        :return: Lista de resultados, en el mismo orden
+        """
+        pares = list(pares)
+        if len(pares) < MIN_PARALLEL_BATCH or processes == 1:
+            return [self.verify(cadena, firma) for cadena, firma in pares]
+        executor = self._get_executor(processes)
+        return list(executor.map(_verify_in_worker, pares,
+                                 chunksize=chunksize))
+
+    def _get_executor(self, processes: int = None) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None or self._executor_workers != processes:
+                if self._executor is not None:
+                    self._executor.shutdown()
+                self._executor = ProcessPoolExecutor(
+                    max_workers=processes, initializer=_init_verify_worker,
+                    initargs=(self._pem,))
+                self._executor_workers = processes
+            return self._executor
+
+    def close(self):
+        """
+            Termina los procesos usados por verify_many
+        """
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
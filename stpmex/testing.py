@@ -0,0 +1,245 @@
+"""
+Servidor SOAP local que imita a SpeiActualizaServices para pruebas de
+integración y de carga sin red. Sirve el WSDL incluido en el paquete,
+implementa registraOrden, verifica la firma con la llave pública de prueba y
+permite inyectar latencia y errores.
+
+    with FakeSTP(public_key=llave_publica, latency=0.05) as stp:
+        stpmex.configure(wsdl_path=stp.wsdl_url, wsdl_cache=False, ...)
+        orden.registra()
+"""
+import itertools
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List, Optional, Sequence, Union
+from xml.sax.saxutils import escape
+
+from lxml import etree
+
+from .base import format_amount
+from .signing import _verify, load_public_key
+
+WSDL_PATH = os.path.join(os.path.dirname(__file__), 'wsdl',
+                         'SpeiActualizaServices.wsdl')
+WSDL_ADDRESS = ('https://demo.stpmex.com:7024/speidemo/webservices/'
+                'SpeiActualizaServices')
+SOAP_NS = 'http://schemas.xmlsoap.org/soap/envelope/'
+STP_NS = 'http://h2h.integration.spei.enlacefi.lgec.com/'
+
+# Campos de la cadena original en el orden de la documentación de STP. Se
+# escriben aquí y no se toman del cliente para que la verificación de la firma
+# no dependa del mismo código que la genera
+CADENA_REGISTRA_ORDEN = (
+    'institucionContraparte', 'empresa', 'fechaOperacion', 'folioOrigen',
+    'claveRastreo', 'institucionOperante', 'monto', 'tipoPago',
+    'tipoCuentaOrdenante', 'nombreOrdenante', 'cuentaOrdenante',
+    'rfcCurpOrdenante', 'tipoCuentaBeneficiario', 'nombreBeneficiario',
+    'cuentaBeneficiario', 'rfcCurpBeneficiario', 'emailBeneficiario',
+    'tipoCuentaBeneficiario2', 'nombreBeneficiario2', 'cuentaBeneficiario2',
+    'rfcCurpBeneficiario2', 'conceptoPago', 'conceptoPago2',
+    'claveCatUsuario1', 'claveCatUsuario2', 'clavePago',
+    'referenciaCobranza', 'referenciaNumerica', 'tipoOperacion', 'topologia',
+    'usuario', 'medioEntrega', 'prioridad', 'iva')
+# Importes que STP escribe con dos decimales
+CADENA_IMPORTES = ('monto', 'iva')
+
+ERROR_FIRMA = (-22, 'Firma invalida')
+ERROR_CLAVE_DUPLICADA = (-1, 'La clave de rastreo ya fue utilizada')
+ERROR_GENERICO = (-9, 'Error validando la orden')
+
+RESPONSE_TEMPLATE = (
+    "<?xml version='1.0' encoding='UTF-8'?>"
+    f'<S:Envelope xmlns:S="{SOAP_NS}"><S:Body>'
+    f'<ns0:{{operation}}Response xmlns:ns0="{STP_NS}">'
+    '<return>{body}</return>'
+    '</ns0:{operation}Response></S:Body></S:Envelope>')
+FAULT_TEMPLATE = (
+    "<?xml version='1.0' encoding='UTF-8'?>"
+    f'<S:Envelope xmlns:S="{SOAP_NS}"><S:Body><S:Fault>'
+    '<faultcode>S:Server</faultcode><faultstring>{message}</faultstring>'
+    '</S:Fault></S:Body></S:Envelope>')
+
+
+def cadena_original(fields: dict) -> bytes:
+    """
+        Cadena original como la arma STP a partir de los campos recibidos:
+        `||campo1|campo2|...||`, un campo ausente queda vacío, los importes
+        van con dos decimales y el resto tal como llegó en el envelope
+    :param fields: Campos del envelope como texto
+    """
+    valores = []
+    for name in CADENA_REGISTRA_ORDEN:
+        value = fields.get(name)
+        if value is None:
+            value = ''
+        elif name in CADENA_IMPORTES and value != '':
+            value = format_amount(value)
+        valores.append(value)
+    return ('||' + '|'.join(valores) + '||').encode('utf-8')
+
+
+def _load_public_key(public_key):
+    if public_key is None or hasattr(public_key, 'verify'):
+        return public_key
+    return load_public_key(public_key)
+
+
+class FakeSTP:
+    """
+        Imitación local de STP.
+    :param public_key: Llave pública o certificado PEM para verificar la
+        firma. Si es None no se verifica
+    :param latency: Segundos de espera por petición, o una función sin
+        argumentos que los devuelve
+    :param error_rate: Probabilidad de responder con un descripcionError
+    :param errores: Lista de (id, descripcionError) a elegir en ese caso
+    :param fault_rate: Probabilidad de responder HTTP 500 con un SOAP Fault
+    :param start_id: Primer id asignado a las órdenes aceptadas
+    :param host: Interfaz donde escucha, por omisión sólo local
+    :param port: Puerto, por omisión uno libre
+    """
+    def __init__(self, public_key=None,
+                 latency: Union[float, Callable[[], float]] = 0,
+                 error_rate: float = 0,
+                 errores: Sequence[tuple] = (ERROR_GENERICO,),
+                 fault_rate: float = 0, start_id: int = 1,
+                 host: str = '127.0.0.1', port: int = 0):
+        self.public_key = _load_public_key(public_key)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.errores = list(errores)
+        self.fault_rate = fault_rate
+        self.ordenes: List[dict] = []
+        self._ids = itertools.count(start_id)
+        self._claves = {}
+        self._lock = threading.Lock()
+        self._random = random.Random()
+        self._server = ThreadingHTTPServer((host, port), _handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/speidemo/webservices/' \
+               f'SpeiActualizaServices'
+
+    @property
+    def wsdl_url(self) -> str:
+        return f'{self.url}?wsdl'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def wsdl(self) -> bytes:
+        with open(WSDL_PATH) as fp:
+            return fp.read().replace(WSDL_ADDRESS, self.url).encode('utf-8')
+
+    def _delay(self):
+        latency = self.latency() if callable(self.latency) else self.latency
+        if latency:
+            time.sleep(latency)
+
+    def _verify(self, fields: dict) -> bool:
+        if self.public_key is None:
+            return True
+        return _verify(self.public_key, cadena_original(fields),
+                       fields.get('firma'))
+
+    def registra_orden(self, fields: dict) -> tuple:
+        """
+            Procesa una orden recibida
+        :param fields: Campos de ordenPago como texto
+        :return: (id, descripcionError)
+        """
+        if not self._verify(fields):
+            return ERROR_FIRMA
+        if self.error_rate and self._random.random() < self.error_rate:
+            return self._random.choice(self.errores)
+        clave = fields.get('claveRastreo')
+        with self._lock:
+            if clave in self._claves:
+                return ERROR_CLAVE_DUPLICADA
+            id_ = next(self._ids)
+            self._claves[clave] = id_
+            self.ordenes.append(dict(fields, id=id_))
+        return id_, None
+
+    def handle(self, body: bytes) -> Optional[str]:
+        """
+            Procesa un envelope SOAP
+        :return: Envelope de respuesta, o None si hay que responder un Fault
+        """
+        root = etree.fromstring(body)
+        request = root.find(f'{{{SOAP_NS}}}Body')[0]
+        operation = etree.QName(request).localname
+        if operation != 'registraOrden':
+            raise ValueError(f'Unknown operation {operation}')
+        fields = _fields(request.find('ordenPago'))
+        id_, descripcion = self.registra_orden(fields)
+        body = ''
+        if descripcion is not None:
+            body += f'<descripcionError>{escape(descripcion)}' \
+                    f'</descripcionError>'
+        body += f'<id>{id_}</id>'
+        return RESPONSE_TEMPLATE.format(operation=operation, body=body)
+
+
+def _fields(element) -> dict:
+    return {etree.QName(e).localname: e.text for e in element}
+
+
+def _handler(stp: FakeSTP):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _send(self, status: int, content: bytes):
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/xml; charset=utf-8')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            if self.path.lower().endswith('?wsdl'):
+                self._send(200, stp.wsdl())
+            else:
+                self._send(404, b'')
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            stp._delay()
+            if stp.fault_rate and stp._random.random() < stp.fault_rate:
+                fault = FAULT_TEMPLATE.format(message='Internal error')
+                self._send(500, fault.encode('utf-8'))
+                return
+            try:
+                response = stp.handle(body)
+            except Exception as exc:
+                fault = FAULT_TEMPLATE.format(message=escape(str(exc)))
+                self._send(500, fault.encode('utf-8'))
+                return
+            self._send(200, response.encode('utf-8'))
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
@@ -0,0 +1,279 @@
+"""
+Transporte HTTP para el cliente de STP con pool de conexiones, keep-alive y
+tiempos límite por operación
+"""
+import functools
+import heapq
+import itertools
+import os
+import socket
+import threading
+import time
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import Timeout
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from zeep.transports import Transport
+
+from .defaults import DEFAULT_POOL_SIZE
+
+# Deadline de la petición en curso en cada hilo
+_current = threading.local()
+
+
+class _Deadline:
+    """
+        Tiempo total máximo de una petición. Al vencer cierra el socket de
+        la conexión en uso, así que la petición termina aunque el servidor
+        siga enviando bytes poco a poco, ya sea en los headers o en el
+        cuerpo
+    """
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires = None
+        self.expired = False
+        self.done = False
+        self._sockets = []
+        self._lock = threading.Lock()
+
+    def watch(self, get_socket):
+        """
+            Registra una función que devuelve el socket a cerrar, o None si
+            todavía no hay uno
+        """
+        with self._lock:
+            self._sockets.append(get_socket)
+            if self.expired:
+                _shutdown(get_socket())
+
+    def _expire(self):
+        with self._lock:
+            if self.done:
+                return
+            self.expired = True
+            for get_socket in self._sockets:
+                _shutdown(get_socket())
+
+    def __enter__(self):
+        _current.deadline = self
+        self.expires = time.monotonic() + self.seconds
+        _watchdog.add(self)
+        return self
+
+    def __exit__(self, *exc):
+        _current.deadline = None
+        with self._lock:
+            self.done = True
+            self._sockets = []
+
+
+class _Watchdog:
+    """
+        Un solo hilo vence los deadlines de todas las peticiones en curso,
+        en lugar de un Timer por petición
+    """
+    def __init__(self):
+        self._heap = []
+        self._order = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def add(self, deadline: _Deadline):
+        with self._cond:
+            heapq.heappush(
+                self._heap, (deadline.expires, next(self._order), deadline))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='stpmex-deadline', daemon=True)
+                self._thread.start()
+            elif self._heap[0][2] is deadline:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                expired = self._pop_expired()
+                while not expired:
+                    timeout = None
+                    if self._heap:
+                        timeout = self._heap[0][0] - time.monotonic()
+                    self._cond.wait(timeout)
+                    expired = self._pop_expired()
+            # Fuera del lock para no frenar a quien registra un deadline
+            for deadline in expired:
+                deadline._expire()
+
+    def _pop_expired(self) -> list:
+        now = time.monotonic()
+        expired = []
+        while self._heap and (
+                self._heap[0][0] <= now or self._heap[0][2].done):
+            deadline = heapq.heappop(self._heap)[2]
+            if not deadline.done:
+                expired.append(deadline)
+        return expired
+
+
+_watchdog = _Watchdog()
+
+
+def _reset_watchdog():
+    # El hilo no sobrevive a un fork: el proceso hijo arranca el suyo
+    global _watchdog
+    _watchdog = _Watchdog()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_watchdog)
+
+
+def _shutdown(sock):
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class _DeadlineConnectionMixin:
+    """
+        Registra en el deadline en curso el socket de la conexión. Usa sólo
+        `request`, `getresponse` y `sock`, la interfaz pública que comparten
+        http.client y urllib3
+    """
+    def request(self, *args, **kwargs):
+        deadline = getattr(_current, 'deadline', None)
+        if deadline is not None:
+            # Mientras se envía la petición el socket es el de la conexión
+            deadline.watch(lambda: getattr(self, 'sock', None))
+        return super().request(*args, **kwargs)
+
+    def getresponse(self, *args, **kwargs):
+        deadline = getattr(_current, 'deadline', None)
+        if deadline is not None:
+            # Si la respuesta cierra la conexión, http.client le pasa el
+            # socket y la conexión deja de tenerlo
+            sock = getattr(self, 'sock', None)
+            deadline.watch(lambda: sock)
+        return super().getresponse(*args, **kwargs)
+
+
+@functools.lru_cache(maxsize=None)
+def _deadline_connection(connection_cls):
+    return type(connection_cls.__name__, (_DeadlineConnectionMixin,
+                                          connection_cls), {})
+
+
+class _DeadlinePoolMixin:
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Se deriva de la clase de conexión vigente al crear el pool, que
+        # puede estar reemplazada, por ejemplo por vcrpy en las pruebas
+        self.ConnectionCls = _deadline_connection(self.ConnectionCls)
+
+
+class _HTTPConnectionPool(_DeadlinePoolMixin, HTTPConnectionPool):
+    pass
+
+
+class _HTTPSConnectionPool(_DeadlinePoolMixin, HTTPSConnectionPool):
+    pass
+
+
+POOL_CLASSES = dict(http=_HTTPConnectionPool, https=_HTTPSConnectionPool)
+
+
+class PooledAdapter(HTTPAdapter):
+    """
+        HTTPAdapter que además activa SO_KEEPALIVE en los sockets para que
+        las conexiones ociosas del pool no sean descartadas por el camino, y
+        cuyos pools permiten a StpTransport cortar una petición al vencer
+        su deadline
+    """
+    def __init__(self, keep_alive: bool = True, **kwargs):
+        self.keep_alive = keep_alive
+        super(PooledAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.keep_alive:
+            kwargs['socket_options'] = (
+                HTTPConnection.default_socket_options +
+                [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)])
+        super(PooledAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = POOL_CLASSES
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        manager = super(PooledAdapter, self).proxy_manager_for(
+            proxy, **proxy_kwargs)
+        manager.pool_classes_by_scheme = POOL_CLASSES
+        return manager
+
+
+def build_session(pool_size: int = DEFAULT_POOL_SIZE,
+                  keep_alive: bool = True, proxies: dict = None) -> Session:
+    """
+        Crea la sesión de requests usada tanto con proxy como sin él
+    :param pool_size: Conexiones que se mantienen abiertas por host
+    :param keep_alive: Reutiliza las conexiones entre peticiones
+    :param proxies: Proxies de requests, si son necesarios
+    :return: Session
+    """
+    session = Session()
+    adapter = PooledAdapter(keep_alive=keep_alive, pool_connections=pool_size,
+                            pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+    if proxies:
+        session.proxies = proxies
+    return session
+
+
+class StpTransport(Transport):
+    """
+        Transport de zeep que separa el timeout de conexión del de lectura y
+        admite un tiempo total máximo (deadline) por cada llamada al servicio
+    """
+    def __init__(self, session: Session, connect_timeout: float = None,
+                 read_timeout: float = None, deadline: float = None,
+                 **kwargs):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.deadline = deadline
+        operation_timeout = None
+        if connect_timeout is not None or read_timeout is not None:
+            operation_timeout = (connect_timeout, read_timeout)
+        super(StpTransport, self).__init__(
+            session=session, operation_timeout=operation_timeout, **kwargs)
+
+    def post(self, address, message, headers):
+        if self.deadline is None:
+            return super(StpTransport, self).post(address, message, headers)
+
+        deadline = _Deadline(self.deadline)
+        with deadline:
+            try:
+                response = self.session.post(
+                    address, data=message, headers=headers,
+                    timeout=(_cap(self.connect_timeout, self.deadline),
+                             _cap(self.read_timeout, self.deadline)))
+            except Exception as exc:
+                if deadline.expired:
+                    raise _deadline_exceeded(self.deadline, address) from exc
+                raise
+        # Un cuerpo sin Content-Length termina sin error al cerrar el socket
+        if deadline.expired:
+            raise _deadline_exceeded(self.deadline, address)
+        return response
+
+
+def _deadline_exceeded(deadline: float, address: str) -> Timeout:
+    return Timeout(f'Deadline of {deadline}s exceeded posting to {address}')
+
+
+def _cap(timeout, deadline):
+    return deadline if timeout is None else min(timeout, deadline)
@@ -53,7 +53,7 @@ class Institucion(Enum):
     BANCOPPEL = 40137
     ABCCAPITAL = 40138
     CONSUBANCO = 40140
-    VOLKSWAGEN = 40140
+    VOLKSWAGEN = 40141
     CIBANCO = 40143
     BBASE = 40145
     BANKAOOL = 40147
@@ -64,7 +64,7 @@ class Institucion(Enum):
     BANCO_FINTERRA = 40154
     ICBC = 40155
     SABADELL = 40156
-    MIZUHO_BANK = 40156
+    MIZUHO_BANK = 40158
     MONEXCB = 90600
     GBP = 90601
     MASARI = 90602
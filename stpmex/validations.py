@@ -0,0 +1,174 @@
+"""
+Reglas de validación declarativas para los recursos enviados a STP. Cada
+clase compila una sola vez sus reglas en una lista de funciones que se
+aplican directamente sobre el objeto.
+"""
+import re
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from clabe import compute_control_digit
+
+from .types import AccountType, Institucion
+
+# Imprimibles ASCII sin '|', que es el separador de la cadena original,
+# más vocales acentuadas y ñ
+VALID_CHARACTERS = re.compile(r'[ -{}~ÁÉÍÓÚÜÑáéíóúüñ]*')
+
+ACCOUNT_LENGTHS = {
+    AccountType.CLABE.value: (18,),
+    AccountType.DEBIT_CARD.value: (15, 16),
+    AccountType.PHONE_NUMBER.value: (10,),
+}
+
+INSTITUCIONES = frozenset(institucion.value for institucion in Institucion)
+
+Checker = Callable[[object], Optional[str]]
+
+
+def _empty(value) -> bool:
+    return value is None or value == ''
+
+
+def _required(field, required) -> Optional[Checker]:
+    if not required:
+        return None
+
+    def check(obj):
+        if not getattr(obj, field):
+            return f'Field {field} is required'
+    return check
+
+
+def _max_length(field, max_length) -> Checker:
+    def check(obj):
+        if max_length < len(str(getattr(obj, field))):
+            return (f'Length of field {field} must be lower than '
+                    f'{max_length}')
+    return check
+
+
+def _positive(field, positive) -> Optional[Checker]:
+    if not positive:
+        return None
+
+    def check(obj):
+        value = getattr(obj, field)
+        if _empty(value):
+            return None
+        try:
+            valid = float(value) > 0
+        except (TypeError, ValueError):
+            valid = False
+        if not valid:
+            return f'Field {field} must be greater than 0'
+    return check
+
+
+def _institucion(field, institucion) -> Optional[Checker]:
+    if not institucion:
+        return None
+
+    def check(obj):
+        value = getattr(obj, field)
+        if _empty(value):
+            return None
+        try:
+            valid = int(value) in INSTITUCIONES
+        except (TypeError, ValueError):
+            valid = False
+        if not valid:
+            return f'Field {field} is not a valid institution'
+    return check
+
+
+def _charset(field, charset) -> Optional[Checker]:
+    if not charset:
+        return None
+
+    def check(obj):
+        value = getattr(obj, field)
+        if isinstance(value, str) and not VALID_CHARACTERS.fullmatch(value):
+            return f'Field {field} has invalid characters'
+    return check
+
+
+def _cuenta(field, account_type_field) -> Checker:
+    """
+        Valida la cuenta según el tipo de cuenta indicado en otro campo. Las
+        CLABE además deben tener un dígito verificador correcto.
+    """
+    def check(obj):
+        value = getattr(obj, field)
+        if _empty(value):
+            return None
+        value = str(value)
+        try:
+            account_type = int(getattr(obj, account_type_field))
+        except (TypeError, ValueError):
+            account_type = None
+        lengths = ACCOUNT_LENGTHS.get(account_type)
+        if not value.isdigit() or (lengths and len(value) not in lengths):
+            return f'Field {field} is not a valid account'
+        if account_type == AccountType.CLABE.value and \
+                value[-1] != compute_control_digit(value):
+            return f'Field {field} has an invalid check digit'
+    return check
+
+
+RULES = dict(
+    required=_required,
+    maxLength=_max_length,
+    positive=_positive,
+    institucion=_institucion,
+    charset=_charset,
+    cuenta=_cuenta,
+)
+
+
+def compile_validations(validations: Dict[str, dict]
+                        ) -> List[Tuple[str, Checker]]:
+    """
+        Convierte el diccionario de validaciones en una lista de funciones
+    :param validations: {campo: {regla: valor}}
+    :return: Lista de (campo, función) en el orden declarado
+    """
+    checkers = []
+    for field, rules in (validations or {}).items():
+        for rule, value in rules.items():
+            try:
+                factory = RULES[rule]
+            except KeyError:
+                raise ValueError(f'Unknown validation {rule!r} for {field}')
+            checker = factory(field, value)
+            if checker is not None:
+                checkers.append((field, checker))
+    return checkers
+
+
+def errors_by_field(obj, checkers: List[Tuple[str, Checker]]
+                    ) -> Dict[str, List[str]]:
+    """
+        Aplica las reglas compiladas a un objeto
+    :return: {campo: [errores]}, vacío si el objeto es válido
+    """
+    errors = {}
+    for field, check in checkers:
+        error = check(obj)
+        if error is not None:
+            errors.setdefault(field, []).append(error)
+    return errors
+
+
+def validate_many(objs: Iterable, checkers: List[Tuple[str, Checker]]
+                  ) -> Dict[int, Dict[str, List[str]]]:
+    """
+        Valida un lote completo en una sola pasada
+    :return: {posición en el lote: {campo: [errores]}} sólo con los objetos
+        inválidos
+    """
+    report = {}
+    for i, obj in enumerate(objs):
+        errors = errors_by_field(obj, checkers)
+        if errors:
+            report[i] = errors
+    return report
@@ -0,0 +1,389 @@
+"""
+Envío de órdenes con varios procesos desde una cola local. La firma RSA y el
+XML de zeep ocupan el GIL, así que para lotes grandes cada núcleo corre su
+propio proceso con su propio StpClient: la llave se descifra y el WSDL se
+procesa una sola vez por proceso.
+
+La cola puede ser un archivo SQLite o un directorio (spool). Cada proceso
+toma un grupo de órdenes, las registra con varios hilos y escribe sus
+resultados en la misma cola:
+
+    cola = SqliteQueue('ordenes.db')
+    cola.put_many(filas)
+    Supervisor(config, 'ordenes.db', processes=4).run()
+
+Al detenerse (SIGTERM o Ctrl-C) cada proceso termina el grupo que está
+enviando y no toma otro. Si un proceso muere a la mitad, sus órdenes se
+devuelven a la cola al arrancar de nuevo y se reenvían con la misma
+claveRastreo y firma; si STP responde que la clave ya fue utilizada, la
+orden sí había salido.
+"""
+import itertools
+import json
+import multiprocessing
+import os
+import signal
+import sqlite3
+import time
+from typing import Iterable, List, NamedTuple, Sequence
+
+from .defaults import DEFAULT_MAX_WORKERS
+from .retry import respuesta_reenvio
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_POLL_INTERVAL = 1.0
+# SpoolQueue.claim lee a lo más este múltiplo de las órdenes pedidas
+SPOOL_WINDOW = 4
+
+PENDIENTE = 'pendiente'
+ENVIANDO = 'enviando'
+REGISTRADA = 'registrada'
+# Un reenvío que STP rechazó por clave duplicada: el envío anterior llegó
+DUPLICADA = 'duplicada'
+ERROR = 'error'
+
+
+class Tarea(NamedTuple):
+    key: object
+    orden: dict
+    # La orden ya se había tomado antes y pudo haber llegado a STP
+    reenvio: bool
+
+
+def normaliza(fila: dict) -> dict:
+    """
+        Completa una fila con los valores por omisión de Orden. La
+        claveRastreo y la referencia generadas se guardan en la cola, así un
+        reenvío lleva los mismos datos
+    :raises TypeError: si la fila tiene campos que no son de Orden
+    """
+    from .ordenes import Orden
+
+    orden = Orden(**{k: v for k, v in fila.items() if v not in ('', None)})
+    return {name: getattr(orden, name) for name in orden.__fieldnames__
+            if getattr(orden, name) is not None}
+
+
+class SqliteQueue:
+    """
+        Cola en un archivo SQLite, compartida por varios procesos
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS ordenes ('
+            ' id INTEGER PRIMARY KEY,'
+            ' orden TEXT NOT NULL,'
+            f" estado TEXT NOT NULL DEFAULT '{PENDIENTE}',"
+            ' intentos INTEGER NOT NULL DEFAULT 0,'
+            ' stp_id INTEGER,'
+            ' descripcionError TEXT,'
+            ' error TEXT)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS ordenes_estado '
+                         'ON ordenes (estado, id)')
+
+    def put_many(self, filas: Iterable[dict]) -> int:
+        """
+            Encola órdenes
+        :return: Número de órdenes encoladas
+        """
+        rows = [(json.dumps(normaliza(fila), default=str),)
+                for fila in filas]
+        with self._transaction():
+            self._db.executemany('INSERT INTO ordenes (orden) VALUES (?)',
+                                 rows)
+        return len(rows)
+
+    def put(self, fila: dict):
+        self.put_many([fila])
+
+    def _transaction(self):
+        return _Transaction(self._db)
+
+    def claim(self, n: int) -> List[Tarea]:
+        """
+            Toma hasta `n` órdenes pendientes
+        """
+        with self._transaction():
+            rows = self._db.execute(
+                'SELECT id, orden, intentos FROM ordenes WHERE estado = ? '
+                'ORDER BY id LIMIT ?', (PENDIENTE, n)).fetchall()
+            self._db.executemany(
+                'UPDATE ordenes SET estado = ?, intentos = intentos + 1 '
+                'WHERE id = ?', [(ENVIANDO, row[0]) for row in rows])
+        return [Tarea(id_, json.loads(orden), intentos > 0)
+                for id_, orden, intentos in rows]
+
+    def complete_many(self, resultados: Sequence[tuple]):
+        """
+            Guarda el resultado de cada tarea
+        :param resultados: Pares (Tarea, Resultado)
+        """
+        rows = [(_estado(resultado), resultado.id,
+                 resultado.descripcionError, _error(resultado.error),
+                 tarea.key) for tarea, resultado in resultados]
+        with self._transaction():
+            self._db.executemany(
+                'UPDATE ordenes SET estado = ?, stp_id = ?, '
+                'descripcionError = ?, error = ? WHERE id = ?', rows)
+
+    def recover(self) -> int:
+        """
+            Devuelve a la cola las órdenes que un proceso tomó y no terminó.
+            Sólo se debe llamar sin procesos trabajando
+        :return: Número de órdenes devueltas
+        """
+        with self._transaction():
+            return self._db.execute(
+                'UPDATE ordenes SET estado = ? WHERE estado = ?',
+                (PENDIENTE, ENVIANDO)).rowcount
+
+    def counts(self) -> dict:
+        return dict(self._db.execute(
+            'SELECT estado, count(*) FROM ordenes GROUP BY estado'))
+
+    def close(self):
+        self._db.close()
+
+
+class _Transaction:
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        # Toma el lock de escritura desde el inicio para que dos procesos no
+        # elijan las mismas órdenes
+        self.db.execute('BEGIN IMMEDIATE')
+
+    def __exit__(self, exc_type, *exc):
+        self.db.execute('ROLLBACK' if exc_type else 'COMMIT')
+
+
+class SpoolQueue:
+    """
+        Cola en un directorio: un archivo JSON por orden. Tomar una orden es
+        moverla de `pendientes/` a `enviando/`, que es atómico en el mismo
+        sistema de archivos, y su resultado se escribe en `resultados/`
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.pendientes = os.path.join(path, 'pendientes')
+        self.enviando = os.path.join(path, 'enviando')
+        self.resultados = os.path.join(path, 'resultados')
+        for directory in (self.pendientes, self.enviando, self.resultados):
+            os.makedirs(directory, exist_ok=True)
+        self._counter = itertools.count()
+
+    def _write(self, path: str, data: dict):
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump(data, fp, default=str)
+        os.replace(tmp, path)
+
+    def put_many(self, filas: Iterable[dict]) -> int:
+        n = 0
+        for fila in filas:
+            # El nombre conserva el orden de llegada
+            name = f'{time.time_ns():020d}-{os.getpid()}-' \
+                   f'{next(self._counter):06d}.json'
+            self._write(os.path.join(self.pendientes, name),
+                        dict(orden=normaliza(fila), reenvio=False))
+            n += 1
+        return n
+
+    def put(self, fila: dict):
+        self.put_many([fila])
+
+    def claim(self, n: int) -> List[Tarea]:
+        """
+            Toma hasta `n` órdenes pendientes. No se lista todo el
+            directorio: se leen a lo más `SPOOL_WINDOW * n` entradas, en el
+            orden del sistema de archivos, y se toman en orden de llegada.
+            Las de más sirven cuando otro proceso toma alguna primero
+        """
+        with os.scandir(self.pendientes) as entries:
+            names = sorted(itertools.islice(
+                (entry.name for entry in entries
+                 if entry.name.endswith('.json')), SPOOL_WINDOW * n))
+        tareas = []
+        for name in names:
+            destino = os.path.join(self.enviando, name)
+            try:
+                os.rename(os.path.join(self.pendientes, name), destino)
+            except FileNotFoundError:
+                # Otro proceso la tomó primero
+                continue
+            with open(destino) as fp:
+                data = json.load(fp)
+            tareas.append(Tarea(name, data['orden'], data['reenvio']))
+            if len(tareas) >= n:
+                break
+        return tareas
+
+    def complete_many(self, resultados: Sequence[tuple]):
+        for tarea, resultado in resultados:
+            self._write(os.path.join(self.resultados, tarea.key), dict(
+                claveRastreo=tarea.orden.get('claveRastreo'),
+                estado=_estado(resultado), id=resultado.id,
+                descripcionError=resultado.descripcionError,
+                error=_error(resultado.error)))
+            os.remove(os.path.join(self.enviando, tarea.key))
+
+    def recover(self) -> int:
+        n = 0
+        for name in os.listdir(self.enviando):
+            path = os.path.join(self.enviando, name)
+            with open(path) as fp:
+                data = json.load(fp)
+            self._write(path, dict(data, reenvio=True))
+            os.rename(path, os.path.join(self.pendientes, name))
+            n += 1
+        return n
+
+    def counts(self) -> dict:
+        return {PENDIENTE: len(os.listdir(self.pendientes)),
+                ENVIANDO: len(os.listdir(self.enviando)),
+                'resultados': len(os.listdir(self.resultados))}
+
+    def close(self):
+        pass
+
+
+def open_queue(path: str):
+    """
+        SpoolQueue si `path` es un directorio, si no SqliteQueue
+    """
+    if os.path.isdir(path) or path.endswith(os.sep):
+        return SpoolQueue(path)
+    return SqliteQueue(path)
+
+
+def _estado(resultado) -> str:
+    if getattr(resultado, 'duplicada', False):
+        return DUPLICADA
+    if resultado.error is not None or resultado.descripcionError:
+        return ERROR
+    return REGISTRADA
+
+
+def _error(error) -> object:
+    return None if error is None else f'{type(error).__name__}: {error}'
+
+
+def procesa(client, queue, tareas: List[Tarea],
+            threads: int = DEFAULT_MAX_WORKERS):
+    """
+        Registra un grupo de tareas con `client` y guarda sus resultados
+    """
+    from .batch import orden_de_fila
+
+    ordenes = [orden_de_fila(tarea.orden) for tarea in tareas]
+    resultados = []
+    for tarea, resultado in zip(tareas,
+                                client.registra_many(ordenes, threads)):
+        if tarea.reenvio:
+            resultado = respuesta_reenvio(resultado)
+        resultados.append((tarea, resultado))
+    queue.complete_many(resultados)
+    return len(resultados)
+
+
+def _work(client_config: dict, queue_path: str, stop, threads: int,
+          batch_size: int, poll_interval: float, drain: bool):
+    # Ctrl-C, y el SIGTERM de systemd o de `kill` al grupo, llegan a todos
+    # los procesos; sólo el supervisor los atiende y avisa con `stop`, así
+    # que un proceso nunca se detiene a la mitad de un grupo
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    from .client import StpClient
+
+    client = StpClient(**client_config)
+    queue = open_queue(queue_path)
+    try:
+        while not stop.is_set():
+            tareas = queue.claim(batch_size)
+            if not tareas:
+                if drain:
+                    return
+                stop.wait(poll_interval)
+                continue
+            procesa(client, queue, tareas, threads)
+    finally:
+        queue.close()
+        client.close()
+
+
+class Supervisor:
+    """
+        Arranca y detiene los procesos que consumen la cola
+    :param client_config: Argumentos de StpClient para cada proceso
+    :param queue_path: Archivo SQLite o directorio spool
+    :param processes: Procesos, por omisión uno por núcleo
+    :param threads: Peticiones simultáneas a STP por proceso
+    :param batch_size: Órdenes que toma cada proceso a la vez
+    :param poll_interval: Segundos de espera cuando la cola está vacía
+    :param drain: Terminar en cuanto la cola esté vacía
+    """
+    def __init__(self, client_config: dict, queue_path: str,
+                 processes: int = None, threads: int = DEFAULT_MAX_WORKERS,
+                 batch_size: int = DEFAULT_BATCH_SIZE,
+                 poll_interval: float = DEFAULT_POLL_INTERVAL,
+                 drain: bool = False):
+        self.client_config = client_config
+        self.queue_path = queue_path
+        self.processes = processes or os.cpu_count() or 1
+        self.threads = threads
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.drain = drain
+        self._context = multiprocessing.get_context('spawn')
+        self._stop = self._context.Event()
+        self._procs = []
+
+    def start(self):
+        """
+            Devuelve a la cola lo que quedó a medias y arranca los procesos
+        """
+        queue = open_queue(self.queue_path)
+        try:
+            queue.recover()
+        finally:
+            queue.close()
+        for _ in range(self.processes):
+            proc = self._context.Process(
+                target=_work, args=(
+                    self.client_config, self.queue_path, self._stop,
+                    self.threads, self.batch_size, self.poll_interval,
+                    self.drain))
+            proc.start()
+            self._procs.append(proc)
+        return self
+
+    def stop(self):
+        """
+            Pide a los procesos que terminen su grupo actual y se detengan
+        """
+        self._stop.set()
+
+    def join(self, timeout: float = None):
+        for proc in self._procs:
+            proc.join(timeout)
+        return all(proc.exitcode is not None for proc in self._procs)
+
+    def run(self):
+        """
+            Arranca los procesos y espera a que terminen; SIGTERM y SIGINT
+            los detienen de forma ordenada
+        """
+        self.start()
+        handlers = {sig: signal.signal(sig, lambda *_: self.stop())
+                    for sig in (signal.SIGTERM, signal.SIGINT)}
+        try:
+            self.join()
+        finally:
+            for sig, handler in handlers.items():
+                signal.signal(sig, handler)
+        return [proc.exitcode for proc in self._procs]
@@ -1,9 +1,13 @@
 import pytest
 import stpmex
+from stpmex import Orden
+from stpmex.signing import load_private_key
+from stpmex.testing import FakeSTP
+from stpmex.types import Institucion
 
 
 @pytest.fixture
-def initialize_stpmex():
+def stpmex_config():
     pkey = ('Bag Attributes\n    friendlyName: prueba\n    localKeyID:'
             ' 54 69 6D 65 20 31 33 32 34 35 39 35 30 31 35 33 '
             '33 30 \nKey Attributes: <No Attributes>\n'
@@ -31,13 +35,37 @@ def initialize_stpmex():
             '+BdiDjPOhSRuoa1ypilODdpOGKNKuf0vu2jAbbzDILBYOfw\n'
             '-----END ENCRYPTED PRIVATE KEY-----\n ')
 
-    wsdl = ('https://demo.stpmex.com:7024/speidemo/webservices/'
-            'SpeiActualizaServices?wsdl')
     pkey_passphrase = '12345678'
 
     empresa = 'TAMIZI'
     prefijo = 1570
-    stpmex.configure(wsdl_path=wsdl, empresa=empresa, priv_key=pkey,
-                     priv_key_passphrase=pkey_passphrase,
-                     prefijo=prefijo, proxy=None, proxy_user=None,
-                     proxy_password=None)
+    return dict(wsdl_path=stpmex.BUNDLED_WSDL, empresa=empresa,
+                priv_key=pkey, priv_key_passphrase=pkey_passphrase,
+                prefijo=prefijo, proxy=None, proxy_user=None,
+                proxy_password=None)
+
+
+@pytest.fixture
+def initialize_stpmex(stpmex_config):
+    stpmex.configure(**stpmex_config)
+
+
+@pytest.fixture
+def get_order():
+    return Orden(
+        conceptoPago='Prueba',
+        institucionOperante=Institucion.STP.value,
+        cuentaBeneficiario='072691004495711499',
+        institucionContraparte=Institucion.BANORTE.value,
+        monto=1.2,
+        nombreBeneficiario='Ricardo Sanchez')
+
+
+@pytest.fixture
+def fake_stp(stpmex_config):
+    key = load_private_key(stpmex_config['priv_key'],
+                           stpmex_config['priv_key_passphrase'])
+    with FakeSTP(public_key=key.public_key()) as stp:
+        stpmex_config.update(wsdl_path=stp.wsdl_url, wsdl_cache=False)
+        stpmex.configure(**stpmex_config)
+        yield stp
@@ -0,0 +1,196 @@
+import csv
+import itertools
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from stpmex import Orden
+from stpmex.batch import procesa_archivo
+
+FILA = dict(
+    conceptoPago='Prueba',
+    institucionOperante='90646',
+    cuentaBeneficiario='072691004495711499',
+    institucionContraparte='40072',
+    monto='1.20',
+    nombreBeneficiario='Ricardo Sanchez',
+)
+
+
+@pytest.fixture
+def enviadas(initialize_stpmex, monkeypatch):
+    enviadas = []
+    ids = itertools.count(1)
+
+    def invoke(orden, method):
+        enviadas.append(orden.claveRastreo)
+        return SimpleNamespace(id=next(ids), descripcionError=None)
+
+    monkeypatch.setattr(Orden, '_invoke_method', invoke)
+    return enviadas
+
+
+def _filas(n):
+    filas = [dict(FILA, claveRastreo=f'CR{i}') for i in range(n)]
+    filas[2]['cuentaBeneficiario'] = '072691004495711490'
+    return filas
+
+
+def test_procesa_csv(tmpdir, enviadas):
+    path = str(tmpdir.join('payouts.csv'))
+    with open(path, 'w', newline='') as fp:
+        writer = csv.DictWriter(fp, list(FILA) + ['claveRastreo'])
+        writer.writeheader()
+        writer.writerows(_filas(5))
+
+    resumen = procesa_archivo(path, max_workers=2)
+    assert resumen == dict(registradas=4, errores=1, omitidas=0)
+    with open(str(tmpdir.join('payouts.resultados.csv'))) as fp:
+        resultados = list(csv.DictReader(fp))
+    assert [r['claveRastreo'] for r in resultados] == \
+        [f'CR{i}' for i in range(5)]
+    assert [r['fila'] for r in resultados] == ['1', '2', '3', '4', '5']
+    assert 'check digit' in resultados[2]['error']
+    assert resultados[2]['id'] == ''
+    assert sorted(enviadas) == ['CR0', 'CR1', 'CR3', 'CR4']
+
+
+def test_procesa_jsonl_resume(tmpdir, enviadas):
+    path = str(tmpdir.join('payouts.jsonl'))
+    results = str(tmpdir.join('resultados.jsonl'))
+    filas = _filas(6)
+    filas[4]['campoInexistente'] = 'x'
+    with open(path, 'w') as fp:
+        for fila in filas:
+            fp.write(json.dumps(fila) + '\n')
+    # Ejecución interrumpida después de registrar las primeras dos filas
+    with open(results, 'w') as fp:
+        for i in range(2):
+            fp.write(json.dumps(dict(fila=i + 1, claveRastreo=f'CR{i}',
+                                     id=i + 1)) + '\n')
+
+    resumen = procesa_archivo(path, results_path=results)
+    assert resumen == dict(registradas=2, errores=2, omitidas=2)
+    assert sorted(enviadas) == ['CR3', 'CR5']
+    with open(results) as fp:
+        resultados = [json.loads(line) for line in fp]
+    assert [r['fila'] for r in resultados] == [1, 2, 3, 4, 5, 6]
+    assert 'campoInexistente' in resultados[4]['error']
+    assert resultados[4]['claveRastreo'] is None
+
+
+def test_procesa_sin_resume(tmpdir, enviadas):
+    path = str(tmpdir.join('payouts.jsonl'))
+    results = str(tmpdir.join('resultados.jsonl'))
+    with open(path, 'w') as fp:
+        fp.write(json.dumps(dict(FILA, claveRastreo='CR1')) + '\n')
+    procesa_archivo(path, results_path=results)
+    resumen = procesa_archivo(path, results_path=results, resume=False)
+    assert resumen == dict(registradas=1, errores=0, omitidas=0)
+    assert enviadas == ['CR1', 'CR1']
+
+
+@pytest.fixture
+def stp(initialize_stpmex, monkeypatch):
+    registradas = {}
+    envios = []
+    fallas = {}
+
+    def invoke(orden, method):
+        envios.append(orden.claveRastreo)
+        if orden.claveRastreo in registradas:
+            return SimpleNamespace(
+                id=-1, descripcionError=(
+                    f'La clave de rastreo {orden.claveRastreo} ya fue '
+                    'utilizada'))
+        registradas[orden.claveRastreo] = len(registradas) + 1
+        if len(envios) in fallas:
+            # La orden llegó a STP pero el proceso se interrumpe
+            raise fallas[len(envios)]
+        return SimpleNamespace(id=registradas[orden.claveRastreo],
+                               descripcionError=None)
+
+    monkeypatch.setattr(Orden, '_invoke_method', invoke)
+    return SimpleNamespace(registradas=registradas, envios=envios,
+                           fallas=fallas)
+
+
+def test_resume_reutiliza_claves(tmpdir, stp):
+    path = str(tmpdir.join('payouts.jsonl'))
+    results = str(tmpdir.join('resultados.jsonl'))
+    # Sin claveRastreo: se generan al enviar
+    with open(path, 'w') as fp:
+        for _ in range(8):
+            fp.write(json.dumps(FILA) + '\n')
+    stp.fallas[3] = KeyboardInterrupt()
+    with pytest.raises(KeyboardInterrupt):
+        procesa_archivo(path, results_path=results, max_workers=2)
+    assert os.path.exists(results + '.claves')
+    del stp.fallas[3]
+
+    resumen = procesa_archivo(path, results_path=results, max_workers=2)
+    assert resumen['registradas'] + resumen['omitidas'] == 8
+    with open(results) as fp:
+        resultados = [json.loads(line) for line in fp]
+    assert sorted(r['fila'] for r in resultados) == list(range(1, 9))
+    # Ninguna fila se registró con dos claves distintas
+    assert len(stp.registradas) == 8
+    assert {r['claveRastreo'] for r in resultados} == set(stp.registradas)
+    # Las que llegaron a STP antes de interrumpirse quedan como duplicadas
+    duplicadas = [r for r in resultados if r['duplicada']]
+    assert duplicadas and all(r['id'] is None for r in duplicadas)
+    assert not os.path.exists(results + '.claves')
+
+
+def test_resume_fila_cortada(tmpdir, stp):
+    path = str(tmpdir.join('payouts.csv'))
+    results = str(tmpdir.join('payouts.resultados.csv'))
+    with open(path, 'w', newline='') as fp:
+        writer = csv.DictWriter(fp, list(FILA) + ['claveRastreo'])
+        writer.writeheader()
+        writer.writerows(dict(FILA, claveRastreo=f'CR{i}') for i in range(4))
+    with open(results, 'w', newline='') as fp:
+        fp.write('fila,claveRastreo,id,descripcionError,error\r\n'
+                 '1,CR0,1,,\r\n'
+                 '3,CR2,3,,\r\n'
+                 '2,CR1,')
+
+    resumen = procesa_archivo(path)
+    assert resumen == dict(registradas=2, errores=0, omitidas=2)
+    assert sorted(stp.envios) == ['CR1', 'CR3']
+    with open(results) as fp:
+        resultados = list(csv.DictReader(fp))
+    assert [r['fila'] for r in resultados] == ['1', '3', '2', '4']
+    assert [r['claveRastreo'] for r in resultados] == \
+        ['CR0', 'CR2', 'CR1', 'CR3']
+
+
+def test_resume_solo_descarta_el_final(tmpdir, stp):
+    path = str(tmpdir.join('payouts.jsonl'))
+    results = str(tmpdir.join('resultados.jsonl'))
+    with open(path, 'w') as fp:
+        for _ in range(4):
+            fp.write(json.dumps(FILA) + '\n')
+    completas = json.dumps(dict(fila=1, claveRastreo='CR1', id=1)) + '\n'
+    with open(results, 'w') as fp:
+        fp.write(completas + '{"fila": 2, "claveRa')
+    # Las filas 2 y 3 ya tenían claves; la de la 4 quedó a medias
+    with open(results + '.claves', 'w') as fp:
+        for fila in (1, 2, 3):
+            fp.write(json.dumps(dict(fila=fila, claveRastreo=f'CR{fila}',
+                                     referenciaNumerica=fila)) + '\n')
+        fp.write('{"fila": 4, "clave')
+    stp.registradas['CR2'] = 2
+
+    resumen = procesa_archivo(path, results_path=results, max_workers=2)
+    assert resumen == dict(registradas=3, errores=0, omitidas=1)
+    assert len(stp.envios) == 3 and {'CR2', 'CR3'} <= set(stp.envios)
+    with open(results) as fp:
+        contenido = fp.read()
+    assert contenido.startswith(completas)
+    resultados = [json.loads(line) for line in contenido.splitlines()]
+    assert [r['fila'] for r in resultados] == [1, 2, 3, 4]
+    assert resultados[1]['duplicada'] is True
+    assert resultados[3]['claveRastreo'] not in ('CR1', 'CR2', 'CR3')
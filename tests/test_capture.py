@@ -0,0 +1,96 @@
+import asyncio
+import json
+
+import pytest
+from zeep.exceptions import Fault
+
+import stpmex
+from stpmex import base
+from stpmex.capture import REDACTED, Capture
+from stpmex.client import StpClient
+
+ORDEN = dict(conceptoPago='Prueba', institucionOperante=90646,
+             cuentaBeneficiario='072691004495711499',
+             institucionContraparte=40072, monto=1.2,
+             nombreBeneficiario='Ricardo Sanchez')
+
+
+@pytest.mark.parametrize('fast_envelope', [False, True])
+def test_captura_errores(fake_stp, stpmex_config, fast_envelope):
+    capture = Capture(size=10)
+    client = StpClient(**stpmex_config, fast_envelope=fast_envelope,
+                       capture=capture)
+    client.orden(claveRastreo='CR1', **ORDEN).registra()
+    assert not len(capture)
+    resp = client.orden(claveRastreo='CR1', **ORDEN).registra()
+    assert resp.id == -1
+    exchange, = capture.exchanges()
+    assert exchange.operation == 'registraOrden'
+    assert exchange.claveRastreo == 'CR1'
+    assert exchange.status == 200
+    assert 'La clave de rastreo ya fue utilizada' in exchange.response
+    assert f'firma>{REDACTED}</' in exchange.request
+    assert '**************1499</' in exchange.request
+    assert '072691004495711499' not in exchange.request
+    assert exchange.error is None
+    client.close()
+
+
+def test_captura_fault_y_limite(fake_stp, stpmex_config):
+    fake_stp.fault_rate = 1
+    capture = Capture(size=3)
+    stpmex.configure(**stpmex_config, capture=capture)
+    assert base.HISTORY is capture
+    for i in range(5):
+        with pytest.raises(Fault):
+            stpmex.Orden(claveRastreo=f'CR{i}', **ORDEN).registra()
+    assert capture.captured == 5
+    assert [e.claveRastreo for e in capture.exchanges()] == ['CR2', 'CR3',
+                                                             'CR4']
+    assert all(e.status == 500 and e.error.startswith('Fault')
+               for e in capture.exchanges())
+
+
+def test_muestreo_y_debug_mode(fake_stp, stpmex_config, monkeypatch):
+    capture = Capture(sample_rate=1)
+    client = StpClient(**stpmex_config, capture=capture)
+    client.orden(**ORDEN).registra()
+    assert len(capture) == 1
+    capture.sample_rate = 0
+    client.orden(**ORDEN).registra()
+    assert len(capture) == 1
+    monkeypatch.setattr(base, 'DEBUG_MODE', True)
+    asyncio.run(client.orden(**ORDEN).registra_async())
+    assert len(capture) == 2
+    client.close()
+
+
+def test_history_sin_captura_del_cliente(fake_stp, stpmex_config,
+                                         monkeypatch):
+    capture = Capture()
+    monkeypatch.setattr(base, 'HISTORY', capture)
+    client = StpClient(**stpmex_config)
+    fake_stp.error_rate = 1
+    client.orden(**ORDEN).registra()
+    assert len(capture) == 1
+    client.close()
+
+
+def test_export(tmpdir):
+    capture = Capture(size=2, mask=())
+    for i in range(3):
+        capture.record('registraOrden', None,
+                       f'<ns0:firma a="1">abc{i}</ns0:firma>'
+                       f'<cuentaBeneficiario>123</cuentaBeneficiario>',
+                       None, None, ValueError('x'), 0.1)
+    path = str(tmpdir.join('captura.jsonl'))
+    assert capture.export(path, clear=True) == 2
+    assert not len(capture)
+    with open(path) as fp:
+        rows = [json.loads(line) for line in fp]
+    assert rows[0]['request'] == (
+        f'<ns0:firma a="1">{REDACTED}</ns0:firma>'
+        '<cuentaBeneficiario>123</cuentaBeneficiario>')
+    assert rows[1]['error'] == 'ValueError: x'
+    with pytest.raises(ValueError):
+        Capture(sample_rate=2)
@@ -0,0 +1,100 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import stpmex
+from stpmex import Orden, StpClient
+from stpmex.signing import load_private_key
+from stpmex.testing import FakeSTP
+from stpmex.types import Institucion
+
+ORDEN = dict(
+    conceptoPago='Prueba',
+    institucionOperante=Institucion.STP.value,
+    cuentaBeneficiario='072691004495711499',
+    institucionContraparte=Institucion.BANORTE.value,
+    monto=1.2,
+    nombreBeneficiario='Ricardo Sanchez')
+
+
+@pytest.fixture
+def servidores(stpmex_config):
+    key = load_private_key(stpmex_config['priv_key'],
+                           stpmex_config['priv_key_passphrase'])
+    with FakeSTP(public_key=key.public_key()) as uno, \
+            FakeSTP(public_key=key.public_key(), start_id=1000) as dos:
+        yield uno, dos
+
+
+def _cliente(stpmex_config, empresa, stp):
+    config = dict(stpmex_config, empresa=empresa, wsdl_path=stp.wsdl_url,
+                  wsdl_cache=False)
+    return StpClient(**config)
+
+
+def test_clientes_simultaneos(stpmex_config, servidores):
+    uno, dos = servidores
+    clientes = [_cliente(stpmex_config, 'EMPRESA1', uno),
+                _cliente(stpmex_config, 'EMPRESA2', dos)]
+    ordenes = [clientes[i % 2].orden(**ORDEN) for i in range(20)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        respuestas = list(executor.map(Orden.registra, ordenes))
+    assert all(r.descripcionError is None for r in respuestas)
+    assert {o['empresa'] for o in uno.ordenes} == {'EMPRESA1'}
+    assert {o['empresa'] for o in dos.ordenes} == {'EMPRESA2'}
+    assert len(uno.ordenes) == len(dos.ordenes) == 10
+    for cliente in clientes:
+        cliente.close()
+
+
+def test_cliente_no_depende_de_configure(stpmex_config, servidores):
+    uno, dos = servidores
+    cliente = _cliente(stpmex_config, 'EMPRESA1', uno)
+    stpmex.configure(**dict(stpmex_config, wsdl_path=dos.wsdl_url,
+                            wsdl_cache=False))
+    orden = Orden(**ORDEN)
+    assert orden.empresa == 'TAMIZI'
+    resp = cliente.registra(Orden(**ORDEN))
+    assert resp.id == 1
+    assert uno.ordenes[0]['empresa'] == 'EMPRESA1'
+    # Una orden sin cliente usa el de configure()
+    assert orden.registra().id == 1000
+    assert dos.ordenes[0]['empresa'] == 'TAMIZI'
+
+
+def test_cliente_registra_many_y_async(stpmex_config, servidores):
+    uno, _ = servidores
+    cliente = _cliente(stpmex_config, 'EMPRESA1', uno)
+    ordenes = [Orden(**ORDEN) for _ in range(3)]
+    firmas = cliente.firma_many(ordenes)
+    assert firmas == [o.firma for o in ordenes]
+    resultados = cliente.registra_many(ordenes, max_workers=2)
+    assert sorted(r.id for r in resultados) == [1, 2, 3]
+    resp = asyncio.run(cliente.registra_async(cliente.orden(**ORDEN)))
+    assert resp.id == 4
+    http = cliente._async_http
+    cliente.close()
+    assert http.is_closed
+
+
+def test_cliente_aclose(stpmex_config, servidores):
+    uno, _ = servidores
+    cliente = _cliente(stpmex_config, 'EMPRESA1', uno)
+
+    async def registra():
+        resp = await cliente.registra_async(cliente.orden(**ORDEN))
+        http = cliente._async_http
+        await cliente.aclose()
+        return resp, http
+
+    resp, http = asyncio.run(registra())
+    assert resp.id == 1
+    assert http.is_closed
+    assert cliente._async_http is None
+
+
+def test_sin_configurar(monkeypatch):
+    monkeypatch.setattr(stpmex.base, 'DEFAULT_CLIENT', None)
+    with pytest.raises(RuntimeError):
+        Orden(**ORDEN).registra()
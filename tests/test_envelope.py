@@ -0,0 +1,122 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from zeep.exceptions import Fault
+from zeep.wsdl.utils import etree_to_string
+
+import stpmex
+from stpmex import Orden
+from stpmex.envelope import EnvelopeTemplate, Respuesta
+from stpmex.testing import FAULT_TEMPLATE, RESPONSE_TEMPLATE
+from stpmex.types import Institucion
+
+ORDENES = [
+    dict(),
+    dict(conceptoPago='Pago <&> "uno" \'dos\' ]]> ñÁ', iva=0.16,
+         nombreOrdenante='Linea\r\nnueva\ttab'),
+    dict(monto='121.00', institucionContraparte='40072', tipoPago='1',
+         referenciaNumerica=1234567, fechaOperacion=20200101, iva='',
+         emailBeneficiario='', cuentaOrdenante='646180157000000004'),
+    dict(monto=1234567.891, conceptoPago2='x' * 200, prioridad=0),
+]
+
+
+@pytest.fixture
+def template(initialize_stpmex):
+    service = stpmex.base.DEFAULT_CLIENT.service
+    return EnvelopeTemplate.build(service, 'registraOrden')
+
+
+def _orden(**kwargs):
+    orden = Orden(**dict(dict(
+        conceptoPago='Prueba',
+        institucionOperante=Institucion.STP.value,
+        cuentaBeneficiario='072691004495711499',
+        institucionContraparte=Institucion.BANORTE.value,
+        monto=1.2,
+        nombreBeneficiario='Ricardo Sanchez'), **kwargs))
+    orden.firma = 'dGVzdA=='
+    return orden
+
+
+@pytest.mark.parametrize('campos', ORDENES)
+def test_envelope_igual_a_zeep(template, campos):
+    orden = _orden(**campos)
+    service = stpmex.base.DEFAULT_CLIENT.service
+    envelope, headers = orden._build_envelope(service, 'registraOrden')
+    assert template.render(orden) == etree_to_string(envelope)
+    assert template.headers == headers
+
+
+def test_caracteres_invalidos(template):
+    orden = _orden(conceptoPago='Prueba\x00')
+    with pytest.raises(ValueError):
+        template.render(orden)
+
+
+def test_otras_operaciones(initialize_stpmex):
+    service = stpmex.base.DEFAULT_CLIENT.service
+    assert EnvelopeTemplate.build(service, 'otraOperacion') is None
+
+
+def test_parse(template):
+    def response(body, status_code=200):
+        return SimpleNamespace(status_code=status_code, headers={},
+                               content=body.encode('utf-8'), encoding=None)
+
+    ok = RESPONSE_TEMPLATE.format(operation='registraOrden',
+                                  body='<id>123</id>')
+    assert template.parse(response(ok)) == Respuesta(123, None)
+    error = RESPONSE_TEMPLATE.format(
+        operation='registraOrden',
+        body='<descripcionError>Cuenta &lt;invalida&gt;</descripcionError>'
+             '<id>-9</id>')
+    assert template.parse(response(error)) == \
+        Respuesta(-9, 'Cuenta <invalida>')
+    fault = FAULT_TEMPLATE.format(message='Internal error')
+    with pytest.raises(Fault):
+        template.parse(response(fault, 500))
+
+
+def test_registra_fast_envelope(fake_stp, stpmex_config):
+    stpmex.configure(fast_envelope=True, **stpmex_config)
+    orden = _orden()
+    resp = orden.registra()
+    assert resp == Respuesta(1, None)
+    assert fake_stp.ordenes[0]['claveRastreo'] == orden.claveRastreo
+    fake_stp.error_rate = 1
+    assert _orden().registra().descripcionError == 'Error validando la orden'
+    fake_stp.error_rate = 0
+    fake_stp.fault_rate = 1
+    with pytest.raises(Fault):
+        _orden().registra()
+
+
+def test_registra_async_fast_envelope(fake_stp, stpmex_config):
+    stpmex.configure(fast_envelope=True, **stpmex_config)
+    resp = asyncio.run(_orden().registra_async())
+    assert resp == Respuesta(1, None)
+
+
+def test_template_compartido(fake_stp, stpmex_config):
+    stpmex.configure(fast_envelope=True, **stpmex_config)
+    client = stpmex.base.DEFAULT_CLIENT
+    template = client.get_template(client.service, 'registraOrden')
+    assert template is client.get_template(client.get_async_service(),
+                                           'registraOrden')
+    client.close()
+
+
+def test_registra_async_sin_fast_envelope(fake_stp, stpmex_config,
+                                          monkeypatch):
+    stpmex.configure(fast_envelope=True, **stpmex_config)
+    monkeypatch.setattr(Orden, '_fast_envelope', False)
+
+    def get_template(service, method):
+        raise AssertionError('template con _fast_envelope = False')
+
+    monkeypatch.setattr(stpmex.base.DEFAULT_CLIENT, 'get_template',
+                        get_template)
+    resp = asyncio.run(_orden().registra_async())
+    assert resp.id == 1
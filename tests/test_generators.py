@@ -0,0 +1,142 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+import stpmex
+from stpmex import Orden
+from stpmex.generators import (ClaveRastreoGenerator, ClaveRastreoIndex,
+                               ReferenciaNumericaGenerator, node_id)
+
+
+def test_clave_rastreo_unique():
+    generator = ClaveRastreoGenerator()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        claves = list(executor.map(lambda _: generator(), range(50_000)))
+    assert len(set(claves)) == len(claves)
+    assert max(len(clave) for clave in claves) <= 30
+    assert all(clave.startswith('CR') for clave in claves)
+
+
+def test_clave_rastreo_nodes():
+    a = ClaveRastreoGenerator(node=1)
+    b = ClaveRastreoGenerator(node=2)
+    b.start = a.start
+    b.reset(2)
+    claves = {a() for _ in range(1000)} | {b() for _ in range(1000)}
+    assert len(claves) == 2000
+
+
+def test_clave_rastreo_prefix_too_long():
+    with pytest.raises(ValueError):
+        ClaveRastreoGenerator(prefijo='X' * 14)
+
+
+def test_referencia_numerica_unique():
+    generators = [ReferenciaNumericaGenerator(node=n, nodes=4)
+                  for n in range(4)]
+    referencias = [g() for g in generators for _ in range(10_000)]
+    assert len(set(referencias)) == len(referencias)
+    assert all(0 < r <= 9_999_999 for r in referencias)
+
+
+def test_referencia_numerica_agotada():
+    generator = ReferenciaNumericaGenerator(node=0, nodes=1_000_000)
+    referencias = [generator() for _ in range(9)]
+    assert len(set(referencias)) == 9
+    assert all(0 < r <= 9_999_999 for r in referencias)
+    with pytest.raises(OverflowError):
+        generator()
+
+
+def test_referencia_numerica_node_count(monkeypatch):
+    monkeypatch.delenv('STP_NODE_ID', raising=False)
+    monkeypatch.setenv('STP_NODES', '4')
+    generator = ReferenciaNumericaGenerator()
+    assert generator.nodes == 4
+    assert 0 <= generator.node < 4
+    monkeypatch.setenv('STP_NODES', '0')
+    with pytest.raises(ValueError):
+        ReferenciaNumericaGenerator()
+
+
+def test_referencia_numerica_nodes():
+    # Con el número de nodos por omisión, node_id() nunca se empalma
+    referencias = [ReferenciaNumericaGenerator(node=n)() for n in (5, 105)]
+    assert referencias[0] != referencias[1]
+    with pytest.raises(ValueError):
+        ReferenciaNumericaGenerator(node=105, nodes=100)
+    with pytest.raises(ValueError):
+        ReferenciaNumericaGenerator(node=-1)
+
+
+def test_node_id_env(monkeypatch):
+    monkeypatch.setenv('STP_NODE_ID', '1234')
+    assert node_id() == 234
+
+
+def test_orden_defaults_unique():
+    ordenes = [Orden() for _ in range(1000)]
+    assert len({orden.claveRastreo for orden in ordenes}) == 1000
+    assert len({orden.referenciaNumerica for orden in ordenes}) == 1000
+
+
+def test_clave_rastreo_index():
+    index = ClaveRastreoIndex(max_size=2)
+    index.add('CR1', 'firma1')
+    index.add('CR1', 'firma1')
+    with pytest.raises(ValueError):
+        index.add('CR1', 'firma2')
+    index.add('CR2')
+    index.add('CR3')
+    assert 'CR1' not in index
+    assert len(index) == 2
+    index.discard('CR3')
+    assert 'CR3' not in index
+    with pytest.raises(ValueError):
+        index.add('CR2')
+
+
+def test_registra_duplicated_clave(stpmex_config, get_order, monkeypatch):
+    stpmex.configure(clave_rastreo_index=ClaveRastreoIndex(),
+                     **stpmex_config)
+    respuesta = SimpleNamespace(id=1, descripcionError=None)
+    monkeypatch.setattr(Orden, '_invoke_method', lambda self, m: respuesta)
+    get_order.registra()
+    # Reintentar la misma orden está permitido
+    get_order.registra()
+    otra = Orden(**get_order.__dict__())
+    otra.monto = 3
+    with pytest.raises(ValueError):
+        otra.registra()
+
+
+def test_libera_clave_sin_envio(stpmex_config, get_order, monkeypatch):
+    index = ClaveRastreoIndex()
+    stpmex.configure(clave_rastreo_index=index, **stpmex_config)
+
+    def falla(self, method):
+        raise ConnectionError
+
+    monkeypatch.setattr(Orden, '_send', falla)
+    with pytest.raises(ConnectionError):
+        get_order.registra()
+    # La orden no salió: la clave se puede usar con otra firma
+    assert get_order.claveRastreo not in index
+    get_order.monto = 3
+    monkeypatch.undo()
+    respuesta = SimpleNamespace(id=1, descripcionError=None)
+    monkeypatch.setattr(Orden, '_invoke_method', lambda self, m: respuesta)
+    get_order.registra()
+    assert get_order.claveRastreo in index
+
+
+def test_conserva_clave_enviada(fake_stp, stpmex_config, get_order):
+    index = ClaveRastreoIndex()
+    stpmex.configure(clave_rastreo_index=index, **stpmex_config)
+    fake_stp.fault_rate = 1
+    with pytest.raises(Exception):
+        get_order.registra()
+    # La petición llegó a STP: la clave sigue reservada
+    assert get_order.claveRastreo in index
@@ -0,0 +1,55 @@
+import pytest
+from clabe.banks import BankCode
+
+from stpmex.helpers import (SPEI_TO_STP, STP_TO_SPEI, institucion_contraparte,
+                            institucion_contraparte_array,
+                            institucion_contraparte_many,
+                            spei_to_stp_bank_code, stp_to_spei_bank_code)
+from stpmex.types import Institucion
+
+
+def test_bank_codes_indices():
+    assert spei_to_stp_bank_code(BankCode.BANAMEX.value) == \
+        Institucion.BANAMEX
+    assert stp_to_spei_bank_code(Institucion.BANAMEX) == \
+        BankCode.BANAMEX.value
+    assert stp_to_spei_bank_code(Institucion.BANAMEX.value) == \
+        BankCode.BANAMEX.value
+    assert SPEI_TO_STP[BankCode.BANORTE.value] == Institucion.BANORTE
+    assert STP_TO_SPEI[Institucion.BANORTE.value] == BankCode.BANORTE.value
+
+
+def test_institucion_contraparte():
+    cuentas = ['072691004495711499', '646180157000000004', '999000', '1']
+    assert institucion_contraparte(cuentas[0]) == Institucion.BANORTE.value
+    assert institucion_contraparte_many(cuentas) == [
+        Institucion.BANORTE.value, Institucion.STP.value, None, None]
+
+
+def test_institucion_contraparte_array():
+    np = pytest.importorskip('numpy')
+    cuentas = ['072691004495711499', '646180157000000004', '999000', '1',
+               'ab2123', '']
+    esperado = [Institucion.BANORTE.value, Institucion.STP.value, 0, 0, 0, 0]
+    for arreglo in (np.array(cuentas), np.array(cuentas, dtype='S18')):
+        assert institucion_contraparte_array(arreglo).tolist() == esperado
+    assert institucion_contraparte_array(np.array([], dtype='U18')).size == 0
+    with pytest.raises(TypeError):
+        institucion_contraparte_array(np.array([72]))
+
+
+def test_bank_codes_sin_alias():
+    assert Institucion.VOLKSWAGEN.value == 40141
+    assert Institucion.MIZUHO_BANK.value == 40158
+    assert spei_to_stp_bank_code(BankCode.VOLKSWAGEN.value) == \
+        Institucion.VOLKSWAGEN
+    assert spei_to_stp_bank_code(BankCode.MIZUHO_BANK.value) == \
+        Institucion.MIZUHO_BANK
+    assert stp_to_spei_bank_code(Institucion.CONSUBANCO) == \
+        BankCode.CONSUBANCO.value
+    assert stp_to_spei_bank_code(Institucion.SABADELL.value) == \
+        BankCode.SABADELL.value
+    for institucion in Institucion:
+        spei_code = stp_to_spei_bank_code(institucion)
+        if spei_code is not None:
+            assert spei_to_stp_bank_code(spei_code) == institucion
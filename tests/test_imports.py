@@ -0,0 +1,47 @@
+import subprocess
+import sys
+
+import pytest
+
+HEAVY = ('zeep', 'requests', 'lxml', 'cryptography', 'OpenSSL', 'httpx')
+
+
+def _loaded(code):
+    # Un proceso nuevo para que no cuenten los módulos que ya cargaron las
+    # demás pruebas
+    check = (f'{code}\nimport sys\n'
+             f'print(",".join(m for m in {HEAVY!r} if m in sys.modules))')
+    output = subprocess.run([sys.executable, '-c', check], check=True,
+                            capture_output=True, text=True).stdout
+    return set(filter(None, output.strip().split(',')))
+
+
+@pytest.mark.parametrize('code', [
+    'import stpmex',
+    'import stpmex.types',
+    'from stpmex.defaults import BUNDLED_WSDL',
+    'import stpmex.__main__',
+    'import stpmex; stpmex.BUNDLED_WSDL; stpmex.DEFAULT_POOL_SIZE',
+])
+def test_import_ligero(code):
+    assert _loaded(code) == set()
+
+
+def test_carga_al_usar():
+    assert 'zeep' in _loaded('import stpmex; stpmex.StpClient')
+
+
+def test_atributo_inexistente():
+    import stpmex
+    with pytest.raises(AttributeError):
+        stpmex.NoExiste
+    assert 'Orden' in dir(stpmex)
+
+
+def test_submodulos():
+    # Sólo con `import stpmex`, en un proceso nuevo
+    assert _loaded('import stpmex; assert stpmex.base.DEFAULT_CLIENT is None; '
+                   'assert stpmex.types.Institucion') == set()
+    assert 'lxml' in _loaded('import stpmex; stpmex.testing.FakeSTP')
+    import stpmex
+    assert {'base', 'batch', 'testing'} <= set(dir(stpmex))
@@ -0,0 +1,113 @@
+import threading
+
+import pytest
+from requests.exceptions import ConnectionError
+
+import stpmex
+from stpmex import Orden
+from stpmex.journal import Journal
+
+ORDEN = dict(conceptoPago='Prueba', institucionOperante=90646,
+             cuentaBeneficiario='072691004495711499',
+             institucionContraparte=40072, monto=1.2,
+             nombreBeneficiario='Ricardo Sanchez')
+
+
+def _firmada(clave):
+    orden = Orden(claveRastreo=clave, **ORDEN)
+    orden.firma = f'firma-{clave}'
+    return orden
+
+
+def test_pendientes(tmpdir):
+    path = str(tmpdir.join('ordenes.journal'))
+    with Journal(path) as journal:
+        uno, dos = _firmada('CR1'), _firmada('CR2')
+        journal.begin(uno)
+        journal.begin(dos)
+        journal.end(uno, type('Resp', (), dict(id=10,
+                                               descripcionError=None))())
+        pendiente, = journal.pendientes()
+    assert pendiente.claveRastreo == 'CR2'
+    assert pendiente.firma == 'firma-CR2'
+    assert pendiente.cadena.encode('utf-8') == dos._joined_fields
+    assert Orden(**pendiente.orden) == dos
+    with pytest.raises(ValueError):
+        journal.begin(uno)
+
+
+def test_linea_incompleta_y_compact(tmpdir):
+    path = str(tmpdir.join('ordenes.journal'))
+    with Journal(path) as journal:
+        journal.begin(_firmada('CR1'))
+        journal.end(_firmada('CR1'), None)
+        journal.begin(_firmada('CR2'))
+    with open(path, 'ab') as fp:
+        fp.write(b'{"t":"P","clave":"CR3","cad')
+    with Journal(path) as journal:
+        journal.begin(_firmada('CR4'))
+        assert [p.claveRastreo for p in journal.pendientes()] == ['CR2',
+                                                                  'CR4']
+        journal.compact()
+        journal.begin(_firmada('CR5'))
+        assert len(journal.pendientes()) == 3
+    with open(path) as fp:
+        assert len(fp.readlines()) == 3
+
+
+def test_group_commit(tmpdir):
+    path = str(tmpdir.join('ordenes.journal'))
+    ordenes = [_firmada(f'CR{i}') for i in range(400)]
+    with Journal(path) as journal:
+        def escribe(lote):
+            for orden in lote:
+                journal.begin(orden)
+                journal.end(orden, None)
+        hilos = [threading.Thread(target=escribe, args=(ordenes[i::8],))
+                 for i in range(8)]
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join()
+        assert journal.pendientes() == []
+    assert journal.commits < len(ordenes)
+    with open(path) as fp:
+        assert len(fp.readlines()) == 2 * len(ordenes)
+
+
+def test_replay(fake_stp, stpmex_config, tmpdir, monkeypatch):
+    path = str(tmpdir.join('ordenes.journal'))
+    client = stpmex.configure(journal=Journal(path), **stpmex_config)
+    transport = client.service._client.transport
+    post = transport.post_xml
+
+    def post_xml(address, envelope, headers):
+        # La orden llega a STP pero el proceso se cae antes de la respuesta
+        post(address, envelope, headers)
+        raise ConnectionError('caída')
+    monkeypatch.setattr(transport, 'post_xml', post_xml)
+    enviada = Orden(**ORDEN)
+    with pytest.raises(ConnectionError):
+        enviada.registra()
+    monkeypatch.setattr(transport, 'post_xml', post)
+    # Otra orden que se anotó pero nunca salió
+    no_enviada = Orden(**ORDEN)
+    no_enviada._prepare_send()
+    client.journal.begin(no_enviada)
+    client.journal.close()
+    assert len(fake_stp.ordenes) == 1
+
+    # Al reiniciar
+    journal = Journal(path)
+    client = stpmex.configure(journal=journal, **stpmex_config)
+    resultados = {r.claveRastreo: r for r in journal.replay(client)}
+    assert resultados[enviada.claveRastreo].id is None
+    assert resultados[enviada.claveRastreo].descripcionError is None
+    assert resultados[enviada.claveRastreo].duplicada
+    assert resultados[no_enviada.claveRastreo].id == 2
+    assert not resultados[no_enviada.claveRastreo].duplicada
+    assert len(fake_stp.ordenes) == 2
+    assert fake_stp.ordenes[1]['firma'] == no_enviada.firma
+    assert journal.pendientes() == []
+    assert journal.replay(client) == []
+    journal.close()
@@ -0,0 +1,82 @@
+import pytest
+
+import stpmex
+from stpmex import Orden, metrics
+from stpmex.metrics import PHASES, TOTAL, PrometheusExporter
+from stpmex.types import Institucion
+
+
+@pytest.fixture
+def eventos():
+    eventos = []
+    metrics.add_hook(eventos.append)
+    yield eventos
+    metrics.remove_hook(eventos.append)
+
+
+@pytest.fixture
+def exporter():
+    exporter = PrometheusExporter()
+    metrics.add_hook(exporter)
+    yield exporter
+    metrics.remove_hook(exporter)
+
+
+def test_fases_registra(fake_stp, get_order, eventos):
+    resp = get_order.registra()
+    assert [e.phase for e in eventos] == list(PHASES) + [TOTAL]
+    assert all(e.resource is get_order for e in eventos)
+    assert all(e.seconds >= 0 and e.error is None for e in eventos)
+    assert eventos[-1].result is resp
+    assert resp.id == 1
+
+
+def test_zeep_privados(initialize_stpmex):
+    # Las fases build y parse usan atributos privados de zeep; si una
+    # versión nueva los cambia, esta prueba falla antes que los envíos
+    service = stpmex.base.DEFAULT_CLIENT.service
+    binding = service._binding
+    assert callable(binding._create)
+    assert callable(binding.process_reply)
+    assert service._binding_options['address']
+    assert binding.get('registraOrden') is not None
+
+
+def test_fase_con_error(initialize_stpmex, get_order, eventos):
+    get_order.monto = 0
+    with pytest.raises(ValueError):
+        get_order.registra()
+    assert [e.phase for e in eventos] == ['validate', TOTAL]
+    assert isinstance(eventos[-1].error, ValueError)
+
+
+def test_sin_hooks(monkeypatch):
+    monkeypatch.setattr(metrics, 'HOOKS', [])
+    assert metrics.measure('sign', None, lambda x: x * 2, 3) == 6
+
+
+def test_prometheus_exporter(fake_stp, exporter):
+    def orden():
+        return Orden(conceptoPago='Prueba',
+                     institucionOperante=Institucion.STP.value,
+                     cuentaBeneficiario='072691004495711499',
+                     institucionContraparte=Institucion.BANORTE.value,
+                     monto=1.2, nombreBeneficiario='Ricardo Sanchez')
+
+    orden().registra()
+    fake_stp.error_rate = 1
+    orden().registra()
+    with pytest.raises(ValueError):
+        Orden(monto=1).registra()
+
+    text = exporter.render()
+    assert '# TYPE stpmex_phase_seconds histogram' in text
+    assert 'stpmex_phase_seconds_count{phase="total"} 3' in text
+    assert 'stpmex_phase_seconds_count{phase="post"} 2' in text
+    assert 'stpmex_phase_seconds_bucket{phase="post",le="+Inf"} 2' in text
+    assert 'stpmex_results_total{result="ok"} 1' in text
+    assert 'stpmex_results_total{result="stp_error"} 1' in text
+    assert 'stpmex_results_total{result="exception"} 1' in text
+    assert 'stpmex_stp_errors_total{id="-9"} 1' in text
+    exporter.reset()
+    assert 'phase=' not in exporter.render()
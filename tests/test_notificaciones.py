@@ -0,0 +1,124 @@
+import json
+import threading
+from io import BytesIO
+from wsgiref.util import setup_testing_defaults
+
+import pytest
+
+from stpmex.notificaciones import (Abono, CambioEstado, Receptor,
+                                   parse_notificacion)
+from stpmex.signing import Signer, Verifier
+
+ABONO = dict(
+    id=123,
+    fechaOperacion=20200420,
+    institucionOrdenante=40072,
+    institucionBeneficiaria=90646,
+    claveRastreo='CR123',
+    monto=150.5,
+    nombreOrdenante='Benito Juarez',
+    tipoCuentaOrdenante=40,
+    cuentaOrdenante='072691004495711499',
+    rfcCurpOrdenante='ND',
+    nombreBeneficiario='Ricardo Sanchez',
+    tipoCuentaBeneficiario=40,
+    cuentaBeneficiario='646180157000000004',
+    rfcCurpBeneficiario='ND',
+    conceptoPago='Pago',
+    referenciaNumerica=1234567,
+    empresa='TAMIZI',
+)
+CAMBIO_ESTADO = dict(id=5706429, empresa='TAMIZI', folioOrigen='F1',
+                     estado='Devuelta', causaDevolucion=3)
+
+
+def _post(app, payload, method='POST'):
+    body = payload if isinstance(payload, bytes) else \
+        json.dumps(payload).encode('utf-8')
+    environ = dict(REQUEST_METHOD=method, CONTENT_LENGTH=str(len(body)))
+    environ['wsgi.input'] = BytesIO(body)
+    setup_testing_defaults(environ)
+    respuesta = {}
+
+    def start_response(status, headers):
+        respuesta['status'] = status
+
+    content = b''.join(app(environ, start_response))
+    return respuesta['status'], json.loads(content)
+
+
+def test_parse_notificacion():
+    abono = parse_notificacion(dict(ABONO, campoNuevo='x'))
+    assert isinstance(abono, Abono)
+    assert abono.empresa == 'TAMIZI'
+    assert abono.monto == 150.5
+    cambio = parse_notificacion(CAMBIO_ESTADO)
+    assert isinstance(cambio, CambioEstado)
+    assert cambio.estado == 'Devuelta'
+    with pytest.raises(ValueError) as exc:
+        parse_notificacion(dict(ABONO, monto=0, claveRastreo=None))
+    assert 'claveRastreo' in str(exc.value)
+    assert 'monto' in str(exc.value)
+    with pytest.raises(ValueError):
+        parse_notificacion([ABONO])
+
+
+def test_receptor_respuestas():
+    receptor = Receptor(handler=lambda n: None, queue_size=1)
+    assert _post(receptor, ABONO) == ('200 OK', dict(mensaje='recibido'))
+    status, body = _post(receptor, ABONO)
+    assert status.startswith('503')
+    status, body = _post(receptor, dict(ABONO, cuentaBeneficiario='123'))
+    assert status.startswith('400')
+    assert 'cuentaBeneficiario' in body['error']
+    assert _post(receptor, b'{no es json')[0].startswith('400')
+    assert _post(receptor, ABONO, method='GET')[0].startswith('405')
+    assert receptor.recibidas == 1
+
+
+def test_receptor_handler_y_sink():
+    hilos = set()
+    lotes = []
+    lock = threading.Lock()
+    # Las dos primeras sólo terminan si se procesan al mismo tiempo
+    juntas = threading.Barrier(2, timeout=5)
+
+    def handler(notificacion):
+        with lock:
+            hilos.add(threading.current_thread().name)
+        if notificacion.id in (1, 2):
+            juntas.wait()
+        if notificacion.id == 13:
+            raise RuntimeError('falla')
+
+    with Receptor(handler=handler, sink=lotes.append, workers=4,
+                  batch_size=7, flush_interval=0.05) as receptor:
+        for i in range(50):
+            status, _ = _post(receptor, dict(ABONO, id=i + 1))
+            assert status == '200 OK'
+    assert receptor.recibidas == 50
+    assert receptor.errores == 1
+    assert len(hilos) > 1
+    ids = sorted(n.id for lote in lotes for n in lote)
+    assert ids == [i + 1 for i in range(50) if i + 1 != 13]
+    assert all(len(lote) <= 7 for lote in lotes)
+
+
+def test_receptor_verifica_firma(stpmex_config):
+    signer = Signer(stpmex_config['priv_key'],
+                    stpmex_config['priv_key_passphrase'])
+    verifier = Verifier(signer.key.public_key())
+    abono = parse_notificacion(ABONO)
+    firmado = dict(ABONO, firma=signer.sign(abono._joined_fields))
+    receptor = Receptor(handler=lambda n: None, verifier=verifier)
+    assert receptor.recibe(firmado).verify(verifier)
+    with pytest.raises(ValueError):
+        receptor.recibe(dict(firmado, monto=1000))
+    status, body = _post(receptor, ABONO)
+    assert status.startswith('400')
+    assert body['error'] == 'Invalid firma'
+
+
+def test_receptor_requiere_handler_o_sink():
+    with pytest.raises(ValueError):
+        Receptor()
@@ -0,0 +1,208 @@
+import asyncio
+
+import pytest
+from requests.exceptions import ConnectionError
+from zeep.wsdl.utils import etree_to_string
+
+import stpmex
+from stpmex import Orden
+from stpmex.envelope import Respuesta
+from stpmex.retry import (CLOSED, HALF_OPEN, OPEN, CircuitBreaker,
+                          CircuitOpenError, Duplicada, RetryPolicy, call,
+                          call_async)
+from stpmex.testing import ERROR_CLAVE_DUPLICADA
+
+ORDEN = dict(conceptoPago='Prueba', institucionOperante=90646,
+             cuentaBeneficiario='072691004495711499',
+             institucionContraparte=40072, monto=1.2,
+             nombreBeneficiario='Ricardo Sanchez')
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _fallas(n, resp='ok'):
+    intentos = []
+
+    def func():
+        intentos.append(len(intentos) + 1)
+        if len(intentos) <= n:
+            raise ConnectionError('sin conexión')
+        return resp
+    return func, intentos
+
+
+def test_retry_policy_delay():
+    policy = RetryPolicy(max_attempts=5, base_delay=0.1, max_delay=0.3)
+    for attempt in range(1, 6):
+        cap = min(0.3, 0.1 * 2 ** (attempt - 1))
+        assert all(0 <= policy.delay(attempt) <= cap for _ in range(50))
+    exc = ConnectionError()
+    assert policy.next_delay(1, exc, 0) is not None
+    assert policy.next_delay(5, exc, 0) is None
+    assert policy.next_delay(1, ValueError(), 0) is None
+    assert RetryPolicy(budget=0.05, base_delay=1).next_delay(1, exc, 0.05) \
+        is None
+
+
+def test_call_reintenta():
+    esperas = []
+    func, intentos = _fallas(2)
+    assert call(func, RetryPolicy(max_attempts=3), None,
+                sleep=esperas.append) == 'ok'
+    assert intentos == [1, 2, 3]
+    assert len(esperas) == 2
+    func, intentos = _fallas(3)
+    with pytest.raises(ConnectionError):
+        call(func, RetryPolicy(max_attempts=3), None, sleep=esperas.append)
+    assert intentos == [1, 2, 3]
+
+
+def test_call_sin_reintento_de_errores_de_negocio():
+    def func():
+        raise ValueError('orden inválida')
+    breaker = CircuitBreaker('stp', failure_threshold=1)
+    with pytest.raises(ValueError):
+        call(func, RetryPolicy(), breaker, sleep=lambda _: None)
+    assert breaker.state == CLOSED
+
+
+def test_clave_duplicada():
+    duplicada = Respuesta(*ERROR_CLAVE_DUPLICADA)
+    # En el primer intento es un error real
+    assert call(lambda: duplicada, RetryPolicy(), None) is duplicada
+    # Después de un intento fallido, el anterior sí llegó
+    func, _ = _fallas(1, duplicada)
+    resp = call(func, RetryPolicy(), None, sleep=lambda _: None)
+    assert resp == Duplicada(duplicada)
+    assert resp.duplicada
+    assert (resp.id, resp.descripcionError) == (None, None)
+    assert resp.respuesta.descripcionError == ERROR_CLAVE_DUPLICADA[1]
+    # Otros rechazos con id -1 no se ocultan
+    otro = Respuesta(-1, 'La cuenta no pertenece a la empresa')
+    func, _ = _fallas(1, otro)
+    assert call(func, RetryPolicy(), None, sleep=lambda _: None) is otro
+
+
+def test_circuit_breaker():
+    clock = Clock()
+    breaker = CircuitBreaker('stp', failure_threshold=2, reset_timeout=10,
+                             clock=clock)
+    func, intentos = _fallas(100)
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            call(func, None, breaker)
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        call(func, None, breaker)
+    assert len(intentos) == 2
+    clock.now = 10
+    assert breaker.state == HALF_OPEN
+    # La petición de prueba falla y el circuito se vuelve a abrir
+    with pytest.raises(ConnectionError):
+        call(func, None, breaker)
+    assert breaker.state == OPEN
+    clock.now = 20
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+
+
+def test_prueba_con_error_de_negocio():
+    clock = Clock()
+    breaker = CircuitBreaker('stp', failure_threshold=1, reset_timeout=10,
+                             clock=clock)
+    func, _ = _fallas(1)
+    with pytest.raises(ConnectionError):
+        call(func, None, breaker)
+    clock.now = 10
+
+    def invalida():
+        raise ValueError('orden inválida')
+    # La petición de prueba termina y el circuito se vuelve a abrir
+    with pytest.raises(ValueError):
+        call(invalida, None, breaker)
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        call(invalida, None, breaker)
+    clock.now = 20
+    assert call(lambda: 'ok', None, breaker) == 'ok'
+    assert breaker.state == CLOSED
+
+
+def test_prueba_cancelada():
+    clock = Clock()
+    breaker = CircuitBreaker('stp', failure_threshold=1, reset_timeout=10,
+                             clock=clock)
+    breaker.record_failure()
+    clock.now = 10
+
+    async def cancelada():
+        raise asyncio.CancelledError()
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(call_async(cancelada, None, breaker))
+    assert breaker.state == OPEN
+    clock.now = 20
+    assert breaker.state == HALF_OPEN
+
+
+def test_call_async():
+    intentos = []
+
+    async def func():
+        intentos.append(1)
+        if len(intentos) == 1:
+            raise asyncio.TimeoutError()
+        return 'ok'
+    policy = RetryPolicy(base_delay=0.001)
+    assert asyncio.run(call_async(func, policy, None)) == 'ok'
+    assert len(intentos) == 2
+
+
+def test_registra_reintenta_misma_orden(fake_stp, stpmex_config,
+                                        monkeypatch):
+    client = stpmex.configure(retry_policy=RetryPolicy(base_delay=0.001),
+                              breaker_threshold=5, **stpmex_config)
+    transport = client.service._client.transport
+    post = transport.post_xml
+    enviados = []
+
+    def post_xml(address, envelope, headers):
+        # La primera orden llega a STP pero se pierde la respuesta
+        enviados.append(etree_to_string(envelope))
+        response = post(address, envelope, headers)
+        if len(enviados) == 1:
+            raise ConnectionError('respuesta perdida')
+        return response
+    monkeypatch.setattr(transport, 'post_xml', post_xml)
+
+    orden = Orden(**ORDEN)
+    resp = orden.registra()
+    assert isinstance(resp, Duplicada)
+    assert len(fake_stp.ordenes) == 1
+    assert len(enviados) == 2
+    assert enviados[0] == enviados[1]
+    assert client.breaker.state == CLOSED
+    # Sin falla previa, la clave duplicada sigue siendo un error
+    assert orden.registra().id == ERROR_CLAVE_DUPLICADA[0]
+
+
+def test_registra_circuito_abierto(fake_stp, stpmex_config, monkeypatch):
+    client = stpmex.configure(breaker_threshold=2, **stpmex_config)
+    transport = client.service._client.transport
+
+    def post_xml(address, envelope, headers):
+        raise ConnectionError('STP no responde')
+    monkeypatch.setattr(transport, 'post_xml', post_xml)
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            Orden(**ORDEN).registra()
+    with pytest.raises(CircuitOpenError):
+        Orden(**ORDEN).registra()
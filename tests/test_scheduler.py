@@ -0,0 +1,116 @@
+import time
+from concurrent.futures import CancelledError
+
+import pytest
+
+from stpmex import Orden
+from stpmex.metrics import add_hook, remove_hook
+from stpmex.scheduler import QUEUE, Scheduler, TokenBucket
+from stpmex.types import Prioridad
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def _orden(clave, prioridad=Prioridad.normal, empresa='TAMIZI'):
+    return Orden(conceptoPago='Prueba', institucionOperante=90646,
+                 cuentaBeneficiario='072691004495711499',
+                 institucionContraparte=40072, monto=1.2,
+                 nombreBeneficiario='Ricardo Sanchez', claveRastreo=clave,
+                 prioridad=prioridad.value, empresa=empresa)
+
+
+def test_token_bucket():
+    clock = Clock()
+    bucket = TokenBucket(rate=10, burst=2, clock=clock, sleep=clock.sleep)
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() == pytest.approx(0.1)
+    bucket.acquire()
+    assert clock.now == pytest.approx(0.1)
+    clock.now = 10
+    assert [bucket.try_acquire() for _ in range(3)][:2] == [0, 0]
+    bucket.release()
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() > 0
+    bucket.release()
+    bucket.release()
+    bucket.release()
+    # Nunca más de `burst` tokens
+    assert [bucket.try_acquire() for _ in range(3)][:2] == [0, 0]
+    assert bucket.try_acquire() > 0
+    with pytest.raises(ValueError):
+        TokenBucket(rate=0)
+
+
+def test_prioridad_y_equidad(fake_stp):
+    scheduler = Scheduler(workers=1)
+    futuros = [scheduler.submit(_orden(f'A{i}', empresa='A'))
+               for i in range(3)]
+    futuros += [scheduler.submit(_orden(f'B{i}', empresa='B'))
+                for i in range(2)]
+    futuros += [scheduler.submit(_orden(f'U{i}', Prioridad.alta))
+                for i in range(2)]
+    assert scheduler.stats()['normal']['pendientes'] == 5
+    assert scheduler.stats()['alta']['pendientes'] == 2
+    with scheduler:
+        pass
+    assert all(futuro.result().id for futuro in futuros)
+    assert [o['claveRastreo'] for o in fake_stp.ordenes] == [
+        'U0', 'U1', 'A0', 'B0', 'A1', 'B1', 'A2']
+    stats = scheduler.stats()
+    assert stats['enviadas'] == 7
+    assert stats['alta'] == dict(stats['alta'], pendientes=0, despachadas=2)
+    assert stats['alta']['espera_maxima'] <= stats['normal']['espera_maxima']
+    with pytest.raises(RuntimeError):
+        scheduler.submit(_orden('X'))
+
+
+def test_rate_limit_y_errores(fake_stp):
+    eventos = []
+    add_hook(eventos.append)
+    try:
+        with Scheduler(rate=20, burst=1, workers=4) as scheduler:
+            inicio = time.monotonic()
+            futuros = [scheduler.submit(_orden(f'R{i}')) for i in range(5)]
+            invalida = scheduler.submit(_orden(None))
+            for futuro in futuros:
+                futuro.result()
+            with pytest.raises(ValueError):
+                invalida.result()
+        assert time.monotonic() - inicio >= 0.2
+    finally:
+        remove_hook(eventos.append)
+    assert scheduler.stats()['errores'] == 1
+    assert sum(evento.phase == QUEUE for evento in eventos) == 6
+
+
+def test_cancelada_devuelve_token(fake_stp):
+    scheduler = Scheduler(rate=0.001, burst=1, workers=1)
+    cancelada = scheduler.submit(_orden('K1'))
+    futuro = scheduler.submit(_orden('K2'))
+    assert cancelada.cancel()
+    with scheduler:
+        # Con una tasa tan baja, K2 sólo sale con el token de K1
+        assert futuro.result(timeout=5).id
+    assert [o['claveRastreo'] for o in fake_stp.ordenes] == ['K2']
+
+
+def test_close_sin_start():
+    scheduler = Scheduler()
+    futuro = scheduler.submit(_orden('C1'))
+    scheduler.close()
+    assert futuro.cancelled()
+    with pytest.raises(CancelledError):
+        futuro.result(timeout=1)
+    assert scheduler.stats()['normal']['pendientes'] == 0
+    with pytest.raises(RuntimeError):
+        scheduler.submit(_orden('C2'))
@@ -0,0 +1,77 @@
+import pytest
+from cryptography.hazmat.primitives import serialization
+
+from stpmex.signing import (MIN_PARALLEL_BATCH, Signer, Verifier,
+                            load_public_key)
+
+CADENA = ('||40072|TAMIZI|||CR1545342796|90646|1.20|1|||||40|'
+          'Ricardo Sanchez|072691004495711499|ND||||||Prueba||||||8839596||'
+          'T||3|1|||').encode('utf-8')
+FIRMA = ('t82zBIDCKaKIFyb0t04EXUBeDTaF56ziNp4ydcrdNxTJJh1pl/t+eYGK7k3op2ET8Y'
+         'mRUHH0paRqw9u+uyJbeUCIhft/Q6T2nT+FHKqJmUZm3liTlpJjuhuyG4K2X3prWsHg'
+         'U+T2EB4C+2usUxKHJESONrvlSSuJLBgsvo5doVQ=')
+
+
+@pytest.fixture
+def signer(stpmex_config):
+    signer = Signer(stpmex_config['priv_key'],
+                    stpmex_config['priv_key_passphrase'], cache_size=2)
+    yield signer
+    signer.close()
+
+
+@pytest.fixture
+def public_key(signer):
+    return signer.key.public_key().public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo).decode('ascii')
+
+
+def test_sign(signer):
+    assert signer.sign(CADENA) == FIRMA
+
+
+def test_sign_cache(signer, monkeypatch):
+    signer.sign(CADENA)
+    monkeypatch.setattr(signer, 'key', None)
+    assert signer.sign(CADENA) == FIRMA
+
+
+def test_sign_cache_size(signer):
+    for i in range(5):
+        signer.sign(str(i).encode('ascii'))
+    assert list(signer._cache) == [b'3', b'4']
+
+
+def test_sign_many(signer):
+    cadenas = [CADENA] + [f'||{i}||'.encode('ascii')
+                          for i in range(MIN_PARALLEL_BATCH)]
+    firmas = signer.sign_many(cadenas, processes=2)
+    assert len(firmas) == len(cadenas)
+    assert firmas[0] == FIRMA
+    assert firmas[1:] == [signer.sign(c) for c in cadenas[1:]]
+
+
+def test_load_public_key_cache(public_key):
+    key = load_public_key(public_key)
+    assert load_public_key(public_key.encode('ascii')) is key
+
+
+def test_verify(public_key):
+    verifier = Verifier(public_key)
+    assert verifier.verify(CADENA, FIRMA)
+    assert not verifier.verify(CADENA + b'|', FIRMA)
+    assert not verifier.verify(CADENA, 'no es base64')
+    assert not verifier.verify(CADENA, None)
+
+
+def test_verify_many(signer, public_key):
+    cadenas = [f'||{i}||'.encode('ascii') for i in range(MIN_PARALLEL_BATCH)]
+    firmas = signer.sign_many(cadenas)
+    firmas[3] = FIRMA
+    verifier = Verifier(public_key)
+    try:
+        resultados = verifier.verify_many(zip(cadenas, firmas), processes=2)
+    finally:
+        verifier.close()
+    assert resultados == [i != 3 for i in range(len(cadenas))]
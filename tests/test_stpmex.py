@@ -1,8 +1,16 @@
+import asyncio
+from types import SimpleNamespace
+
 from clabe import BankCode
+from cryptography.hazmat.primitives import serialization
+from requests.exceptions import ConnectionError
+from zeep.cache import SqliteCache
 
+import stpmex
 from stpmex import Orden
 from stpmex.helpers import spei_to_stp_bank_code, stp_to_spei_bank_code
-from stpmex.types import Institucion
+from stpmex.signing import load_private_key
+from stpmex.types import AccountType, Institucion
 import pytest
 import vcr
 
@@ -39,15 +47,172 @@ def test_join_fields(initialize_stpmex):
     assert orden._joined_fields == joined
 
 
-@pytest.fixture
-def get_order():
-    return Orden(
+def _join_fields_anterior(obj, fieldnames):
+    # Serializador anterior a la versión compilada, como referencia
+    fields = []
+    for name in fieldnames:
+        if name in ['monto', 'iva'] and not getattr(obj, name) in ['', None]:
+            field = float(getattr(obj, name))
+            field = f'{field:.2f}'
+        else:
+            field = getattr(obj, name) or ''
+        fields.append(str(field))
+    return ('||' + '|'.join(fields) + '||').encode('utf-8')
+
+
+def test_join_fields_anterior(initialize_stpmex):
+    kwargs = dict(conceptoPago='Prueba', claveRastreo='CR1',
+                  referenciaNumerica=1234567)
+    ordenes = [Orden(monto=1.2, **kwargs), Orden(monto='0', iva=1, **kwargs),
+               Orden(monto=0, iva='', prioridad='0', **kwargs),
+               Orden(monto='12.345', prioridad=1, **kwargs)]
+    for orden in ordenes:
+        assert orden._joined_fields == \
+            _join_fields_anterior(orden, Orden.__fieldnames__)
+    # Diferencias: un campo numérico en 0 ya no queda vacío
+    orden = Orden(monto=1, prioridad=0, **kwargs)
+    assert orden._joined_fields.endswith(b'|T||3|0|||')
+    assert _join_fields_anterior(orden, Orden.__fieldnames__).endswith(
+        b'|T||3||||')
+    # y el medio centavo se redondea hacia arriba sobre el texto del número,
+    # no sobre el float: 1.005 es 1.00499... en binario
+    for monto, nuevo, anterior in ((1.005, b'1.01', b'1.00'),
+                                   ('2.675', b'2.68', b'2.67')):
+        orden = Orden(monto=monto, **kwargs)
+        assert b'|' + nuevo + b'|' in orden._joined_fields
+        assert b'|' + anterior + b'|' in _join_fields_anterior(
+            orden, Orden.__fieldnames__)
+
+
+def test_join_fields_cero(initialize_stpmex):
+    # Mismo ejemplo de STP que test_join_fields, con valores numéricos
+    orden = Orden(
+        institucionContraparte=846, fechaOperacion=20160810,
+        folioOrigen='1q2w33e', claveRastreo='1q2w33e', monto=121,
+        tipoPago=1, tipoCuentaOrdenante=40, tipoCuentaBeneficiario=40,
+        nombreBeneficiario='eduardo',
+        cuentaBeneficiario='846180000300000004', rfcCurpBeneficiario='ND',
+        emailBeneficiario='fernanda.cedillo@stpmex.com',
+        conceptoPago='pago prueba', referenciaNumerica=123123, topologia='T',
+        medioEntrega=3, prioridad=0)
+    assert orden._joined_fields == (
+        '||846|TAMIZI|20160810|1q2w33e|1q2w33e||121.00|1|40||||40|'
+        'eduardo|846180000300000004|ND|fernanda.cedillo@stpmex.com|||||'
+        'pago prueba||||||123123||T||3|0|||').encode('utf-8')
+
+
+def test_joined_fields_invalidation(initialize_stpmex):
+    orden = Orden(conceptoPago='Prueba', monto=0, iva='',
+                  claveRastreo='CR1', referenciaNumerica=1234567)
+    assert orden._joined_fields == (
+        '|||TAMIZI|||CR1||0.00|1|||||40|||ND||||||Prueba||||||1234567||T||'
+        '3|1|||').encode('utf-8')
+    orden.monto = '12.345'
+    orden.iva = 1
+    assert b'|12.35|' in orden._joined_fields
+    assert orden._joined_fields.endswith(b'|1.00||')
+
+
+def test_orden_without_client(monkeypatch):
+    monkeypatch.setattr(stpmex.base, 'ACTUALIZA_CLIENT', None)
+    monkeypatch.setattr(stpmex.base, 'STP_EMPRESA', None)
+    orden = Orden(conceptoPago='Prueba', nombreBeneficiario='Ricardo',
+                  monto=1.2, cuentaBeneficiario='072691004495711499',
+                  institucionContraparte=Institucion.BANORTE.value)
+    assert orden.empresa is None
+    assert orden.cuentaOrdenante is None
+    assert orden.rfcCurpBeneficiario == 'ND'
+    assert not hasattr(orden, '__weakref__')
+    orden._is_valid()
+    with pytest.raises(AttributeError):
+        orden.campoInexistente = 1
+    with pytest.raises(TypeError):
+        Orden(campoInexistente=1)
+
+
+@vcr.use_cassette('tests/cassettes/test_create_orden')
+def test_create_orden_before_configure(monkeypatch, stpmex_config):
+    monkeypatch.setattr(stpmex.base, 'STP_EMPRESA', None)
+    orden = Orden(
         conceptoPago='Prueba',
         institucionOperante=Institucion.STP.value,
         cuentaBeneficiario='072691004495711499',
         institucionContraparte=Institucion.BANORTE.value,
         monto=1.2,
         nombreBeneficiario='Ricardo Sanchez')
+    stpmex.configure(**stpmex_config)
+    resp = orden.registra()
+    assert resp.id == 5706429
+    assert orden.empresa == 'TAMIZI'
+
+
+def test_to_zeep(initialize_stpmex, get_order):
+    get_order.firma = 'firma'
+    ordenes_pago = [get_order._to_zeep(), get_order._to_zeep()]
+    assert ordenes_pago[0].conceptoPago == 'Prueba'
+    assert ordenes_pago[0].firma == 'firma'
+    assert ordenes_pago[0].monto == 1.2
+    assert type(ordenes_pago[0]) is type(ordenes_pago[1])
+    assert 'ns0:ordenPagoWS' in stpmex.base.ZEEP_TYPES
+
+
+def test_join_many(initialize_stpmex):
+    ordenes = [Orden(conceptoPago='Prueba', monto=i, claveRastreo=f'CR{i}')
+               for i in range(3)]
+    assert Orden._join_many(ordenes) == [o._joined_fields for o in ordenes]
+
+
+def test_compute_signature(initialize_stpmex):
+    orden = Orden(
+        conceptoPago='Prueba',
+        institucionOperante=Institucion.STP.value,
+        cuentaBeneficiario='072691004495711499',
+        institucionContraparte=Institucion.BANORTE.value,
+        monto=1.2,
+        nombreBeneficiario='Ricardo Sanchez',
+        claveRastreo='CR1545342796',
+        referenciaNumerica=8839596)
+    # Firma enviada en tests/cassettes/test_create_orden
+    assert orden._compute_signature() == (
+        't82zBIDCKaKIFyb0t04EXUBeDTaF56ziNp4ydcrdNxTJJh1pl/t+eYGK7k3op2ET8Y'
+        'mRUHH0paRqw9u+uyJbeUCIhft/Q6T2nT+FHKqJmUZm3liTlpJjuhuyG4K2X3prWsHg'
+        'U+T2EB4C+2usUxKHJESONrvlSSuJLBgsvo5doVQ=')
+
+
+def test_firma_many(initialize_stpmex):
+    ordenes = [Orden(
+        conceptoPago='Prueba',
+        institucionOperante=Institucion.STP.value,
+        cuentaBeneficiario='072691004495711499',
+        institucionContraparte=Institucion.BANORTE.value,
+        monto=i,
+        nombreBeneficiario='Ricardo Sanchez') for i in range(1, 4)]
+    firmas = Orden.firma_many(ordenes)
+    assert [orden.firma for orden in ordenes] == firmas
+    assert firmas == [orden._compute_signature() for orden in ordenes]
+
+
+def test_verify(stpmex_config):
+    key = load_private_key(stpmex_config['priv_key'],
+                           stpmex_config['priv_key_passphrase'])
+    public_key = key.public_key().public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo)
+    client = stpmex.configure(public_key=public_key, **stpmex_config)
+    ordenes = [Orden(conceptoPago='Prueba', monto=i, claveRastreo=f'CR{i}')
+               for i in range(1, 4)]
+    Orden.firma_many(ordenes)
+    assert ordenes[0].verify()
+    ordenes[1].monto = 20
+    assert Orden.verify_many(ordenes) == [True, False, True]
+    assert Orden.verify_many(ordenes, verifier=client.verifier,
+                             processes=1) == [True, False, True]
+
+
+def test_verify_sin_llave_publica(initialize_stpmex, get_order):
+    get_order.firma = 'x'
+    with pytest.raises(RuntimeError):
+        get_order.verify()
 
 
 def test_create_order_leading_trailing_spaces(initialize_stpmex):
@@ -77,6 +242,23 @@ def test_create_orden(initialize_stpmex, get_order):
     assert orden._id == resp.id
 
 
+@vcr.use_cassette('tests/cassettes/test_create_orden')
+def test_create_orden_async(initialize_stpmex, get_order):
+    orden = get_order
+    resp = asyncio.run(orden.registra_async())
+    assert resp.descripcionError is None
+    assert resp.id == 5706429
+    assert orden._id == resp.id
+    assert orden.firma is not None
+
+
+def test_empty_concepto_async(initialize_stpmex, get_order):
+    orden = get_order
+    orden.conceptoPago = ''
+    with pytest.raises(ValueError):
+        asyncio.run(orden.registra_async())
+
+
 @vcr.use_cassette(cassette_library_dir='tests/cassettes')
 def test_empty_concepto(initialize_stpmex, get_order):
     orden = get_order
@@ -133,6 +315,73 @@ def test_null_reference(initialize_stpmex, get_order):
         order.registra()
 
 
+def test_configure_wsdl_from_cache(tmpdir, stpmex_config):
+    cache_path = str(tmpdir.join('wsdl.db'))
+    with open(stpmex.BUNDLED_WSDL, 'rb') as fp:
+        SqliteCache(path=cache_path).add(stpmex.DEFAULT_WSDL, fp.read())
+    stpmex_config.update(wsdl_path=stpmex.DEFAULT_WSDL,
+                         cache_path=cache_path)
+    # No hay red disponible para el WSDL, se obtiene de la caché
+    stpmex.configure(**stpmex_config)
+    assert stpmex.base.ACTUALIZA_CLIENT.get_type('ns0:ordenPagoWS')
+
+
+def test_configure_wsdl_cache_expired(tmpdir, stpmex_config):
+    cache_path = str(tmpdir.join('wsdl.db'))
+    url = 'http://localhost:1/SpeiActualizaServices?wsdl'
+    with open(stpmex.BUNDLED_WSDL, 'rb') as fp:
+        SqliteCache(path=cache_path).add(url, fp.read())
+    stpmex_config.update(wsdl_path=url, cache_path=cache_path, cache_ttl=-1)
+    with pytest.raises(ConnectionError):
+        stpmex.configure(**stpmex_config)
+
+
+@pytest.mark.parametrize('field,value,error', [
+    ('cuentaBeneficiario', '072691004495711490',
+     'Field cuentaBeneficiario has an invalid check digit'),
+    ('cuentaBeneficiario', '07269100449571149',
+     'Field cuentaBeneficiario is not a valid account'),
+    ('institucionContraparte', 12345,
+     'Field institucionContraparte is not a valid institution'),
+    ('monto', -1, 'Field monto must be greater than 0'),
+    ('monto', 'abc', 'Field monto must be greater than 0'),
+    ('conceptoPago', 'pago | prueba',
+     'Field conceptoPago has invalid characters'),
+    ('nombreBeneficiario', 'Ricardo\n',
+     'Field nombreBeneficiario has invalid characters'),
+])
+def test_validations(get_order, field, value, error):
+    setattr(get_order, field, value)
+    with pytest.raises(ValueError) as exc:
+        get_order._is_valid()
+    assert str(exc.value) == error
+
+
+def test_valid_debit_card(get_order):
+    get_order.tipoCuentaBeneficiario = AccountType.DEBIT_CARD.value
+    get_order.cuentaBeneficiario = '4152313112345678'
+    assert get_order._is_valid() is None
+    get_order.cuentaBeneficiario = '072691004495711499'
+    with pytest.raises(ValueError):
+        get_order._is_valid()
+
+
+def test_validate_many(get_order):
+    invalida = Orden(conceptoPago='', nombreBeneficiario='Ricardo Sanchez',
+                     cuentaBeneficiario='072691004495711490', monto=0,
+                     institucionContraparte=Institucion.BANORTE.value)
+    report = Orden.validate_many([get_order, invalida, get_order])
+    assert report == {
+        1: dict(
+            conceptoPago=['Field conceptoPago is required'],
+            cuentaBeneficiario=[
+                'Field cuentaBeneficiario has an invalid check digit'],
+            monto=['Field monto is required',
+                   'Field monto must be greater than 0'],
+        )
+    }
+
+
 def test_invalid_spei_bank():
     spei_bank = '001'
     stp_code = spei_to_stp_bank_code(spei_bank)
@@ -162,3 +411,32 @@ def test_max_length(initialize_stpmex, get_order):
     order.claveRastreo = '1234567891234567891234567891234'
     with pytest.raises(ValueError):
         order.registra()
+
+
+def test_registra_many(initialize_stpmex, monkeypatch):
+    respuesta = SimpleNamespace(id=5706429, descripcionError=None)
+    monkeypatch.setattr(Orden, '_invoke_method', lambda self, m: respuesta)
+    ordenes = [Orden(
+        conceptoPago=concepto,
+        institucionOperante=Institucion.STP.value,
+        cuentaBeneficiario='072691004495711499',
+        institucionContraparte=Institucion.BANORTE.value,
+        monto=1.2,
+        nombreBeneficiario='Ricardo Sanchez')
+        for concepto in ['Prueba', 'Prueba', '', 'Prueba', 'Prueba']]
+    resultados = Orden.registra_many(ordenes, max_workers=2)
+    assert len(resultados) == 5
+    assert isinstance(resultados[2].error, ValueError)
+    assert resultados[2].id is None
+    assert ordenes[2]._id is None
+    for orden, resultado in zip(ordenes[:2] + ordenes[3:],
+                                resultados[:2] + resultados[3:]):
+        assert resultado.error is None
+        assert resultado.descripcionError is None
+        assert resultado.id == 5706429
+        assert orden._id == resultado.id
+
+
+def test_registra_many_max_workers():
+    with pytest.raises(ValueError):
+        Orden.registra_many([], max_workers=0)
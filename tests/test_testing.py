@@ -0,0 +1,100 @@
+import time
+from urllib.request import urlopen
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from stpmex import Orden
+from stpmex.testing import (ERROR_CLAVE_DUPLICADA, ERROR_FIRMA,
+                            ERROR_GENERICO, FakeSTP, cadena_original)
+
+
+def _ordenes(n):
+    return [Orden(
+        conceptoPago='Prueba',
+        institucionOperante=90646,
+        cuentaBeneficiario='072691004495711499',
+        institucionContraparte=40072,
+        monto=i + 1,
+        nombreBeneficiario='Ricardo Sanchez & Hijos') for i in range(n)]
+
+
+def test_cadena_original():
+    # Ejemplo de la documentación de STP, con los campos como llegan en el
+    # envelope
+    fields = dict(
+        institucionContraparte='846', empresa='TAMIZI',
+        fechaOperacion='20160810', folioOrigen='1q2w33e',
+        claveRastreo='1q2w33e', monto='121', tipoPago='1',
+        tipoCuentaOrdenante='40', tipoCuentaBeneficiario='40',
+        nombreBeneficiario='eduardo', cuentaBeneficiario='846180000300000004',
+        rfcCurpBeneficiario='ND',
+        emailBeneficiario='fernanda.cedillo@stpmex.com',
+        conceptoPago='pago prueba', referenciaNumerica='123123',
+        topologia='T', medioEntrega='3', prioridad='0',
+        firma='ignorada')
+    assert cadena_original(fields) == (
+        '||846|TAMIZI|20160810|1q2w33e|1q2w33e||121.00|1|40||||40|'
+        'eduardo|846180000300000004|ND|fernanda.cedillo@stpmex.com|||||'
+        'pago prueba||||||123123||T||3|0|||').encode('utf-8')
+
+
+def test_registra(fake_stp, get_order):
+    resp = get_order.registra()
+    assert resp.descripcionError is None
+    assert resp.id == 1
+    assert get_order._id == 1
+    assert fake_stp.ordenes[0]['claveRastreo'] == get_order.claveRastreo
+    assert fake_stp.ordenes[0]['firma'] == get_order.firma
+
+
+def test_registra_many(fake_stp):
+    fake_stp.latency = 0.05
+    ordenes = _ordenes(20)
+    start = time.monotonic()
+    resultados = Orden.registra_many(ordenes, max_workers=10)
+    assert time.monotonic() - start < 20 * 0.05
+    assert sorted(r.id for r in resultados) == list(range(1, 21))
+    assert [o._id for o in ordenes] == [r.id for r in resultados]
+    assert len(fake_stp.ordenes) == 20
+
+
+def test_firma_invalida(fake_stp, get_order):
+    fake_stp.public_key = rsa.generate_private_key(
+        public_exponent=65537, key_size=1024).public_key()
+    resp = get_order.registra()
+    assert (resp.id, resp.descripcionError) == ERROR_FIRMA
+    assert not fake_stp.ordenes
+
+
+def test_firma_medio_centavo(fake_stp, get_order):
+    # El cliente y FakeSTP redondean 1.005 igual: 1.01
+    get_order.monto = 1.005
+    resp = get_order.registra()
+    assert resp.descripcionError is None
+    assert b'|1.01|' in get_order._joined_fields
+
+
+def test_clave_duplicada(fake_stp, get_order):
+    get_order.registra()
+    resp = get_order.registra()
+    assert (resp.id, resp.descripcionError) == ERROR_CLAVE_DUPLICADA
+
+
+def test_error_rate(fake_stp):
+    fake_stp.error_rate = 1
+    resultados = Orden.registra_many(_ordenes(3))
+    assert all((r.id, r.descripcionError) == ERROR_GENERICO
+               for r in resultados)
+
+
+def test_fault_rate(fake_stp, get_order):
+    fake_stp.fault_rate = 1
+    resultado, = Orden.registra_many([get_order])
+    assert resultado.error is not None
+    assert 'Internal error' in str(resultado.error)
+
+
+def test_wsdl():
+    with FakeSTP() as stp:
+        wsdl = urlopen(stp.wsdl_url).read()
+    assert stp.url.encode('ascii') in wsdl
@@ -0,0 +1,136 @@
+import os
+import signal
+import time
+
+import pytest
+
+from stpmex.client import StpClient
+from stpmex.worker import (
+    DUPLICADA, ENVIANDO, PENDIENTE, REGISTRADA, SpoolQueue, SqliteQueue,
+    Supervisor, open_queue, procesa)
+
+ORDEN = dict(conceptoPago='Prueba', institucionOperante='90646',
+             cuentaBeneficiario='072691004495711499',
+             institucionContraparte='40072', monto='1.2',
+             nombreBeneficiario='Ricardo Sanchez')
+
+
+def _filas(n):
+    return [dict(ORDEN, claveRastreo=f'CR{i}') for i in range(n)]
+
+
+@pytest.fixture(params=['sqlite', 'spool'])
+def queue_path(request, tmpdir):
+    if request.param == 'spool':
+        return str(tmpdir.mkdir('spool'))
+    return str(tmpdir.join('ordenes.db'))
+
+
+def test_claim_y_recover(queue_path):
+    cola = open_queue(queue_path)
+    assert cola.put_many(_filas(3)) == 3
+    uno, dos = cola.claim(2)
+    assert not uno.reenvio
+    assert uno.orden['claveRastreo'] == 'CR0'
+    assert uno.orden['referenciaNumerica']
+    tres, = open_queue(queue_path).claim(5)
+    assert tres.orden['claveRastreo'] == 'CR2'
+    assert cola.recover() == 3
+    tareas = cola.claim(10)
+    assert [t.orden['claveRastreo'] for t in tareas] == ['CR0', 'CR1', 'CR2']
+    assert all(t.reenvio for t in tareas)
+    assert not cola.claim(10)
+    cola.close()
+
+
+def test_spool_claim_acotado(tmpdir):
+    cola = SpoolQueue(str(tmpdir))
+    cola.put_many(_filas(30))
+    claves = []
+    while True:
+        tareas = cola.claim(4)
+        if not tareas:
+            break
+        assert len(tareas) <= 4
+        nombres = [t.key for t in tareas]
+        assert nombres == sorted(nombres)
+        claves += [t.orden['claveRastreo'] for t in tareas]
+    assert sorted(claves) == sorted(f'CR{i}' for i in range(30))
+
+
+def test_open_queue(tmpdir):
+    assert isinstance(open_queue(str(tmpdir)), SpoolQueue)
+    assert isinstance(open_queue(str(tmpdir.join('q.db'))), SqliteQueue)
+
+
+def test_reenvio_duplicado(fake_stp, stpmex_config, tmpdir):
+    client = StpClient(**stpmex_config)
+    cola = SqliteQueue(str(tmpdir.join('ordenes.db')))
+    cola.put_many(_filas(2))
+    tarea, otra = cola.claim(2)
+    # El proceso envió la orden y se cayó antes de guardar el resultado
+    client.orden(**tarea.orden).registra()
+    cola.recover()
+    assert procesa(client, cola, cola.claim(2)) == 2
+    assert cola.counts() == {DUPLICADA: 1, REGISTRADA: 1}
+    assert len(fake_stp.ordenes) == 2
+    ids = cola._db.execute('SELECT stp_id FROM ordenes ORDER BY id')
+    assert [row[0] for row in ids] == [None, 2]
+    cola.close()
+    client.close()
+
+
+def test_supervisor_drain(fake_stp, stpmex_config, queue_path):
+    cola = open_queue(queue_path)
+    cola.put_many(_filas(40))
+    exitcodes = Supervisor(stpmex_config, queue_path, processes=2,
+                           threads=4, batch_size=5, drain=True).run()
+    assert exitcodes == [0, 0]
+    assert len(fake_stp.ordenes) == 40
+    counts = cola.counts()
+    assert counts.get(REGISTRADA, counts.get('resultados')) == 40
+    assert not counts.get(PENDIENTE)
+    cola.close()
+
+
+def test_supervisor_stop(fake_stp, stpmex_config, tmpdir):
+    fake_stp.latency = 0.02
+    path = str(tmpdir.join('ordenes.db'))
+    cola = SqliteQueue(path)
+    cola.put_many(_filas(300))
+    supervisor = Supervisor(stpmex_config, path, processes=2, threads=2,
+                            batch_size=5, poll_interval=0.1).start()
+    deadline = time.monotonic() + 60
+    while not fake_stp.ordenes and time.monotonic() < deadline:
+        time.sleep(0.05)
+    supervisor.stop()
+    assert supervisor.join(60)
+    counts = cola.counts()
+    # Los grupos en vuelo se terminan y el resto sigue en la cola
+    assert not counts.get(ENVIANDO)
+    assert counts[REGISTRADA] == len(fake_stp.ordenes)
+    assert counts[REGISTRADA] + counts[PENDIENTE] == 300
+    cola.close()
+
+
+def test_sigterm_en_proceso(fake_stp, stpmex_config, tmpdir):
+    fake_stp.latency = 0.02
+    path = str(tmpdir.join('ordenes.db'))
+    cola = SqliteQueue(path)
+    cola.put_many(_filas(100))
+    supervisor = Supervisor(stpmex_config, path, processes=1, threads=2,
+                            batch_size=5, poll_interval=0.1).start()
+    deadline = time.monotonic() + 60
+    while not fake_stp.ordenes and time.monotonic() < deadline:
+        time.sleep(0.05)
+    proc, = supervisor._procs
+    # Un SIGTERM al proceso no lo corta a la mitad de un grupo: sólo el
+    # supervisor lo detiene
+    os.kill(proc.pid, signal.SIGTERM)
+    time.sleep(0.3)
+    assert proc.is_alive()
+    supervisor.stop()
+    assert supervisor.join(60)
+    assert proc.exitcode == 0
+    assert not cola.counts().get(ENVIANDO)
+    cola.close()